@@ -143,6 +143,8 @@ if "%HAS_ICON%"=="1" (
     --hidden-import=webdriver_manager.chrome ^
     --hidden-import=pandas ^
     --hidden-import=openpyxl ^
+    --hidden-import=xlsxwriter ^
+    --hidden-import=pyarrow ^
     --hidden-import=fitz ^
     --hidden-import=customtkinter ^
     --collect-all customtkinter ^
@@ -166,6 +168,8 @@ if "%HAS_ICON%"=="1" (
     --hidden-import=webdriver_manager.chrome ^
     --hidden-import=pandas ^
     --hidden-import=openpyxl ^
+    --hidden-import=xlsxwriter ^
+    --hidden-import=pyarrow ^
     --hidden-import=fitz ^
     --hidden-import=customtkinter ^
     --collect-all customtkinter ^
@@ -0,0 +1,408 @@
+"""
+CACHÉ DEL ARCHIVO MAESTRO - PayPal
+Guarda una instantánea columnar (Parquet) de la hoja del maestro junto a la aplicación
+para no volver a parsear el .xlsm de red mientras no cambie, y las huellas por
+registro del último periodo procesado para detectar qué filas cambiaron.
+EspejoMaestro mantiene además una copia local del .xlsm de red para parsearlo
+sin leerlo por SMB.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from normalizacion import limpiar_ids
+
+# Columnas que identifican un registro del maestro en las huellas
+CLAVES_HUELLA = ["factura", "orden", "ocurrencia"]
+
+
+def directorio_aplicacion() -> Path:
+    """Carpeta de la aplicación: la del .exe si está empaquetada, la del código si no."""
+    if getattr(sys, 'frozen', False):
+        return Path(sys.executable).parent
+    return Path(__file__).resolve().parent
+
+
+def huellas_filas(df: pd.DataFrame, col_factura: str, col_orden: str) -> pd.DataFrame:
+    """
+    Huella (hash de 64 bits de todas las columnas) de cada registro del maestro.
+    La clave es (factura, orden, ocurrencia): la ocurrencia numera los registros
+    repetidos con la misma factura y orden, en el orden del maestro.
+    """
+    factura = limpiar_ids(df[col_factura]) if col_factura in df.columns else pd.Series("", index=df.index)
+    orden = limpiar_ids(df[col_orden]) if col_orden in df.columns else pd.Series("", index=df.index)
+    huellas = pd.DataFrame({'factura': factura.astype(str), 'orden': orden.astype(str)}, index=df.index)
+    huellas['ocurrencia'] = huellas.groupby(['factura', 'orden']).cumcount()
+    huellas['huella'] = pd.util.hash_pandas_object(df, index=False)
+    return huellas.reset_index(drop=True)
+
+
+@dataclass
+class DeltaMaestro:
+    """Registros insertados, cambiados y eliminados desde el último periodo procesado (solo claves)"""
+    insertados: pd.DataFrame
+    cambiados: pd.DataFrame
+    eliminados: pd.DataFrame
+
+    @property
+    def vacio(self) -> bool:
+        return self.insertados.empty and self.cambiados.empty and self.eliminados.empty
+
+    @property
+    def facturas_afectadas(self) -> set:
+        """Facturas cuyo grupo hay que reconstruir ("" agrupa los registros sin factura)"""
+        return set(pd.concat([self.insertados['factura'], self.cambiados['factura'],
+                              self.eliminados['factura']]))
+
+    def resumen(self) -> str:
+        return (f"{len(self.insertados)} insertados, {len(self.cambiados)} cambiados, "
+                f"{len(self.eliminados)} eliminados")
+
+    @classmethod
+    def comparar(cls, anteriores: pd.DataFrame, actuales: pd.DataFrame) -> 'DeltaMaestro':
+        cruce = actuales.merge(anteriores, on=CLAVES_HUELLA, how='outer',
+                               suffixes=('', '_anterior'), indicator=True)
+        ambos = cruce['_merge'] == 'both'
+        return cls(
+            insertados=cruce.loc[cruce['_merge'] == 'left_only', CLAVES_HUELLA].reset_index(drop=True),
+            cambiados=cruce.loc[ambos & (cruce['huella'] != cruce['huella_anterior']),
+                                CLAVES_HUELLA].reset_index(drop=True),
+            eliminados=cruce.loc[cruce['_merge'] == 'right_only', CLAVES_HUELLA].reset_index(drop=True),
+        )
+
+
+class CacheMaestro:
+    """
+    Instantáneas de la hoja del maestro indexadas por ruta y hoja.
+
+    Cada instantánea guarda la firma del archivo (ruta, tamaño, mtime y hoja);
+    si el maestro cambia, la firma deja de coincidir y la instantánea se descarta.
+    Se usa Parquet cuando pyarrow está disponible y el DataFrame es convertible;
+    en otro caso se recurre a pickle. El mismo mecanismo guarda el volcado
+    de la hoja SAP de un pago (ver ProcesadorExcel.leer_valores_sap).
+
+    Aparte, para cada periodo procesado se guardan las huellas de sus registros
+    (ver huellas_filas); no dependen de la firma y solo se reemplazan al marcar
+    un nuevo procesamiento, de modo que `delta` compara contra lo último escrito.
+    """
+
+    DIRECTORIO = "cache_maestro"
+
+    def __init__(self, directorio: Optional[Path] = None):
+        self.directorio = directorio or directorio_aplicacion() / self.DIRECTORIO
+        self.logger = logging.getLogger(__name__)
+
+    # ------------------------------------------------------------------
+    # Firma e identificación de instantáneas
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def firma(ruta: Path, hoja: str, variante: str = "") -> dict:
+        """
+        Firma del maestro: cambia en cuanto el archivo se modifica.
+        `variante` identifica cómo se parseó (p. ej. las columnas proyectadas).
+        """
+        info = ruta.stat()
+        return {
+            'ruta': str(ruta.resolve()),
+            'hoja': hoja,
+            'tamaño': info.st_size,
+            'mtime_ns': info.st_mtime_ns,
+            'variante': variante,
+        }
+
+    def _base(self, ruta: Path, hoja: str) -> Path:
+        clave = f"{str(ruta.resolve()).lower()}|{hoja}"
+        return self.directorio / hashlib.sha1(clave.encode('utf-8')).hexdigest()[:16]
+
+    def _leer_metadatos(self, base: Path) -> Optional[dict]:
+        archivo_meta = base.with_suffix('.json')
+        if not archivo_meta.exists():
+            return None
+        try:
+            return json.loads(archivo_meta.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    # ------------------------------------------------------------------
+    # API pública
+    # ------------------------------------------------------------------
+
+    def obtener(self, ruta: Path, hoja: str, variante: str = "",
+                conservar_tipos: bool = False) -> Optional[pd.DataFrame]:
+        """
+        Retorna la instantánea si sigue vigente para el maestro actual; None si no.
+        Con `conservar_tipos` las columnas Parquet mantienen sus tipos compactos
+        en lugar de volver a object.
+        """
+        try:
+            base = self._base(ruta, hoja)
+            meta = self._leer_metadatos(base)
+            if not meta:
+                return None
+
+            if meta.get('firma') != self.firma(ruta, hoja, variante):
+                self.logger.info(f"{ruta.name} cambió desde la última lectura. Caché invalidada.")
+                self.invalidar(ruta, hoja)
+                return None
+
+            if meta.get('formato') == 'parquet' and conservar_tipos:
+                df = pd.read_parquet(base.with_suffix('.parquet'))
+            elif meta.get('formato') == 'parquet':
+                df = pd.read_parquet(base.with_suffix('.parquet'), dtype_backend='numpy_nullable')
+                # Volver a object para que el resto del proceso vea los mismos tipos que con read_excel
+                df = df.astype(object).where(df.notna(), None)
+            else:
+                df = pd.read_pickle(base.with_suffix('.pkl'))
+
+            self.logger.info(f"'{hoja}' cargada desde caché ({meta.get('formato')}): {len(df)} registros.")
+            return df
+
+        except Exception as e:
+            self.logger.warning(f"No se pudo leer la caché de {ruta.name}, se leerá el archivo original: {e}")
+            return None
+
+    def guardar(self, ruta: Path, hoja: str, df: pd.DataFrame, variante: str = "",
+                firma: Optional[dict] = None) -> bool:
+        """
+        Guarda la instantánea del maestro ya parseado. `firma` es la tomada antes de
+        leerlo; si no se indica, se calcula ahora.
+        """
+        try:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            base = self._base(ruta, hoja)
+            firma = firma or self.firma(ruta, hoja, variante)
+
+            formato = 'parquet'
+            try:
+                if not all(isinstance(col, str) for col in df.columns):
+                    raise ValueError("nombres de columna no textuales")
+                df.to_parquet(base.with_suffix('.parquet'), index=True)
+                base.with_suffix('.pkl').unlink(missing_ok=True)
+            except Exception as e:
+                # Sin pyarrow, o columnas con tipos mezclados que Parquet no admite
+                self.logger.info(f"Parquet no disponible para '{hoja}' ({e}). Usando pickle.")
+                formato = 'pickle'
+                df.to_pickle(base.with_suffix('.pkl'))
+                base.with_suffix('.parquet').unlink(missing_ok=True)
+
+            meta = {'firma': firma, 'formato': formato, 'filas': len(df)}
+            base.with_suffix('.json').write_text(json.dumps(meta, ensure_ascii=False), encoding='utf-8')
+            self.logger.info(f"Instantánea de '{hoja}' guardada en caché ({formato}).")
+            return True
+
+        except Exception as e:
+            self.logger.warning(f"No se pudo guardar la caché de {ruta.name}: {e}")
+            return False
+
+    def obtener_encabezado(self, ruta: Path, hoja: str) -> Optional[dict]:
+        """
+        Fila de encabezado detectada la última vez: {'fila': índice base 0, 'columnas': [...]}.
+        No depende de la firma del archivo: el maestro cambia a diario, su encabezado casi nunca.
+        """
+        archivo = self._base(ruta, hoja).with_name(f"{self._base(ruta, hoja).name}_encabezado.json")
+        if not archivo.exists():
+            return None
+        try:
+            return json.loads(archivo.read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def guardar_encabezado(self, ruta: Path, hoja: str, fila: int, columnas: list) -> None:
+        """Recuerda la fila de encabezado y su firma (nombres normalizados)"""
+        try:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            base = self._base(ruta, hoja)
+            datos = {'fila': fila, 'columnas': columnas}
+            base.with_name(f"{base.name}_encabezado.json").write_text(
+                json.dumps(datos, ensure_ascii=False), encoding='utf-8'
+            )
+        except OSError as e:
+            self.logger.warning(f"No se pudo guardar el encabezado del maestro en caché: {e}")
+
+    def _archivo_huellas(self, ruta: Path, clave: str) -> Path:
+        base = self._base(ruta, clave)
+        return base.with_name(f"{base.name}_huellas.parquet")
+
+    def obtener_huellas(self, ruta: Path, clave: str) -> Optional[pd.DataFrame]:
+        """Huellas del último procesamiento del periodo `clave`; None si nunca se procesó"""
+        archivo = self._archivo_huellas(ruta, clave)
+        for candidato, lector in ((archivo, pd.read_parquet), (archivo.with_suffix('.pkl'), pd.read_pickle)):
+            if candidato.exists():
+                try:
+                    return lector(candidato)
+                except Exception as e:
+                    self.logger.warning(f"No se pudieron leer las huellas de '{clave}': {e}")
+                    return None
+        return None
+
+    def marcar_procesado(self, ruta: Path, clave: str, huellas: pd.DataFrame) -> None:
+        """Guarda las huellas del periodo recién escrito como referencia del próximo delta"""
+        try:
+            self.directorio.mkdir(parents=True, exist_ok=True)
+            archivo = self._archivo_huellas(ruta, clave)
+            try:
+                huellas.to_parquet(archivo, index=False)
+                archivo.with_suffix('.pkl').unlink(missing_ok=True)
+            except Exception:
+                huellas.to_pickle(archivo.with_suffix('.pkl'))
+                archivo.unlink(missing_ok=True)
+            self.logger.info(f"Huellas de '{clave}' guardadas: {len(huellas)} registros.")
+        except OSError as e:
+            self.logger.warning(f"No se pudieron guardar las huellas de '{clave}': {e}")
+
+    def delta(self, ruta: Path, clave: str, huellas: pd.DataFrame) -> Optional[DeltaMaestro]:
+        """
+        Registros insertados, cambiados y eliminados del periodo `clave` desde su último
+        procesamiento. None si no hay huellas anteriores (hay que construirlo completo).
+        """
+        anteriores = self.obtener_huellas(ruta, clave)
+        if anteriores is None:
+            return None
+        delta = DeltaMaestro.comparar(anteriores, huellas)
+        self.logger.info(f"Delta de '{clave}' desde el último procesamiento: {delta.resumen()}.")
+        return delta
+
+    def invalidar(self, ruta: Optional[Path] = None, hoja: Optional[str] = None,
+                  encabezado: bool = False) -> int:
+        """
+        Elimina instantáneas. Con ruta y hoja borra solo esa (y el encabezado recordado
+        si `encabezado`, p. ej. al refrescar a mano); sin argumentos, todo el directorio.
+        El encabezado se conserva por defecto: sobrevive a los cambios de contenido del maestro.
+        Retorna el número de archivos eliminados.
+        """
+        if not self.directorio.exists():
+            return 0
+
+        if ruta is not None and hoja is not None:
+            base = self._base(ruta, hoja)
+            archivos = [base.with_suffix(ext) for ext in ('.json', '.parquet', '.pkl')]
+            if encabezado:
+                archivos.append(base.with_name(f"{base.name}_encabezado.json"))
+        else:
+            archivos = [f for f in self.directorio.iterdir() if f.is_file()]
+
+        eliminados = 0
+        for archivo in archivos:
+            try:
+                if archivo.exists():
+                    archivo.unlink()
+                    eliminados += 1
+            except OSError as e:
+                self.logger.warning(f"No se pudo eliminar {archivo.name} de la caché: {e}")
+        return eliminados
+
+
+class EspejoMaestro:
+    """
+    Copia local del maestro (que vive en una unidad de red) para que el parseo no
+    lea el .xlsm por SMB.
+
+    La copia solo se renueva cuando cambian el tamaño o la fecha de modificación del
+    original. Se copia directamente y se comprueba que ese estado no cambió durante la
+    copia (otro usuario podría estar guardando); solo entonces se reintenta. El espejo
+    se reemplaza de forma atómica. Mientras alguien tiene el maestro abierto en Excel
+    (existe su archivo de propietario `~$`) la copia se pospone si hay un espejo anterior.
+    Si no se puede copiar, se sigue usando el espejo anterior cuando existe (y
+    `desactualizado` queda en True), o el original.
+    """
+
+    SUBDIRECTORIO = "espejo"
+
+    def __init__(self, directorio: Optional[Path] = None, reintentos: int = 5, pausa: float = 2.0):
+        self.directorio = directorio or directorio_aplicacion() / CacheMaestro.DIRECTORIO / self.SUBDIRECTORIO
+        self.reintentos = reintentos
+        self.pausa = pausa
+        # True si la última sincronización devolvió un espejo anterior al estado actual del original
+        self.desactualizado = False
+        self.logger = logging.getLogger(__name__)
+
+    def ruta_espejo(self, ruta: Path) -> Path:
+        """Ruta de la copia local; conserva el nombre (y la extensión) del original"""
+        clave = hashlib.sha1(str(ruta.resolve()).lower().encode('utf-8')).hexdigest()[:12]
+        return self.directorio / f"{clave}_{ruta.name}"
+
+    @staticmethod
+    def _estado(ruta: Path) -> list:
+        info = ruta.stat()
+        return [info.st_size, info.st_mtime_ns]
+
+    def _estado_copiado(self, espejo: Path) -> Optional[list]:
+        meta = espejo.with_name(f"{espejo.name}.json")
+        if not espejo.exists() or not meta.exists():
+            return None
+        try:
+            return json.loads(meta.read_text(encoding='utf-8')).get('estado')
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def archivo_propietario(ruta: Path) -> Path:
+        """Archivo que Excel crea junto al libro mientras alguien lo tiene abierto"""
+        return ruta.with_name(f"~${ruta.name}")
+
+    def sincronizar(self, ruta: Path) -> Path:
+        """
+        Retorna la ruta desde la que conviene leer el maestro: el espejo (copiándolo
+        antes si el original cambió) o, si no hay forma de copiarlo, el original.
+        Solo se espera entre reintentos, cuando la copia falló o el original cambió.
+        """
+        espejo = self.ruta_espejo(ruta)
+        temporal = espejo.with_name(f"~tmp_{espejo.name}")
+        self.desactualizado = False
+
+        for intento in range(1, self.reintentos + 1):
+            try:
+                estado = self._estado(ruta)
+                if self._estado_copiado(espejo) == estado:
+                    return espejo
+
+                # Abierto en Excel: puede guardarse en cualquier momento; se usa el espejo anterior.
+                # Sin espejo se copia igual (la comprobación de estado protege la copia)
+                if espejo.exists() and self.archivo_propietario(ruta).exists():
+                    self.logger.info(f"{ruta.name} está abierto en Excel; se pospone la copia al espejo.")
+                    break
+
+                # 1. Copiar a un temporal y confirmar que el original no cambió mientras tanto
+                self.directorio.mkdir(parents=True, exist_ok=True)
+                inicio = time.perf_counter()
+                shutil.copyfile(ruta, temporal)
+                if self._estado(ruta) != estado:
+                    self.logger.info(f"{ruta.name} cambió durante la copia (se está guardando); "
+                                     f"reintento {intento}/{self.reintentos}.")
+                    time.sleep(self.pausa)
+                    continue
+
+                # 2. Reemplazo atómico del espejo y de su estado
+                os.replace(temporal, espejo)
+                espejo.with_name(f"{espejo.name}.json").write_text(
+                    json.dumps({'origen': str(ruta), 'estado': estado}), encoding='utf-8'
+                )
+                self.logger.info(f"Espejo local de {ruta.name} actualizado "
+                                 f"({estado[0] / 1e6:.1f} MB en {time.perf_counter() - inicio:.1f}s).")
+                return espejo
+
+            except PermissionError as e:
+                self.logger.info(f"{ruta.name} está bloqueado ({e}); reintento {intento}/{self.reintentos}.")
+                time.sleep(self.pausa)
+            except OSError as e:
+                self.logger.warning(f"No se pudo copiar {ruta.name} al espejo local: {e}")
+                break
+            finally:
+                temporal.unlink(missing_ok=True)
+
+        if espejo.exists():
+            self.desactualizado = True
+            self.logger.warning(f"Se usa el espejo anterior de {ruta.name} (puede estar desactualizado).")
+            return espejo
+        return ruta
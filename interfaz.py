@@ -3,8 +3,10 @@ from tkinter import messagebox
 from pathlib import Path
 from datetime import datetime 
 from config_manager import ConfiguradorRutasPayPal
+from cache_maestro import CacheMaestro
 import threading
 import logging
+import time
 import sys
 import os
 
@@ -88,6 +90,7 @@ class PaymentApp(ctk.CTk):
         
         # Variables para proceso completo
         self.archivo_movido = None
+        self.archivo_descargado = None
         self.df_segunda = None
         self.carpeta_soporte = None
         
@@ -309,6 +312,18 @@ class PaymentApp(ctk.CTk):
         self.año_select = ctk.CTkComboBox(date_frame, values=años, width=70, height=35, state="readonly")
         self.año_select.set(str(datetime.now().year))
         self.año_select.pack(side="left", expand=True, padx=(5, 0))
+
+        # Exportación rápida: la hoja Validación se genera con xlsxwriter
+        self.chk_exportacion_rapida = ctk.CTkCheckBox(
+            action_side,
+            text="Exportación rápida (meses grandes)",
+            font=("Roboto", 11),
+            text_color=COLOR_TEXT_DIM,
+            fg_color=COLOR_PRIMARY
+        )
+        if Config.EXPORTACION_RAPIDA:
+            self.chk_exportacion_rapida.select()
+        self.chk_exportacion_rapida.pack(anchor="w", padx=30, pady=(0, 15))
         
         # Botón Principal
         self.btn_ejecutar = ctk.CTkButton(
@@ -350,6 +365,19 @@ class PaymentApp(ctk.CTk):
             font=("Roboto", 11),
             text_color=COLOR_TEXT_DIM
         ).pack(pady=(0, 20))
+
+        # Botón para forzar la relectura del maestro (descarta la caché)
+        self.btn_refrescar_maestro = ctk.CTkButton(
+            action_side,
+            text="🔄 Refrescar Maestro",
+            command=self.refresh_master,
+            fg_color="transparent",
+            text_color=COLOR_PRIMARY,
+            hover_color=("#E4E6EB", "#2A3357"),
+            font=("Roboto", 12, "bold"),
+            height=36
+        )
+        self.btn_refrescar_maestro.pack(fill="x", padx=30, pady=(0, 20))
         
     def create_running_content(self):
         """Crea el contenido del estado RUNNING con un diseño compacto y adaptativo"""
@@ -887,6 +915,33 @@ class PaymentApp(ctk.CTk):
             height=45
         ).pack(side="left", fill="x", expand=True, padx=(10, 0))
     
+    def refresh_master(self):
+        """Descarta la caché del maestro y lo vuelve a leer en segundo plano"""
+        if self.operation_running:
+            messagebox.showwarning("Maestro", "Espere a que termine la operación en curso.")
+            return
+        if not Config.RUTA_MAESTRO or not Config.RUTA_MAESTRO.exists():
+            messagebox.showerror("Maestro", f"No se encontró el archivo maestro:\n{Config.RUTA_MAESTRO}")
+            return
+
+        self.btn_refrescar_maestro.configure(state="disabled", text="⏳ Leyendo maestro...")
+        threading.Thread(target=self._run_refresh_master, daemon=True).start()
+
+    def _run_refresh_master(self):
+        """Hilo: invalida la instantánea y la reconstruye desde el Excel"""
+        try:
+            inicio = time.time()
+            CacheMaestro().invalidar(Config.RUTA_MAESTRO, Config.HOJA_MAESTRO, encabezado=True)
+            df = ProcesadorExcel().leer_maestro(Config.RUTA_MAESTRO, Config.HOJA_MAESTRO)
+            mensaje = f"Maestro actualizado: {len(df)} registros en {time.time() - inicio:.1f} s."
+            self.logger.info(mensaje)
+            self.after(0, lambda: messagebox.showinfo("Maestro", mensaje))
+        except Exception as e:
+            self.logger.error(f"Error refrescando maestro: {e}", exc_info=True)
+            self.after(0, lambda e=e: messagebox.showerror("Maestro", f"No se pudo leer el maestro:\n{e}"))
+        finally:
+            self.after(0, lambda: self.btn_refrescar_maestro.configure(state="normal", text="🔄 Refrescar Maestro"))
+
     def show_verificar_soportes(self):
         """NUEVO: Muestra la interfaz para verificar soportes"""
         self.modo_verificacion = True
@@ -1126,6 +1181,11 @@ class PaymentApp(ctk.CTk):
                           "Julio":7, "Agosto":8, "Septiembre":9, "Octubre":10, "Noviembre":11, "Diciembre":12}
             self.mes_pago = meses_dict.get(self.mes_select.get(), datetime.now().month)
             self.año_pago = int(self.año_select.get())
+            self.exportacion_rapida = bool(self.chk_exportacion_rapida.get())
+
+            # Un solo procesador por ejecución: entre pasos conserva las huellas pendientes
+            # del periodo y la hoja 'Validación' anterior del pago
+            self.procesador = ProcesadorExcel()
             
             # Obtener el siguiente número de pago automáticamente
             gestor = GestorCarpetas(Config.BASE_PAYPAL)
@@ -1359,6 +1419,7 @@ class PaymentApp(ctk.CTk):
             
             descargador = DescargadorSAP()
             archivo = descargador.descargar_reporte_sap(self.numero_pago)
+            self.archivo_descargado = archivo
             if archivo:
                 self.log_message(f" Archivo descargado: {archivo.name}")
             else:
@@ -1392,8 +1453,10 @@ class PaymentApp(ctk.CTk):
                     progress_callback=update_step_progress
                 )
                 
-                procesador = ProcesadorExcel()
-                procesador.guardar_excel_con_dos_hojas(self.archivo_movido, self.df_segunda)
+                self.procesador.guardar_excel_con_dos_hojas(
+                    self.archivo_movido, self.df_segunda,
+                    rapido=getattr(self, 'exportacion_rapida', None)
+                )
                 
                 self.log_message(f" PDFs procesados y Excel final actualizado.")
             else:
@@ -1405,9 +1468,13 @@ class PaymentApp(ctk.CTk):
         """Paso 3: Procesar Excel"""
         self.log_message("📊 Procesando archivo Excel...")
         try:
-            procesador = ProcesadorExcel()
+            procesador = self.procesador
             
-            archivo = procesador.buscar_archivo_pago_en_descargas(self.numero_pago)
+            # El archivo de la descarga automática; si no hubo, el exportado a mano en Descargas
+            archivo = self.archivo_descargado
+            if not (archivo and archivo.exists()):
+                archivo = procesador.buscar_archivo_pago_en_descargas(self.numero_pago)
+            self.archivo_descargado = None
             if archivo:
                 self.log_message(f" Archivo encontrado: {archivo.name}")
                 
@@ -1432,7 +1499,10 @@ class PaymentApp(ctk.CTk):
                     
                     self.df_segunda = procesador.calcular_mon_grupo_y_diferencia(self.archivo_movido, self.df_segunda)
                     
-                    procesador.guardar_excel_con_dos_hojas(self.archivo_movido, self.df_segunda)
+                    procesador.guardar_excel_con_dos_hojas(
+                        self.archivo_movido, self.df_segunda,
+                        rapido=getattr(self, 'exportacion_rapida', None)
+                    )
                     self.log_message(" Procesamiento inicial de Excel completado")
                 else:
                     self.log_message("⚠️ Archivo maestro no encontrado")
@@ -1446,11 +1516,22 @@ class PaymentApp(ctk.CTk):
         """Paso 5: Actualizar Maestro"""
         self.log_message("📋 Actualizando archivo maestro...")
         try:
-            if self.archivo_movido and self.archivo_movido.exists():
-                self.log_message(f"⚠️ Funcionalidad pendiente de implementar.")
-                self.log_message(f"📁 Archivo listo en: {self.archivo_movido}")
-            else:
+            if self.df_segunda is None or not (self.archivo_movido and self.archivo_movido.exists()):
                 self.log_message("⚠️ No hay archivo procesado para actualizar en el maestro.")
+            elif not Config.RUTA_MAESTRO or not Config.RUTA_MAESTRO.exists():
+                self.log_message("⚠️ Archivo maestro no encontrado")
+            else:
+                resultado = self.procesador.actualizar_maestro(Config.RUTA_MAESTRO, self.df_segunda, self.numero_pago)
+                if resultado is None:
+                    self.log_message(" No se pudo actualizar el maestro (¿está abierto en Excel?)")
+                else:
+                    self.log_message(
+                        f" Maestro actualizado: {resultado['celdas']} celdas en "
+                        f"{resultado['registros']} registros ({resultado['segundos']:.1f}s)"
+                    )
+                    if resultado['no_encontrados']:
+                        self.log_message(f"⚠️ {resultado['no_encontrados']} registros no se encontraron en el maestro")
+                self.log_message(f"📁 Archivo listo en: {self.archivo_movido}")
         except Exception as e:
             self.log_message(f" Error en actualización de maestro: {e}")
     
@@ -1,27 +1,41 @@
 import os
 import sys
+import argparse
 import time
 import shutil
+import tempfile
+import itertools
 import logging
 import traceback
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime, time as dt_time, timedelta
 from typing import Optional, List, Tuple
 
+import numpy as np
 import pandas as pd
 import openpyxl
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Alignment, Font
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Alignment, Font, Border, Side
 from openpyxl.utils import get_column_letter
 import openpyxl.utils
 import fitz  # PyMuPDF
 
+from cache_maestro import CacheMaestro, EspejoMaestro, directorio_aplicacion, huellas_filas
+from config_manager import ConfiguradorRutasPayPal
+from paquete_excel import actualizar_celdas, reemplazar_hoja, reordenar_columnas
+from normalizacion import (
+    COLUMNAS_FECHA, aplicar_esquema, asignar_valor, limpiar_ids, limpiar_nulos, preparar_para_excel
+)
+
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import (
+    TimeoutException, NoSuchElementException, StaleElementReferenceException, WebDriverException
+)
 
 # ============================================================================
 # CONFIGURACIÓN Y CONSTANTES
@@ -59,11 +73,65 @@ class Config:
         "Valoración flete", "Diferencia", "Observaciones"
     ]
 
+    # Filas iniciales del maestro en las que se busca el encabezado
+    FILAS_BUSQUEDA_ENCABEZADO = 10
+
+    # Variantes de nombre aceptadas en el maestro (clave y valores en minúsculas)
+    ALIAS_COLUMNAS_MAESTRO = {
+        "neto despues de prorrateo": ["neto, despues de prorrateo"],
+        "pago #": ["pago#", "pago no.", "no. pago", "numero de pago", "número de pago"],
+    }
+
     # Timeouts — sin cambios
     TIMEOUT_SAP      = 30
     TIMEOUT_DOWNLOAD = 30
+
+    # Descarga SAP: timeout (s) de cada paso de la máquina de estados y selector CSS
+    # del indicador de "ocupado" de la WebGUI (el paso avanza cuando desaparece)
+    TIMEOUTS_PASOS_SAP = {
+        "login": 30, "transaccion": 30, "formulario": 30,
+        "resultados": 120, "exportacion": 30, "descarga": TIMEOUT_DOWNLOAD,
+    }
+    SAP_SELECTOR_OCUPADO = "#ur-loading, .lsBusyIndicator, .urBusyIndicator"
+
+    # Perfil ligero de Chrome para la WebGUI: headless, sin imágenes ni fuentes web,
+    # sin extensiones ni tráfico en segundo plano y con un perfil (caché) reutilizado.
+    # Ese perfil (carpeta perfil_chrome_sap junto a la aplicación) solo admite un Chrome
+    # a la vez: una segunda descarga simultánea desde la misma instalación no arranca.
+    # Medir con scripts/benchmark_sap.py antes de activarlo.
+    PERFIL_SAP_LIGERO = False
+    RECURSOS_BLOQUEADOS_SAP = [
+        "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico",
+        "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+    ]
+    # Llenar los campos de cada pantalla con una sola llamada de JavaScript en lugar de
+    # clear + send_keys por campo; los campos que no acepten el valor se teclean.
+    # Desactivado: los controles de la WebGUI escuchan eventos de teclado y un valor
+    # asignado por script puede verse en el campo sin llegar a SAP (el script no lo
+    # detecta). Activarlo solo tras comprobarlo contra la WebGUI real.
+    LLENADO_SAP_JS = False
     ACTIVAR_LOG_ARCHIVO = False
 
+    # Caché columnar del maestro (se invalida sola si el archivo cambia)
+    USAR_CACHE_MAESTRO = True
+    # Copia local del maestro de red; el parseo lee la copia
+    USAR_ESPEJO_MAESTRO = True
+
+    # Generar la hoja 'Validación' con xlsxwriter en lugar de openpyxl
+    EXPORTACION_RAPIDA = False
+
+    # Lectura de la hoja SAP: filas por lote y volcado opcional a Parquet (reutilizable)
+    LOTE_FILAS_SAP = 50_000
+    VOLCADO_SAP_PARQUET = False
+
+    # Actualización del maestro al cerrar un pago: columna del número de pago
+    # y columnas que se devuelven desde la segunda hoja
+    COLUMNA_PAGO_MAESTRO = "Pago #"
+    COLUMNAS_ACTUALIZAR_MAESTRO = ["Observaciones", "Fecha del envío"]
+
+    # Columnas que escribe la revisión de soportes (PDFs); se conservan al reconstruir un pago
+    COLUMNAS_REVISION_SOPORTES = ["Observaciones", "Fecha del envío"]
+
     @classmethod
     def cargar_desde_ini(cls, rutas: dict) -> None:
         cls.BASE_PAYPAL  = rutas["base_paypal"]
@@ -269,15 +337,85 @@ def obtener_ruta_chromedriver() -> Path:
 
 class DescargadorSAP:
     """Maneja la descarga de archivos desde SAP"""
+
+    # Cada sesión descarga en su propia carpeta temporal (tempfile) con este prefijo
+    PREFIJO_CARPETA_SESION = "paypal_sap_"
+    # Extensiones de descargas en curso (Chrome, Firefox)
+    EXTENSIONES_PARCIALES = (".crdownload", ".part", ".tmp")
+
+    # Asigna {id: valor} con el setter nativo, dispara input/change/blur como al teclear
+    # y retorna los IDs cuyo valor no quedó (inexistentes, de solo lectura o reescritos)
+    SCRIPT_LLENAR_CAMPOS = """
+        var valores = arguments[0], rechazados = [];
+        Object.keys(valores).forEach(function (id) {
+            var campo = document.getElementById(id);
+            if (!campo || campo.readOnly || campo.disabled) { rechazados.push(id); return; }
+            var propiedad = Object.getOwnPropertyDescriptor(Object.getPrototypeOf(campo), "value");
+            campo.focus();
+            if (propiedad && propiedad.set) { propiedad.set.call(campo, valores[id]); } else { campo.value = valores[id]; }
+            ["input", "change"].forEach(function (tipo) {
+                campo.dispatchEvent(new Event(tipo, { bubbles: true }));
+            });
+            campo.blur();
+            if (campo.value !== valores[id]) { rechazados.push(id); }
+        });
+        return rechazados;
+    """
     
     def __init__(self):
         self.driver = None
         self.logger = logging.getLogger(__name__)
         self.download_path = Config.RUTA_DESCARGAS
+        self.comandos_webdriver = 0
     
-    def configurar_chrome(self) -> webdriver.Chrome:
+    def opciones_chrome(self, ligero: bool = False) -> webdriver.ChromeOptions:
+        """Opciones de Chrome: las de siempre y, con `ligero`, el perfil de rendimiento"""
+        options = webdriver.ChromeOptions()
+
+        # Desactivar logs innecesarios de la consola
+        options.add_argument("--log-level=3")
+        options.add_experimental_option('excludeSwitches', ['enable-logging'])
+
+        # Configurar preferencias de descarga
+        prefs = {
+            "download.default_directory": str(self.download_path),
+            "download.prompt_for_download": False,
+            "safebrowsing.enabled": True,
+        }
+
+        if ligero:
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=1137,694")
+            options.add_argument("--disable-extensions")
+            options.add_argument("--disable-background-networking")
+            options.add_argument("--disable-component-update")
+            options.add_argument("--disable-default-apps")
+            options.add_argument("--disable-sync")
+            options.add_argument("--no-first-run")
+            options.add_argument("--blink-settings=imagesEnabled=false")
+            # Perfil propio y persistente: la caché de la WebGUI sobrevive entre ejecuciones.
+            # Chrome bloquea el user-data-dir mientras está abierto, así que no pueden usarlo
+            # dos instancias a la vez (p. ej. la interfaz y la línea de comandos en paralelo)
+            options.add_argument(f"--user-data-dir={directorio_aplicacion() / 'perfil_chrome_sap'}")
+            prefs["profile.managed_default_content_settings.images"] = 2
+
+        options.add_experimental_option("prefs", prefs)
+        return options
+
+    def _aplicar_perfil_ligero(self, driver) -> None:
+        """Bloquea imágenes y fuentes por CDP y permite descargas en modo headless"""
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": Config.RECURSOS_BLOQUEADOS_SAP})
+            driver.execute_cdp_cmd("Browser.setDownloadBehavior",
+                                   {"behavior": "allow", "downloadPath": str(self.download_path)})
+        except Exception as e:
+            self.logger.warning(f"No se pudo aplicar por completo el perfil ligero: {e}")
+
+    def configurar_chrome(self, ligero: Optional[bool] = None) -> webdriver.Chrome:
         """
         Configura el navegador Google Chrome con opciones personalizadas.
+        Con `ligero` (por defecto Config.PERFIL_SAP_LIGERO) usa el perfil de rendimiento.
         
         IMPORTANTE: Esta función detecta automáticamente si está corriendo
         desde un .exe (producción) o en modo desarrollo:
@@ -286,22 +424,10 @@ class DescargadorSAP:
         """
         try:
             from selenium.webdriver.chrome.service import Service
-            from subprocess import CREATE_NO_WINDOW
 
-            # Configurar opciones de Chrome
-            options = webdriver.ChromeOptions()
-
-            # Desactivar logs innecesarios de la consola
-            options.add_argument("--log-level=3")
-            options.add_experimental_option('excludeSwitches', ['enable-logging'])
-
-            # Configurar preferencias de descarga
-            prefs = {
-                "download.default_directory": str(self.download_path),
-                "download.prompt_for_download": False,
-                "safebrowsing.enabled": True,
-            }
-            options.add_experimental_option("prefs", prefs)
+            if ligero is None:
+                ligero = Config.PERFIL_SAP_LIGERO
+            options = self.opciones_chrome(ligero)
 
             # ============================================================
             # OBTENER CHROMEDRIVER SEGÚN CONTEXTO (PRODUCCIÓN VS DESARROLLO)
@@ -322,7 +448,9 @@ class DescargadorSAP:
             
             # Iniciar navegador
             driver = webdriver.Chrome(options=options, service=service)
-            self.logger.info("Navegador Google Chrome configurado correctamente")
+            if ligero:
+                self._aplicar_perfil_ligero(driver)
+            self.logger.info(f"Navegador Google Chrome configurado correctamente (perfil {'ligero' if ligero else 'estándar'})")
             return driver
 
         except FileNotFoundError as e:
@@ -334,164 +462,212 @@ class DescargadorSAP:
             self.logger.error(traceback.format_exc())
             raise
     
-    def esperar_descarga(self, timeout: int = Config.TIMEOUT_DOWNLOAD, patron_alternativo: str = None) -> Optional[Path]:
-        """Espera a que se complete la descarga y retorna el archivo"""
+    def crear_carpeta_sesion(self, numero_pago: int) -> Path:
+        """Carpeta temporal privada de descarga para esta sesión de SAP"""
+        self.download_path = Path(tempfile.mkdtemp(prefix=f"{self.PREFIJO_CARPETA_SESION}{numero_pago}_"))
+        self.logger.info(f"Carpeta de descarga de la sesión: {self.download_path}")
+        return self.download_path
+
+    @classmethod
+    def es_carpeta_sesion(cls, carpeta: Path) -> bool:
+        return (carpeta.name.startswith(cls.PREFIJO_CARPETA_SESION)
+                and carpeta.parent.resolve() == Path(tempfile.gettempdir()).resolve())
+
+    @classmethod
+    def limpiar_carpeta_sesion(cls, carpeta: Path) -> None:
+        """Elimina la carpeta temporal de una sesión (solo si realmente lo es)"""
+        if cls.es_carpeta_sesion(carpeta):
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+    def esperar_descarga(self, timeout: float = Config.TIMEOUT_DOWNLOAD,
+                         intervalo: float = 0.2) -> Optional[Path]:
+        """
+        Espera a que termine la descarga en la carpeta de la sesión y retorna el archivo.
+
+        La carpeta es privada, así que cualquier archivo que aparezca es el reporte: se
+        considera completo cuando no quedan temporales (.crdownload/.part) y su tamaño
+        no cambia entre dos sondeos consecutivos.
+        """
         try:
-            inicio = time.time()
-            self.logger.info(f"Iniciando espera de descarga (timeout: {timeout}s)...")
-            
-            while time.time() - inicio < timeout:
-                # Buscar archivos .xlsx recién descargados
-                archivos = list(self.download_path.glob("EXPORT_*.xlsx"))
-                
-                # Si se proporcionó un patrón alternativo (ej: "pago 12*")
-                if patron_alternativo:
-                    archivos.extend(list(self.download_path.glob(patron_alternativo)))
-                
-                # Verificar que no haya archivos temporales
-                archivos_temp = list(self.download_path.glob("*.part"))
-                archivos_temp.extend(list(self.download_path.glob("*.crdownload")))
-                
-                if archivos and not archivos_temp:
-                    # Ordenar por fecha de modificación
-                    archivo_mas_reciente = max(archivos, key=lambda x: x.stat().st_mtime)
-                    
-                    # Verificar que el archivo tenga al menos 1KB
-                    # Y que haya sido creado/modificado en los últimos 5 minutos
-                    antiguedad_segundos = time.time() - archivo_mas_reciente.stat().st_mtime
-                    if archivo_mas_reciente.stat().st_size > 1024 and antiguedad_segundos < 300:
-                        self.logger.info(f"Archivo detectado y verificado: {archivo_mas_reciente}")
-                        return archivo_mas_reciente
-                    elif archivo_mas_reciente.stat().st_size > 1024 and antiguedad_segundos >= 300:
-                        self.logger.warning(f"Archivo encontrado pero es antiguo ({int(antiguedad_segundos)}s). Ignorando: {archivo_mas_reciente.name}")
-                
-                time.sleep(2)
-            
-            patron_error = patron_alternativo if patron_alternativo else "EXPORT_*.xlsx"
-            self.logger.error(f"TIEMPO EXCEDIDO: No se encontró el archivo {patron_error} en {self.download_path} después de {timeout} segundos.")
+            inicio = time.perf_counter()
+            self.logger.info(f"Iniciando espera de descarga en {self.download_path} (timeout: {timeout}s)...")
+
+            anterior = None
+            while time.perf_counter() - inicio < timeout:
+                with os.scandir(self.download_path) as entradas:
+                    archivos = [(e.name, e.stat().st_size) for e in entradas if e.is_file()]
+
+                parciales = [nombre for nombre, _ in archivos if nombre.lower().endswith(self.EXTENSIONES_PARCIALES)]
+                completos = [(nombre, tamaño) for nombre, tamaño in archivos
+                             if nombre not in parciales and tamaño > 0]
+
+                if completos and not parciales:
+                    actual = max(completos, key=lambda archivo: archivo[1])
+                    if actual == anterior:
+                        archivo = self.download_path / actual[0]
+                        self.logger.info(f"Archivo detectado y verificado: {archivo} "
+                                         f"({time.perf_counter() - inicio:.1f}s)")
+                        return archivo
+                    anterior = actual
+                else:
+                    anterior = None
+
+                time.sleep(intervalo)
+
+            self.logger.error(f"TIEMPO EXCEDIDO: No se completó ninguna descarga en {self.download_path} "
+                              f"después de {timeout} segundos.")
             return None
-        
+
         except Exception as e:
             self.logger.error(f"ERROR DURANTE LA ESPERA DE DESCARGA: {str(e)}")
             return None
-    
-    def _esperar_y_hacer(self, wait, by, selector, accion="presence", valor=None, descripcion=""):
-        """Método auxiliar para esperar elementos con mensajes de error claros"""
+
+    # ------------------------------------------------------------------
+    # Máquina de estados de la descarga
+    # ------------------------------------------------------------------
+
+    # Pasos en orden; cada uno termina cuando la pantalla del siguiente está lista
+    PASOS_DESCARGA = ("login", "transaccion", "formulario", "resultados", "exportacion", "descarga")
+
+    def _esperar_condicion(self, condicion, timeout: float, descripcion: str):
+        """Espera a que `condicion(driver)` sea verdadera, sondeando cada 0.2 s"""
         try:
-            if accion == "presence":
-                elemento = wait.until(EC.presence_of_element_located((by, selector)))
-            elif accion == "clickable":
-                elemento = wait.until(EC.element_to_be_clickable((by, selector)))
-            else:
-                raise ValueError(f"Acción no reconocida: {accion}")
-            
-            if valor is not None:
-                elemento.clear() if hasattr(elemento, 'clear') else None
-                elemento.send_keys(valor)
-            
-            return elemento
+            # La WebGUI regenera la pantalla: un elemento puede desaparecer entre dos consultas
+            return WebDriverWait(self.driver, timeout, poll_frequency=0.2,
+                                 ignored_exceptions=(NoSuchElementException, StaleElementReferenceException)
+                                 ).until(condicion)
         except TimeoutException:
-            msg = f"ERROR DE TIEMPO: No se encontró o no está disponible: '{descripcion}' (Selector: {selector})"
-            self.logger.error(msg)
-            raise Exception(msg)
+            raise TimeoutException(f"{descripcion} (más de {timeout}s)")
+
+    def _sap_libre(self, driver) -> bool:
+        """Página cargada y sin el indicador de "ocupado" de la WebGUI visible"""
+        if driver.execute_script("return document.readyState") != "complete":
+            return False
+        ocupados = driver.find_elements(By.CSS_SELECTOR, Config.SAP_SELECTOR_OCUPADO)
+        return not any(elemento.is_displayed() for elemento in ocupados)
+
+    def _elemento_listo(self, by, selector, clickable: bool = False):
+        """Sonda: el elemento existe (o es clicable) y SAP no está ocupado"""
+        esperado = EC.element_to_be_clickable((by, selector)) if clickable else EC.presence_of_element_located((by, selector))
+
+        def sonda(driver):
+            elemento = esperado(driver)
+            return elemento if elemento and self._sap_libre(driver) else False
+        return sonda
+
+    def _llenar(self, elemento, valor: str):
+        elemento.clear()
+        elemento.send_keys(valor)
+
+    def _llenar_campos(self, valores: dict):
+        """
+        Llena varios campos (ID -> valor) de la pantalla actual tecleándolos. Con
+        Config.LLENADO_SAP_JS es un solo viaje a WebDriver y solo se teclean los campos
+        que rechacen el valor.
+        """
+        pendientes = list(valores)
+        if Config.LLENADO_SAP_JS:
+            pendientes = self.driver.execute_script(self.SCRIPT_LLENAR_CAMPOS, valores) or []
+            if pendientes:
+                self.logger.warning(f"[SAP] Campos que no aceptaron el valor por script: {pendientes}; "
+                                    f"se escriben con el teclado")
+        for id_campo in pendientes:
+            self._llenar(self.driver.find_element(By.ID, id_campo), valores[id_campo])
+
+    def _contar_comandos(self):
+        """Cuenta en self.comandos_webdriver cada comando (viaje de ida y vuelta) enviado al navegador"""
+        ejecutor = getattr(self.driver, "command_executor", None)
+        if ejecutor is None or getattr(ejecutor, "_contador_sap", None) is self:
+            return
+        original = ejecutor.execute
+
+        def execute(comando, parametros):
+            self.comandos_webdriver += 1
+            return original(comando, parametros)
+        ejecutor.execute = execute
+        ejecutor._contador_sap = self
+
+    def _paso_login(self, timeout: float, contexto: dict):
+        self._esperar_condicion(self._elemento_listo(By.ID, "sap-user"), timeout, "Campo Usuario")
+        self._llenar_campos({"sap-user": Config.SAP_USER, "sap-password": Config.SAP_PASSWORD})
+        self.driver.find_element(By.ID, "sap-password").send_keys(Keys.ENTER)
+        self._esperar_condicion(self._elemento_listo(By.ID, "ToolbarOkCode"), timeout,
+                                "Barra de transacciones (ToolbarOkCode)")
+
+    def _paso_transaccion(self, timeout: float, contexto: dict):
+        toolbar = self._esperar_condicion(self._elemento_listo(By.ID, "ToolbarOkCode"), timeout,
+                                          "Barra de transacciones (ToolbarOkCode)")
+        # "/n" abre la transacción desde cualquier pantalla (sesión reutilizada)
+        prefijo = "/n" if contexto.get('nueva_transaccion') else ""
+        self._llenar_campos({"ToolbarOkCode": prefijo + Config.SAP_TRANSACCION})
+        toolbar.send_keys(Keys.ENTER)
+        self._esperar_condicion(self._elemento_listo(By.ID, "M0:46:::1:34"), timeout, "Campo Cuenta de Mayor")
+
+    def _paso_formulario(self, timeout: float, contexto: dict):
+        self._esperar_condicion(self._elemento_listo(By.ID, "M0:46:::2:34"), timeout, "Campo Sociedad")
+        self._llenar_campos({"M0:46:::1:34": Config.SAP_CUENTA, "M0:46:::2:34": Config.SAP_SOCIEDAD})
+        self.driver.execute_script("window.scrollTo(0,0)")
+        ejecutar_btn = self._esperar_condicion(self._elemento_listo(By.ID, "M0:50::btn[8]", clickable=True),
+                                               timeout, "Botón Ejecutar (F8)")
+        ejecutar_btn.click()
+        contexto['ejecutar_btn'] = ejecutar_btn
+
+    def _paso_resultados(self, timeout: float, contexto: dict):
+        # La lista está cargada cuando la pantalla de selección se reemplazó y SAP quedó libre
+        def resultados_cargados(driver):
+            return EC.staleness_of(contexto['ejecutar_btn'])(driver) and self._sap_libre(driver)
+        self._esperar_condicion(resultados_cargados, timeout, "Tabla de resultados")
+
+    def _paso_exportacion(self, timeout: float, contexto: dict):
+        # Mayus + F4 abre la ventana de exportación; si falla, el usuario puede exportar a mano
+        # mientras el paso de descarga espera el archivo
+        try:
+            cuerpo = self.driver.find_element(By.TAG_NAME, "body")
+            cuerpo.click()
+            cuerpo.send_keys(Keys.SHIFT + Keys.F4)
+            campo_nombre = self._esperar_condicion(self._elemento_listo(By.ID, "M1:46:1::1:17", clickable=True),
+                                                   timeout, "Nombre del archivo de exportación")
+            self._llenar(campo_nombre, contexto['nombre_archivo'])
+            self.driver.find_element(By.ID, "M1:48::btn[20]").click()
+            self.logger.info(f"Nombre '{contexto['nombre_archivo']}' enviado y botón Generar presionado.")
         except Exception as e:
-            msg = f"ERROR EN PASO '{descripcion}': {str(e)}"
-            self.logger.error(msg)
-            raise Exception(msg)
+            self.logger.warning(f"No se pudo completar el llenado del nombre/generación automática: {e}")
+            return
+
+        # Confirmar descarga si aparece el diálogo de SAP
+        try:
+            self._esperar_condicion(EC.element_to_be_clickable((By.ID, "UpDownDialogChoose")),
+                                    min(timeout, 5), "Diálogo de descarga").click()
+        except TimeoutException:
+            pass
+
+    def _paso_descarga(self, timeout: float, contexto: dict) -> Optional[Path]:
+        return self.esperar_descarga(timeout=timeout)
 
     def descargar_reporte_sap(self, numero_pago: int) -> Optional[Path]:
         """
-        Ejecuta el proceso completo de descarga desde SAP
+        Ejecuta el proceso completo de descarga desde SAP como una máquina de estados:
+        login -> transacción -> formulario -> resultados -> exportación -> descarga.
+        Cada paso avanza en cuanto la pantalla siguiente está lista (elemento presente y
+        sin indicador de "ocupado"), con su propio timeout (Config.TIMEOUTS_PASOS_SAP).
+        La duración de cada paso queda en self.tiempos_pasos y en el log.
+        El archivo se descarga en una carpeta temporal propia de la sesión; quien lo
+        mueva (mover_y_renombrar_descarga) elimina esa carpeta.
         """
+        self.tiempos_pasos = {}
+        self.comandos_pasos = {}
+        archivo = None
         try:
             self.numero_pago_actual = numero_pago
+            self.crear_carpeta_sesion(numero_pago)
             self.driver = self.configurar_chrome()  # si falla, se propaga (no se silencia)
-            wait = WebDriverWait(self.driver, Config.TIMEOUT_SAP)
-            
+
             # 1. Acceder a SAP
-            self.logger.info("Accediendo a la URL de SAP...")
-            try:
-                self.driver.get(Config.SAP_URL)
-                self.driver.set_window_size(1137, 694)
-            except Exception as e:
-                self.logger.error(f"Fallo al cargar la URL de SAP: {e}")
+            if not self.abrir_sap():
                 return None
-            
-            # 2. Login
-            self.logger.info("Esperando pantalla de login...")
-            self._esperar_y_hacer(wait, By.ID, "sap-user", "presence", Config.SAP_USER, "Campo Usuario")
-            self._esperar_y_hacer(wait, By.ID, "sap-password", "presence", Config.SAP_PASSWORD, "Campo Contraseña")
-            self.driver.find_element(By.ID, "sap-password").send_keys(Keys.ENTER)
-            
-            time.sleep(3)
-            
-            # 3. Navegar a transacción
-            self.logger.info(f"Navegando a transacción {Config.SAP_TRANSACCION}...")
-            toolbar = self._esperar_y_hacer(wait, By.ID, "ToolbarOkCode", "presence", descripcion="Barra de transacciones (ToolbarOkCode)")
-            toolbar.send_keys(Config.SAP_TRANSACCION)
-            toolbar.send_keys(Keys.ENTER)
-            
-            time.sleep(2)
-            
-            # 4. Completar campos
-            self.logger.info(f"Completando formulario de {Config.SAP_TRANSACCION}...")
-            
-            # Campo 1: Cuenta
-            self._esperar_y_hacer(wait, By.ID, "M0:46:::1:34", "presence", Config.SAP_CUENTA, "Campo Cuenta de Mayor")
-            
-            # Campo 2: Sociedad
-            self._esperar_y_hacer(wait, By.ID, "M0:46:::2:34", "presence", Config.SAP_SOCIEDAD, "Campo Sociedad")
-            
-            # 5. Ejecutar
-            self.logger.info("Ejecutando la consulta (botón F8)...")
-            self.driver.execute_script("window.scrollTo(0,0)")
-            ejecutar_btn = self._esperar_y_hacer(wait, By.ID, "M0:50::btn[8]", "clickable", descripcion="Botón Ejecutar (F8)")
-            ejecutar_btn.click()
-            
-            # Nombre del archivo dinámico para usar en las instrucciones
-            nombre_archivo = f"pago {getattr(self, 'numero_pago_actual', 1)}"
-
-            # ESPERA 1: Carga de la tabla inicial
-            self.logger.info("Esperando carga de la tabla de resultados (15s)...")
-            time.sleep(15)
-
-            # Paso 1: Enviar Mayus + F4 para abrir la ventana de exportación
-            self.logger.info("Enviando Mayus + F4 para abrir la ventana de exportación...")
-            try:
-                cuerpo = self.driver.find_element(By.TAG_NAME, "body")
-                cuerpo.click()
-                time.sleep(2)
-                cuerpo.send_keys(Keys.SHIFT + Keys.F4)
-                self.logger.info("Atajo Mayus + F4 enviado.")
-            except Exception as e:
-                self.logger.warning(f"No se pudo enviar Mayus+F4 automáticamente: {e}")
-
-            # Paso 2: Rellenar el nombre del archivo y generar
-            self.logger.info("Intentando rellenar el nombre del archivo y generar reporte...")
-            try:
-                campo_nombre = WebDriverWait(self.driver, 20).until(
-                    EC.element_to_be_clickable((By.ID, "M1:46:1::1:17"))
-                )
-                campo_nombre.clear()
-                campo_nombre.send_keys(nombre_archivo)
 
-                generar_btn = self.driver.find_element(By.ID, "M1:48::btn[20]")
-                generar_btn.click()
-                self.logger.info(f"Nombre '{nombre_archivo}' enviado y botón Generar presionado.")
-            except Exception as e:
-                self.logger.warning(f"No se pudo completar el llenado del nombre/generación automática: {e}")
-            
-            # Confirmar descarga si aparece el diálogo de SAP
-            try:
-                confirmar_btn = WebDriverWait(self.driver, 5).until(
-                    EC.element_to_be_clickable((By.ID, "UpDownDialogChoose"))
-                )
-                confirmar_btn.click()
-            except:
-                pass
-            
-            # 7. Esperar descarga
-            archivo = self.esperar_descarga(patron_alternativo=f"{nombre_archivo}*")
+            # 2. Recorrer los pasos; el nombre del archivo se usa también en las instrucciones
+            archivo = self.ejecutar_pasos(self.PASOS_DESCARGA, {'nombre_archivo': f"pago {numero_pago}"})
             return archivo
         
         except Exception as e:
@@ -504,16 +680,215 @@ class DescargadorSAP:
                     self.driver.quit()
                 except:
                     pass
+            if archivo is None:
+                self.limpiar_carpeta_sesion(self.download_path)
+
+    def abrir_sap(self) -> bool:
+        """Carga la URL de SAP en el navegador ya iniciado"""
+        self.logger.info("Accediendo a la URL de SAP...")
+        try:
+            self.driver.get(Config.SAP_URL)
+            self.driver.set_window_size(1137, 694)
+            return True
+        except Exception as e:
+            self.logger.error(f"Fallo al cargar la URL de SAP: {e}")
+            return False
+
+    def ejecutar_pasos(self, pasos, contexto: dict) -> Optional[Path]:
+        """
+        Ejecuta los pasos indicados en orden, midiendo cada uno en self.tiempos_pasos
+        y sus comandos enviados al navegador en self.comandos_pasos.
+        Retorna lo que devuelva el último (el archivo, si es el paso de descarga).
+        """
+        self.tiempos_pasos = {}
+        self.comandos_pasos = {}
+        self._contar_comandos()
+        resultado = None
+        for paso in pasos:
+            timeout = Config.TIMEOUTS_PASOS_SAP.get(paso, Config.TIMEOUT_SAP)
+            self.logger.info(f"[SAP] Paso '{paso}' (timeout {timeout}s)...")
+            inicio = time.perf_counter()
+            comandos = self.comandos_webdriver
+            try:
+                resultado = getattr(self, f"_paso_{paso}")(timeout, contexto)
+            except TimeoutException as e:
+                msg = f"ERROR DE TIEMPO en el paso '{paso}' de SAP: {e.msg}"
+                self.logger.error(msg)
+                raise Exception(msg)
+            finally:
+                self.tiempos_pasos[paso] = time.perf_counter() - inicio
+                self.comandos_pasos[paso] = self.comandos_webdriver - comandos
+                self.logger.info(f"[SAP] Paso '{paso}': {self.tiempos_pasos[paso]:.1f}s, "
+                                 f"{self.comandos_pasos[paso]} comandos WebDriver")
+
+        resumen = ", ".join(f"{paso} {seg:.1f}s" for paso, seg in self.tiempos_pasos.items())
+        self.logger.info(f"[SAP] Tiempos por paso: {resumen} (total {sum(self.tiempos_pasos.values()):.1f}s, "
+                         f"{sum(self.comandos_pasos.values())} comandos WebDriver)")
+        return resultado
+
+    def dirigir_descargas(self, carpeta: Path) -> bool:
+        """Cambia la carpeta de descarga del navegador ya abierto (CDP de Chrome)"""
+        self.download_path = carpeta
+        try:
+            self.driver.execute_cdp_cmd("Browser.setDownloadBehavior",
+                                        {"behavior": "allow", "downloadPath": str(carpeta)})
+            return True
+        except Exception as e:
+            self.logger.warning(f"No se pudo cambiar la carpeta de descarga del navegador: {e}")
+            return False
+
+
+class SesionSAP:
+    """
+    Sesión de SAP reutilizable: un único navegador autenticado para varias exportaciones.
+
+        with SesionSAP() as sesion:
+            archivos = sesion.descargar_reportes([12, 13])
+
+    Antes de cada exportación se comprueba la sesión: si el navegador ya no responde
+    se reinicia, y si SAP volvió a la pantalla de login (sesión expirada) se vuelve a
+    autenticar. Una exportación que falla se reintenta con un navegador nuevo.
+    """
+
+    # Pasos de una exportación con la sesión ya autenticada
+    PASOS_EXPORTACION = DescargadorSAP.PASOS_DESCARGA[1:]
+
+    def __init__(self, descargador: Optional[DescargadorSAP] = None, reintentos: int = 1):
+        self.descargador = descargador or DescargadorSAP()
+        self.reintentos = reintentos
+        self.logger = logging.getLogger(__name__)
+        self.inicios_sesion = 0
+        self.tiempos = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+        return False
+
+    @property
+    def driver(self):
+        return self.descargador.driver
+
+    def navegador_activo(self) -> bool:
+        """Comprobación de salud: el navegador responde a una orden trivial"""
+        if self.driver is None:
+            return False
+        try:
+            return self.driver.execute_script("return 1") == 1
+        except WebDriverException:
+            return False
+
+    def requiere_login(self) -> bool:
+        """SAP muestra la pantalla de login (sesión nueva o expirada)"""
+        return bool(self.driver.find_elements(By.ID, "sap-user"))
+
+    def abrir(self) -> None:
+        """Inicia el navegador y carga SAP; el login se hace en asegurar_sesion"""
+        self.cerrar()
+        self.descargador.driver = self.descargador.configurar_chrome()
+        if not self.descargador.abrir_sap():
+            raise Exception("No se pudo cargar la URL de SAP")
+
+    def asegurar_sesion(self) -> None:
+        """Deja el navegador abierto y autenticado"""
+        if not self.navegador_activo():
+            self.logger.info("[SAP] Iniciando navegador para la sesión...")
+            self.abrir()
+        if self.requiere_login():
+            self.logger.info("[SAP] Iniciando sesión en SAP...")
+            self.descargador.ejecutar_pasos(("login",), {})
+            self.inicios_sesion += 1
+
+    def descargar_reporte(self, numero_pago: int) -> Optional[Path]:
+        """Exporta el reporte de un pago con la sesión abierta (reintentando si falla)"""
+        for intento in range(self.reintentos + 1):
+            carpeta = self.descargador.crear_carpeta_sesion(numero_pago)
+            try:
+                self.asegurar_sesion()
+                self.descargador.dirigir_descargas(carpeta)
+                contexto = {'nombre_archivo': f"pago {numero_pago}", 'nueva_transaccion': True}
+                archivo = self.descargador.ejecutar_pasos(self.PASOS_EXPORTACION, contexto)
+                self.tiempos[numero_pago] = dict(self.descargador.tiempos_pasos)
+                if archivo is None:
+                    DescargadorSAP.limpiar_carpeta_sesion(carpeta)
+                return archivo
+            except Exception as e:
+                DescargadorSAP.limpiar_carpeta_sesion(carpeta)
+                if intento >= self.reintentos:
+                    self.logger.error(f"FALLO EN LA EXPORTACIÓN DEL PAGO {numero_pago}: {e}")
+                    raise
+                self.logger.warning(f"Exportación del pago {numero_pago} falló ({e}); reintentando con un navegador nuevo...")
+                self.cerrar()
+
+    def descargar_reportes(self, numeros_pago: List[int]) -> dict:
+        """
+        Exporta varios pagos con un solo navegador y un solo login.
+        Retorna {numero_pago: archivo o None}; un pago que falla no detiene los demás.
+        """
+        archivos = {}
+        for numero_pago in numeros_pago:
+            try:
+                archivos[numero_pago] = self.descargar_reporte(numero_pago)
+            except Exception:
+                archivos[numero_pago] = None
+        descargados = sum(archivo is not None for archivo in archivos.values())
+        self.logger.info(f"[SAP] {descargados}/{len(archivos)} reportes descargados con "
+                         f"{self.inicios_sesion} inicio(s) de sesión.")
+        return archivos
+
+    def cerrar(self) -> None:
+        if self.descargador.driver is not None:
+            try:
+                self.descargador.driver.quit()
+            except Exception:
+                pass
+            self.descargador.driver = None
 
 # ============================================================================
 # FASE 3: PROCESAMIENTO DE EXCEL
 # ============================================================================
 
+# Textos que pd.read_excel interpreta como vacío (incluye los errores de fórmula de Excel)
+_VALORES_NULOS_EXCEL = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+    "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#NULL!",
+})
+
+# Columnas con fila de TOTALES y anchos de columna de la hoja 'Validación'
+_COLUMNAS_TOTALES_VALIDACION = [
+    "Gross", "Fee", "Net",
+    "Prorrateo Disputa", "Prorrateo Normal", "Neto despues de prorrateo",
+    "Flete", "Valor mcia"
+]
+_ANCHOS_VALIDACION = {
+    "Observaciones": 44,
+    "Date": 15,
+    "Fecha del envío": 18,
+    "Prorrateo Disputa": 20,
+    "Prorrateo Normal": 20,
+    "Neto despues de prorrateo": 20,
+    "Fecha_pago": 15,
+    "Order Id Paypal": 20,
+    "Valoración flete": 20,
+    "Diferencia": 15,
+    "Número guía": 20,
+    "Invoice Numbers": 18
+}
+_COLOR_CABECERA_VALIDACION = '69E2FF'
+
+
 class ProcesadorExcel:
     """Procesa archivos Excel y realiza transformaciones"""
     
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        # Huellas del periodo construido, pendientes de marcar como procesadas al guardar
+        self._huellas_pendientes = None
+        # (archivo, hoja 'Validación') del Excel del pago que reemplazó una nueva descarga
+        self._validacion_reemplazada = None
     
     def buscar_archivo_pago_en_descargas(self, numero_pago: int) -> Optional[Path]:
         """
@@ -564,10 +939,19 @@ class ProcesadorExcel:
             fecha = datetime.now().strftime("%Y%m%d")
             nuevo_nombre = f"EXPORT_{fecha}_Pago#{numero_pago}.xlsx"
             ruta_destino = carpeta_destino / nuevo_nombre
+
+            # Si el pago ya se procesó hoy, su hoja 'Validación' se guarda para reconstruirla por incremento
+            if ruta_destino.exists():
+                df_anterior = self.leer_validacion_existente(ruta_destino)
+                if df_anterior is not None:
+                    self._validacion_reemplazada = (ruta_destino, df_anterior)
             
             # Mover archivo
             self.logger.info(f"Moviendo archivo de {archivo_descarga.name} a {ruta_destino}")
             shutil.move(str(archivo_descarga), str(ruta_destino))
+
+            # La carpeta temporal de la sesión SAP ya no hace falta
+            DescargadorSAP.limpiar_carpeta_sesion(archivo_descarga.parent)
             
             return ruta_destino
         
@@ -576,86 +960,257 @@ class ProcesadorExcel:
             raise
     
     def reorganizar_columnas_primera_hoja(self, archivo: Path):
-        """Mueve la columna 'Referencia' a la primera posición"""
+        """
+        Mueve la columna 'Referencia' a la primera posición.
+
+        Solo se lee la cabecera (read_only); después el XML de la hoja se reescribe en
+        streaming (ver paquete_excel.reordenar_columnas), por lo que la memoria no depende
+        del número de filas. Anchos, formatos y estilos de celda acompañan a su columna
+        y las demás hojas se copian sin cambios.
+        """
         try:
             self.logger.info(f"Reorganizando columnas en {archivo.name}...")
-            # Cargar con openpyxl para mantener formato
-            wb = load_workbook(archivo)
-            ws = wb.active
-            
-            # Encontrar columna "Referencia"
-            headers = [cell.value for cell in ws[1]]
-            
+            wb_origen = load_workbook(archivo, read_only=True)
+            try:
+                ws_origen = wb_origen.active
+                ws_origen.reset_dimensions()  # Las exportaciones SAP no siempre declaran bien su rango
+                nombre_hoja = ws_origen.title
+
+                # Encontrar columna "Referencia" en la cabecera
+                primera_fila = next(ws_origen.iter_rows(min_row=1, max_row=1, values_only=True), ())
+                headers = list(primera_fila)
+            finally:
+                wb_origen.close()
+
             if "Referencia" not in headers:
                 self.logger.error(f"ERROR: No se encontró la columna 'Referencia' en el archivo {archivo.name}. Las columnas encontradas son: {headers}")
                 return
-            
-            idx_referencia = headers.index("Referencia") + 1  # openpyxl usa índices desde 1
-            
+
+            idx_referencia = headers.index("Referencia")
+
             # Si ya está en la primera posición, no hacer nada
-            if idx_referencia == 1:
+            if idx_referencia == 0:
                 self.logger.info("La columna 'Referencia' ya está en la primera posición.")
                 return
-            
-            # Insertar nueva columna al inicio
-            ws.insert_cols(1)
-            
-            # Copiar datos de la columna Referencia
-            for row in range(1, ws.max_row + 1):
-                valor = ws.cell(row, idx_referencia + 1).value  # +1 por la inserción
-                ws.cell(row, 1).value = valor
-            
-            # Eliminar la columna antigua
-            ws.delete_cols(idx_referencia + 1)
-            
-            wb.save(archivo)
+
+            orden = [idx_referencia + 1] + [i + 1 for i in range(len(headers)) if i != idx_referencia]
+            reordenar_columnas(archivo, nombre_hoja, orden)
             self.logger.info("Columna 'Referencia' movida a la primera posición correctamente.")
         
         except Exception as e:
             self.logger.error(f"ERROR AL REORGANIZAR COLUMNAS EN EXCEL: {str(e)}")
             raise
     
+    def leer_maestro(self, archivo_maestro: Path, nombre_hoja: str = Config.HOJA_MAESTRO,
+                     usar_cache: bool = True) -> pd.DataFrame:
+        """
+        Lee la hoja del maestro. Si hay una instantánea en caché vigente para el
+        archivo (misma ruta, tamaño, fecha de modificación y hoja) se usa esa;
+        si no, se parsea el Excel y se guarda la instantánea para la próxima vez.
+        Solo se cargan las columnas que usa la segunda hoja. El parseo lee el espejo
+        local del maestro (ver EspejoMaestro) en lugar del archivo de red; si no se pudo
+        renovar y se leyó el espejo anterior, la instantánea no se guarda.
+        """
+        cache = CacheMaestro() if usar_cache and Config.USAR_CACHE_MAESTRO else None
+        variante = "proyeccion:" + ",".join(sorted(self._columnas_maestro_requeridas()))
+        if cache:
+            df_cache = cache.obtener(archivo_maestro, nombre_hoja, variante)
+            if df_cache is not None:
+                return df_cache
+
+        # Firma tomada antes de leer: si el maestro cambia durante la lectura, la próxima la descarta
+        firma = cache.firma(archivo_maestro, nombre_hoja, variante) if cache else None
+        espejo = EspejoMaestro() if Config.USAR_ESPEJO_MAESTRO else None
+        origen = espejo.sincronizar(archivo_maestro) if espejo else archivo_maestro
+
+        try:
+            df_maestro = self._leer_hoja_maestro_proyectada(origen, nombre_hoja, cache, archivo_maestro)
+            self.logger.info(f"Hoja '{nombre_hoja}' leída correctamente.")
+        except Exception as e:
+            self.logger.error(f"ERROR: No se pudo leer la hoja '{nombre_hoja}' en el archivo maestro: {e}")
+            self.logger.info("Intentando listar hojas disponibles...")
+            xl = pd.ExcelFile(origen)
+            self.logger.info(f"Hojas encontradas: {xl.sheet_names}")
+            raise
+
+        # Un espejo anterior no corresponde a la firma actual: no se guarda la instantánea
+        if cache and not (espejo and espejo.desactualizado):
+            cache.guardar(archivo_maestro, nombre_hoja, df_maestro, variante, firma)
+        return df_maestro
+
+    @staticmethod
+    def _columnas_maestro_requeridas() -> set:
+        """Nombres (en minúsculas) de las columnas del maestro que usa la segunda hoja, con sus alias"""
+        requeridas = {col.lower() for col in Config.COLUMNAS_SEGUNDA_HOJA}
+        for nombre, alias in Config.ALIAS_COLUMNAS_MAESTRO.items():
+            if nombre in requeridas:
+                requeridas.update(alias)
+        return requeridas
+
+    @staticmethod
+    def _resolver_columnas_maestro(encabezado) -> dict:
+        """
+        {nombre en minúsculas: índice (base 0)} de las columnas del encabezado del maestro.
+        Los alias de Config.ALIAS_COLUMNAS_MAESTRO se registran con su nombre principal;
+        ante nombres repetidos gana la primera columna.
+        """
+        principales = {alias: nombre for nombre, variantes in Config.ALIAS_COLUMNAS_MAESTRO.items()
+                       for alias in variantes}
+        columnas = {}
+        for idx, valor in enumerate(encabezado):
+            if valor is None:
+                continue
+            nombre = str(valor).strip().lower()
+            columnas.setdefault(principales.get(nombre, nombre), idx)
+        return columnas
+
+    @staticmethod
+    def _valor_celda_maestro(valor):
+        """Normaliza un valor de celda igual que pd.read_excel(dtype=object)"""
+        if isinstance(valor, str):
+            return None if valor in _VALORES_NULOS_EXCEL else valor
+        if isinstance(valor, float) and valor.is_integer():
+            return int(valor)
+        return valor
+
+    @staticmethod
+    def _firma_encabezado(fila) -> list:
+        """Nombres normalizados (sin espacios, en minúsculas) de una fila candidata a encabezado"""
+        return [str(valor).strip().lower() if valor is not None else "" for valor in fila]
+
+    def _detectar_fila_encabezado(self, primeras: list, requeridas: set, archivo_maestro: Path,
+                                  nombre_hoja: str, cache: Optional[CacheMaestro] = None) -> int:
+        """
+        Retorna el índice (base 0) de la fila de encabezado entre las primeras filas.
+
+        Si la caché recuerda una fila cuya firma sigue coincidiendo, se usa directamente.
+        Si no, cada fila se puntúa por cuántas columnas esperadas contiene y gana la mejor
+        (la primera en caso de empate).
+        """
+        if not primeras:
+            return 0
+
+        if cache:
+            recordado = cache.obtener_encabezado(archivo_maestro, nombre_hoja)
+            if recordado and recordado.get('fila', -1) < len(primeras):
+                fila = recordado['fila']
+                if self._firma_encabezado(primeras[fila]) == recordado.get('columnas'):
+                    return fila
+
+        puntajes = [len(set(self._firma_encabezado(fila)) & requeridas) for fila in primeras]
+        fila = max(range(len(puntajes)), key=lambda i: (puntajes[i], -i))
+        if puntajes[fila] == 0:
+            self.logger.warning("No se reconoció ninguna columna esperada en las primeras filas del maestro.")
+            return 0
+
+        if fila > 0:
+            self.logger.info(f"Encabezado del maestro detectado en la fila {fila + 1} ({puntajes[fila]} columnas esperadas).")
+        if cache:
+            cache.guardar_encabezado(archivo_maestro, nombre_hoja, fila, self._firma_encabezado(primeras[fila]))
+        return fila
+
+    def _leer_hoja_maestro_proyectada(self, archivo_maestro: Path, nombre_hoja: str,
+                                      cache: Optional[CacheMaestro] = None,
+                                      ruta_original: Optional[Path] = None) -> pd.DataFrame:
+        """
+        Lee en streaming (read_only) solo las columnas requeridas de la hoja del maestro.
+        `archivo_maestro` puede ser el espejo local; `ruta_original` identifica el maestro en la caché.
+        La fila de encabezado se detecta mirando las primeras filas del mismo recorrido,
+        de modo que la hoja se lee una única vez. Las columnas se resuelven una sola vez
+        desde el encabezado, sin distinguir mayúsculas; se conservan los nombres del maestro.
+        """
+        requeridas = self._columnas_maestro_requeridas()
+        wb = load_workbook(archivo_maestro, read_only=True, data_only=True, keep_links=False)
+        try:
+            ws = wb[nombre_hoja]
+            ws.reset_dimensions()
+            filas = ws.iter_rows(values_only=True)
+
+            # Primeras filas en memoria para ubicar el encabezado; el resto sigue en streaming
+            primeras = list(itertools.islice(filas, Config.FILAS_BUSQUEDA_ENCABEZADO))
+            fila_encabezado = self._detectar_fila_encabezado(
+                primeras, requeridas, ruta_original or archivo_maestro, nombre_hoja, cache
+            )
+            encabezado = list(primeras[fila_encabezado]) if primeras else []
+            filas = itertools.chain(primeras[fila_encabezado + 1:], filas)
+
+            indices, nombres, vistos = [], [], set()
+            for idx, valor in enumerate(encabezado):
+                if valor is None:
+                    continue
+                nombre = str(valor).strip()
+                if nombre.lower() in requeridas and nombre.lower() not in vistos:
+                    vistos.add(nombre.lower())
+                    indices.append(idx)
+                    nombres.append(nombre)
+
+            self.logger.info(f"Columnas proyectadas del maestro: {len(nombres)} de {len(encabezado)}")
+
+            datos = []
+            for fila in filas:
+                valores = [self._valor_celda_maestro(fila[i]) if i < len(fila) else None for i in indices]
+                if any(v is not None for v in valores):
+                    datos.append(valores)
+
+            return pd.DataFrame(datos, columns=nombres, dtype=object)
+        finally:
+            wb.close()
+
+    @staticmethod
+    def _es_vacio(serie: pd.Series) -> pd.Series:
+        """Máscara de valores nulos o en blanco"""
+        return serie.isna() | (serie.astype(str).str.strip() == "")
+
+    def _rellenar_por_factura(self, df: pd.DataFrame, col_invoice: str, columnas: List[str]) -> None:
+        """
+        Completa en sitio los valores vacíos de `columnas` con el primer valor no vacío
+        del mismo grupo de 'Invoice Numbers' (groupby + transform 'first').
+        Las filas sin factura no se tocan.
+        """
+        claves = df[col_invoice]
+        con_factura = ~self._es_vacio(claves)
+
+        for col in columnas:
+            if col not in df.columns:
+                continue
+            vacio = self._es_vacio(df[col])
+            primero = df[col].where(~vacio).groupby(claves, sort=False).transform('first')
+            a_llenar = con_factura & vacio & primero.notna()
+            if a_llenar.any():
+                df.loc[a_llenar, col] = primero[a_llenar]
+
+    def _deduplicar_valor_mcia(self, df: pd.DataFrame, col_invoice: str) -> None:
+        """
+        En pagos divididos (varias filas con el mismo 'Invoice Numbers') deja 'Valor mcia'
+        solo en la primera fila con valor distinto de cero y pone 0 en las demás.
+        La posición del valor no cero dentro de su grupo se obtiene con un cumsum por grupo.
+        """
+        df["Valor mcia"] = pd.to_numeric(df["Valor mcia"], errors="coerce")
+
+        claves = df[col_invoice]
+        con_factura = ~self._es_vacio(claves)
+        no_cero = df["Valor mcia"].fillna(0) != 0
+
+        grupos = no_cero.groupby(claves, sort=False)
+        rango = grupos.cumsum()
+        grupo_con_valor = grupos.transform('any').fillna(False).astype(bool)
+
+        a_cero = con_factura & grupo_con_valor & ~(no_cero & (rango == 1))
+        df.loc[a_cero, "Valor mcia"] = 0
+
     def crear_segunda_hoja(self, archivo_principal: Path, 
                           archivo_maestro: Path,
                           mes_filtro: int = None,
                           año_filtro: int = None) -> pd.DataFrame:
         """
         Crea la segunda hoja filtrando datos del maestro por el mes y año proporcionados.
-        Si no se proporcionan, usa el mes y año actual.
+        Si no se proporcionan, usa el mes y año actual. Si el pago ya se procesó, solo se
+        reconstruyen las facturas que cambiaron (ver actualizar_segunda_hoja_incremental).
         """
         try:
-            # Leer archivo maestro
-            self.logger.info(f"Leyendo archivo maestro: {archivo_maestro}")
-            if not archivo_maestro.exists():
-                raise FileNotFoundError(f"No se encontró el archivo maestro en: {archivo_maestro}")
-
-            # 1. Identificar la hoja correcta
+            # 1-2. Leer el maestro y normalizar columnas
             nombre_hoja = Config.HOJA_MAESTRO
-            try:
-                # Leer con dtype=object para preservar tipos originales de Excel y evitar conversiones automáticas
-                df_maestro = pd.read_excel(archivo_maestro, sheet_name=nombre_hoja, engine='openpyxl', dtype=object)
-                
-                # Si las primeras columnas son 'Unnamed', es muy probable que el encabezado esté más abajo
-                if any('Unnamed' in str(col) for col in df_maestro.columns[:3]):
-                    self.logger.info("Detectados encabezados 'Unnamed'. Reintentando lectura desde la fila 2...")
-                    df_maestro = pd.read_excel(archivo_maestro, sheet_name=nombre_hoja, engine='openpyxl', header=1, dtype=object)
-                
-                # Si la primera columna sigue siendo Unnamed (columna A vacía), la eliminamos
-                if 'Unnamed: 0' in df_maestro.columns:
-                    self.logger.info("Eliminando primera columna vacía (Columna A)...")
-                    df_maestro = df_maestro.drop(columns=['Unnamed: 0'])
-
-                self.logger.info(f"Hoja '{nombre_hoja}' leída correctamente.")
-            except Exception as e:
-                self.logger.error(f"ERROR: No se pudo leer la hoja '{nombre_hoja}' en el archivo maestro: {e}")
-                self.logger.info("Intentando listar hojas disponibles...")
-                xl = pd.ExcelFile(archivo_maestro)
-                self.logger.info(f"Hojas encontradas: {xl.sheet_names}")
-                raise
-
-            # 2. Normalizar nombres de columnas (quitar espacios y poner en minúsculas para búsqueda flexible)
-            df_maestro.columns = [str(col).strip() for col in df_maestro.columns]
-            columnas_normalizadas = {col.lower(): col for col in df_maestro.columns}
+            df_maestro = self.preparar_maestro(archivo_maestro, nombre_hoja)
             
             # Obtener mes y año para el filtro
             mes_actual = mes_filtro if mes_filtro is not None else datetime.now().month
@@ -664,21 +1219,6 @@ class ProcesadorExcel:
             # 3. Filtrar por Fecha_pago del mes solicitado
             COL_FECHA_PAGO = 'Fecha_pago'
 
-            if COL_FECHA_PAGO not in df_maestro.columns:
-                # La columna no existe en absoluto — error estructural del maestro
-                self.logger.error(
-                    f"ERROR CRÍTICO: La columna '{COL_FECHA_PAGO}' no existe en la hoja "
-                    f"'{nombre_hoja}' del archivo maestro.\n"
-                    f"Columnas disponibles: {list(df_maestro.columns)}"
-                )
-                raise ValueError(
-                    f"No se encontró la columna '{COL_FECHA_PAGO}' en el maestro. "
-                    f"Verifique que el archivo sea el correcto."
-                )
-
-            self.logger.info(f"Columna de fecha identificada como: '{COL_FECHA_PAGO}'")
-            df_maestro[COL_FECHA_PAGO] = pd.to_datetime(df_maestro[COL_FECHA_PAGO], errors='coerce')
-
             # Contar cuántos valores no-nulos tiene Fecha_pago en total
             total_con_fecha = df_maestro[COL_FECHA_PAGO].notna().sum()
             self.logger.info(f"Registros con '{COL_FECHA_PAGO}' llenada en el maestro: {total_con_fecha} / {len(df_maestro)}")
@@ -706,7 +1246,7 @@ class ProcesadorExcel:
             df_filtrado = df_maestro[
                 (df_maestro[COL_FECHA_PAGO].dt.month == mes_actual) &
                 (df_maestro[COL_FECHA_PAGO].dt.year == año_actual)
-            ].copy()
+            ]
 
             self.logger.info(f"Registros encontrados para el mes {mes_actual:02d}/{año_actual}: {len(df_filtrado)}")
 
@@ -738,181 +1278,448 @@ class ProcesadorExcel:
                     f"No hay registros con '{COL_FECHA_PAGO}' en {mes_actual:02d}/{año_actual}. "
                     f"Llene las fechas o seleccione el mes correcto y vuelva a ejecutar."
                 )
-            
-            df_final = pd.DataFrame(columns=Config.COLUMNAS_SEGUNDA_HOJA)
-            
-            for col_requerida in Config.COLUMNAS_SEGUNDA_HOJA:
-                col_requerida_lower = col_requerida.lower()
-                
-                # Búsqueda flexible para columnas específicas
-                if col_requerida_lower == "neto despues de prorrateo":
-                    # Intentar con y sin coma
-                    for posible in ["neto despues de prorrateo", "neto, despues de prorrateo"]:
-                        if posible in columnas_normalizadas:
-                            col_maestro = columnas_normalizadas[posible]
-                            serie_datos = df_filtrado[col_maestro]
-                            # Asegurar que sea Serie incluso si hay duplicados
-                            if isinstance(serie_datos, pd.DataFrame):
-                                serie_datos = serie_datos.iloc[:, 0]
-                            df_final[col_requerida] = serie_datos.values
-                            break
-                elif col_requerida_lower in columnas_normalizadas:
-                    col_maestro = columnas_normalizadas[col_requerida_lower]
-                    serie_datos = df_filtrado[col_maestro]
-                    if isinstance(serie_datos, pd.DataFrame):
-                        serie_datos = serie_datos.iloc[:, 0]
-                    df_final[col_requerida] = serie_datos.values
-                else:
-                    df_final[col_requerida] = None
 
-            col_invoice = "Invoice Numbers"
-            columnas_a_llenar = ["Order Id Paypal", "Número guía", "Gross", "Fee", "Flete", "Valor mcia"]
-
-            if col_invoice in df_final.columns:
-                for invoice_val, grupo in df_final.groupby(col_invoice):
-                    if pd.isna(invoice_val) or str(invoice_val).strip() == "":
-                        continue
-                    for col in columnas_a_llenar:
-                        if col not in df_final.columns:
-                            continue
-                        serie_fuente = grupo[col]
-                        serie_fuente = serie_fuente[serie_fuente.notna()]
-                        serie_fuente = serie_fuente[serie_fuente.astype(str).str.strip() != ""]
-                        if serie_fuente.empty:
-                            continue
-                        valor = serie_fuente.iloc[0]
-                        mask_faltante = (df_final[col_invoice] == invoice_val) & (
-                            df_final[col].isna() | (df_final[col].astype(str).str.strip() == "")
-                        )
-                        df_final.loc[mask_faltante, col] = valor
-
-            # Evitar duplicar "Valor mcia" cuando hay pagos divididos (mismo Invoice Numbers)
-            if "Valor mcia" in df_final.columns and col_invoice in df_final.columns:
-                df_final["Valor mcia"] = pd.to_numeric(df_final["Valor mcia"], errors="coerce")
-                for invoice_val, grupo in df_final.groupby(col_invoice):
-                    if pd.isna(invoice_val) or str(invoice_val).strip() == "":
-                        continue
-                    idxs = grupo.index.tolist()
-                    if len(idxs) <= 1:
-                        continue
-                    vals = df_final.loc[idxs, "Valor mcia"].fillna(0)
-                    nz = vals[vals != 0]
-                    if nz.empty:
-                        continue
-                    keep_idx = nz.index[0]
-                    to_zero = [i for i in idxs if i != keep_idx]
-                    df_final.loc[to_zero, "Valor mcia"] = 0
-
-            # 5. Formatear columnas de fecha y IDs, y detectar "Próximo pago"
-            columnas_fecha = ["Date", "Fecha del envío", "Fecha_pago"]
-            for col in columnas_fecha:
-                if col in df_final.columns:
-                    def _formatear_fecha_segura(val):
-                        if pd.isna(val) or str(val).strip() == "":
-                            return ""
-                        try:
-                            if isinstance(val, (pd.Timestamp, datetime)):
-                                return val.strftime('%d/%m/%Y')
-                            
-                            dt = pd.to_datetime(val, dayfirst=True, errors='coerce')
-                            if pd.notna(dt):
-                                return dt.strftime('%d/%m/%Y')
-                            
-                            return str(val).strip()
-                        except:
-                            return str(val).strip()
-
-                    df_final[col] = df_final[col].apply(_formatear_fecha_segura)
-            
-            # Detectar registros de "Próximo pago"
-            # Un registro es parcial si Net > 0 pero Gross y Fee están vacíos/nulos
-            if "Observaciones" in df_final.columns:
-                # Obtener nombres reales de columnas mapeadas para evitar problemas de mayúsculas
-                col_net = columnas_normalizadas.get('net')
-                col_gross = columnas_normalizadas.get('gross')
-                col_fee = columnas_normalizadas.get('fee')
-
-                def obtener_serie_segura(df, col_name):
-                    if col_name and col_name in df.columns:
-                        s = df[col_name]
-                        if isinstance(s, pd.DataFrame):
-                            s = s.iloc[:, 0]
-                        return pd.to_numeric(s, errors='coerce').fillna(0)
-                    return pd.Series(0, index=df.index)
-
-                net_vals = obtener_serie_segura(df_filtrado, col_net)
-                gross_vals = obtener_serie_segura(df_filtrado, col_gross)
-                fee_vals = obtener_serie_segura(df_filtrado, col_fee)
-                
-                # Máscara: Net > 0 Y Gross == 0 Y Fee == 0
-                es_parcial = (net_vals > 0) & (gross_vals == 0) & (fee_vals == 0)
-                
-                # Resetear índice para asegurar alineación con df_final
-                es_parcial_reset = es_parcial.reset_index(drop=True)
-                df_final.loc[es_parcial_reset, "Observaciones"] = "Proximo pago"
-                
-                conteo_parciales = es_parcial_reset.sum()
-                if conteo_parciales > 0:
-                    self.logger.info(f"Se detectaron {conteo_parciales} registros de 'Próximo pago' (parciales).")
-            
-            # Asegurar que IDs se manejen como string para evitar notación científica y pérdida de precisión
-            columnas_id = ["Order Id Paypal", "Invoice Numbers", "Número guía"]
-            
-            def clean_id(x):
-                if pd.isna(x) or str(x).strip().lower() in ["", "nan"]:
-                    return ""
-                # Si es float, intentar convertir a int para quitar .0
-                if isinstance(x, float):
-                    if x.is_integer():
-                        return str(int(x))
-                    return "{:.0f}".format(x) # Evitar notación científica
-                return str(x).strip()
-
-            for col_id in columnas_id:
-                if col_id in df_final.columns:
-                    df_final[col_id] = df_final[col_id].apply(clean_id)
-
-            return df_final
+            # Si el pago ya tiene una hoja 'Validación', solo se reconstruyen las facturas que cambiaron
+            return self.actualizar_segunda_hoja_incremental(
+                archivo_principal, archivo_maestro, df_filtrado, mes_actual, año_actual
+            )
         
         except Exception as e:
             self.logger.error(f"ERROR AL PROCESAR SEGUNDA HOJA DESDE MAESTRO: {str(e)}")
             raise
+
+    def crear_segundas_hojas(self, archivo_maestro: Path,
+                             periodos: List[Tuple[int, int]]) -> dict:
+        """
+        Backfill: crea la segunda hoja de varios meses leyendo el maestro una sola vez.
+
+        `periodos` es una lista de (mes, año). El maestro se parte por el periodo de
+        Fecha_pago y cada partición pasa por la misma construcción que crear_segunda_hoja.
+        Retorna {(mes, año): DataFrame}; los meses sin registros se omiten con una advertencia.
+        """
+        try:
+            df_maestro = self.preparar_maestro(archivo_maestro, Config.HOJA_MAESTRO)
+            particiones = self.particionar_por_periodo(df_maestro, periodos)
+            return {periodo: self._construir_segunda_hoja(df_filtrado)
+                    for periodo, df_filtrado in particiones.items()}
+
+        except Exception as e:
+            self.logger.error(f"ERROR EN EL BACKFILL DE SEGUNDAS HOJAS: {str(e)}")
+            raise
+
+    def particionar_por_periodo(self, df_maestro: pd.DataFrame,
+                                periodos: List[Tuple[int, int]]) -> dict:
+        """
+        Parte el maestro ya preparado por el periodo de Fecha_pago.
+        Retorna {(mes, año): filas del maestro}; los meses sin registros se omiten con una advertencia.
+        """
+        solicitados = {pd.Period(year=año, month=mes, freq='M'): (mes, año) for mes, año in periodos}
+        periodo_pago = df_maestro['Fecha_pago'].dt.to_period('M')
+        en_backfill = periodo_pago.isin(list(solicitados))
+
+        particiones = {}
+        for periodo, df_filtrado in df_maestro[en_backfill].groupby(periodo_pago[en_backfill], sort=True):
+            mes, año = solicitados[periodo]
+            self.logger.info(f"Backfill {mes:02d}/{año}: {len(df_filtrado)} registros en el maestro.")
+            particiones[(mes, año)] = df_filtrado
+
+        for mes, año in periodos:
+            if (mes, año) not in particiones:
+                self.logger.warning(f"Backfill {mes:02d}/{año}: no hay registros con 'Fecha_pago' en ese mes.")
+
+        return particiones
+
+    def preparar_maestro(self, archivo_maestro: Path, nombre_hoja: str = Config.HOJA_MAESTRO) -> pd.DataFrame:
+        """
+        Lee la hoja del maestro (desde la caché si el archivo no cambió), quita espacios
+        en los nombres de columna y convierte 'Fecha_pago' a fecha.
+        Lanza ValueError si la columna 'Fecha_pago' no existe.
+        """
+        # Leer archivo maestro
+        self.logger.info(f"Leyendo archivo maestro: {archivo_maestro}")
+        if not archivo_maestro.exists():
+            raise FileNotFoundError(f"No se encontró el archivo maestro en: {archivo_maestro}")
+
+        df_maestro = self.leer_maestro(archivo_maestro, nombre_hoja)
+
+        # Normalizar nombres de columnas (quitar espacios; la búsqueda posterior es en minúsculas)
+        df_maestro.columns = [str(col).strip() for col in df_maestro.columns]
+
+        COL_FECHA_PAGO = 'Fecha_pago'
+        if COL_FECHA_PAGO not in df_maestro.columns:
+            # La columna no existe en absoluto — error estructural del maestro
+            self.logger.error(
+                f"ERROR CRÍTICO: La columna '{COL_FECHA_PAGO}' no existe en la hoja "
+                f"'{nombre_hoja}' del archivo maestro.\n"
+                f"Columnas disponibles: {list(df_maestro.columns)}"
+            )
+            raise ValueError(
+                f"No se encontró la columna '{COL_FECHA_PAGO}' en el maestro. "
+                f"Verifique que el archivo sea el correcto."
+            )
+
+        self.logger.info(f"Columna de fecha identificada como: '{COL_FECHA_PAGO}'")
+        df_maestro[COL_FECHA_PAGO] = pd.to_datetime(df_maestro[COL_FECHA_PAGO], errors='coerce')
+        return df_maestro
+
+    def _construir_segunda_hoja(self, df_filtrado: pd.DataFrame) -> pd.DataFrame:
+        """
+        Construye la segunda hoja a partir de las filas del maestro de un periodo:
+        selecciona columnas, rellena y deduplica por factura, formatea fechas e IDs
+        y marca los registros de "Proximo pago".
+        """
+        columnas_normalizadas = {col.lower(): col for col in df_filtrado.columns}
+
+        df_final = pd.DataFrame(columns=Config.COLUMNAS_SEGUNDA_HOJA)
+        
+        for col_requerida in Config.COLUMNAS_SEGUNDA_HOJA:
+            col_requerida_lower = col_requerida.lower()
+            
+            # Búsqueda flexible para columnas específicas
+            if col_requerida_lower == "neto despues de prorrateo":
+                # Intentar con y sin coma
+                for posible in [col_requerida_lower] + Config.ALIAS_COLUMNAS_MAESTRO[col_requerida_lower]:
+                    if posible in columnas_normalizadas:
+                        col_maestro = columnas_normalizadas[posible]
+                        serie_datos = df_filtrado[col_maestro]
+                        # Asegurar que sea Serie incluso si hay duplicados
+                        if isinstance(serie_datos, pd.DataFrame):
+                            serie_datos = serie_datos.iloc[:, 0]
+                        df_final[col_requerida] = serie_datos.values
+                        break
+            elif col_requerida_lower in columnas_normalizadas:
+                col_maestro = columnas_normalizadas[col_requerida_lower]
+                serie_datos = df_filtrado[col_maestro]
+                if isinstance(serie_datos, pd.DataFrame):
+                    serie_datos = serie_datos.iloc[:, 0]
+                df_final[col_requerida] = serie_datos.values
+            else:
+                df_final[col_requerida] = None
+
+        col_invoice = "Invoice Numbers"
+        columnas_a_llenar = ["Order Id Paypal", "Número guía", "Gross", "Fee", "Flete", "Valor mcia"]
+
+        if col_invoice in df_final.columns:
+            self._rellenar_por_factura(df_final, col_invoice, columnas_a_llenar)
+
+        # Evitar duplicar "Valor mcia" cuando hay pagos divididos (mismo Invoice Numbers)
+        if "Valor mcia" in df_final.columns and col_invoice in df_final.columns:
+            self._deduplicar_valor_mcia(df_final, col_invoice)
+
+        # 5. Detectar "Próximo pago" y formatear IDs; las fechas se tipan al final
+        # Detectar registros de "Próximo pago"
+        # Un registro es parcial si Net > 0 pero Gross y Fee están vacíos/nulos
+        if "Observaciones" in df_final.columns:
+            # Obtener nombres reales de columnas mapeadas para evitar problemas de mayúsculas
+            col_net = columnas_normalizadas.get('net')
+            col_gross = columnas_normalizadas.get('gross')
+            col_fee = columnas_normalizadas.get('fee')
+
+            def obtener_serie_segura(df, col_name):
+                if col_name and col_name in df.columns:
+                    s = df[col_name]
+                    if isinstance(s, pd.DataFrame):
+                        s = s.iloc[:, 0]
+                    return pd.to_numeric(s, errors='coerce').fillna(0)
+                return pd.Series(0, index=df.index)
+
+            net_vals = obtener_serie_segura(df_filtrado, col_net)
+            gross_vals = obtener_serie_segura(df_filtrado, col_gross)
+            fee_vals = obtener_serie_segura(df_filtrado, col_fee)
+            
+            # Máscara: Net > 0 Y Gross == 0 Y Fee == 0
+            es_parcial = (net_vals > 0) & (gross_vals == 0) & (fee_vals == 0)
+            
+            # Resetear índice para asegurar alineación con df_final
+            es_parcial_reset = es_parcial.reset_index(drop=True)
+            df_final.loc[es_parcial_reset, "Observaciones"] = "Proximo pago"
+            
+            conteo_parciales = es_parcial_reset.sum()
+            if conteo_parciales > 0:
+                self.logger.info(f"Se detectaron {conteo_parciales} registros de 'Próximo pago' (parciales).")
+        
+        # Asegurar que IDs se manejen como string para evitar notación científica y pérdida de precisión
+        columnas_id = ["Order Id Paypal", "Invoice Numbers", "Número guía"]
+        
+        for col_id in columnas_id:
+            if col_id in df_final.columns:
+                df_final[col_id] = limpiar_ids(df_final[col_id])
+
+        # 6. Tipos compactos (categorías, float64, "string", datetime64); se vuelven a texto al escribir
+        return aplicar_esquema(df_final)
     
+    # ------------------------------------------------------------------
+    # Reconstrucción incremental de la segunda hoja
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _clave_periodo(archivo_pago: Path, mes: int, año: int) -> str:
+        """Identifica las huellas de un periodo escrito en un Excel de pago concreto"""
+        return f"{Config.HOJA_MAESTRO}|{año}-{mes:02d}|{archivo_pago.name}"
+
+    @staticmethod
+    def _columnas_clave_maestro(df: pd.DataFrame) -> Tuple[str, str]:
+        """Nombres reales de las columnas de factura y orden en el maestro"""
+        columnas = {col.lower(): col for col in df.columns}
+        return (columnas.get('invoice numbers', 'Invoice Numbers'),
+                columnas.get('order id paypal', 'Order Id Paypal'))
+
+    def _preparar_huellas(self, archivo_maestro: Path, archivo_pago: Path,
+                          df_filtrado: pd.DataFrame, mes: int, año: int) -> Optional[pd.DataFrame]:
+        """Calcula las huellas del periodo; se marcan como procesadas al guardar el Excel del pago"""
+        if not Config.USAR_CACHE_MAESTRO or archivo_pago is None:
+            return None
+        # Las columnas que la aplicación devuelve al maestro no cuentan como cambio del registro
+        devueltas = {col.lower() for col in Config.COLUMNAS_ACTUALIZAR_MAESTRO}
+        df_huella = df_filtrado[[col for col in df_filtrado.columns if col.lower() not in devueltas]]
+        huellas = huellas_filas(df_huella, *self._columnas_clave_maestro(df_filtrado))
+        self._huellas_pendientes = (archivo_maestro, archivo_pago, self._clave_periodo(archivo_pago, mes, año), huellas)
+        return huellas
+
+    def _marcar_periodo_procesado(self, archivo: Path) -> None:
+        if self._huellas_pendientes is None:
+            return
+        archivo_maestro, archivo_pago, clave, huellas = self._huellas_pendientes
+        if archivo_pago != archivo:
+            return
+        CacheMaestro().marcar_procesado(archivo_maestro, clave, huellas)
+        self._huellas_pendientes = None
+
+    def leer_validacion_existente(self, archivo: Path) -> Optional[pd.DataFrame]:
+        """
+        Registros ya escritos en la hoja 'Validación' de un pago (incluidos los de "Proximo pago"),
+        sin totales ni filas vacías. None si la hoja no existe o no tiene las columnas esperadas.
+        """
+        try:
+            with pd.ExcelFile(archivo) as xl:
+                if 'Validación' not in xl.sheet_names:
+                    return None
+                df = xl.parse('Validación', dtype=object)
+        except Exception as e:
+            self.logger.warning(f"No se pudo leer la hoja 'Validación' de {archivo.name}: {e}")
+            return None
+
+        df.columns = [str(col).strip() for col in df.columns]
+        if set(Config.COLUMNAS_SEGUNDA_HOJA) - set(df.columns):
+            self.logger.warning(f"La hoja 'Validación' de {archivo.name} no tiene las columnas esperadas.")
+            return None
+
+        # Todo registro del maestro tiene Fecha_pago; totales y separadores no
+        df = df.loc[limpiar_nulos(df['Fecha_pago']) != "", Config.COLUMNAS_SEGUNDA_HOJA]
+        return aplicar_esquema(df.reset_index(drop=True))
+
+    def _validacion_anterior(self, archivo: Optional[Path]) -> Optional[pd.DataFrame]:
+        """Hoja 'Validación' ya escrita del pago: la del archivo o, si una descarga lo reemplazó, la guardada"""
+        if self._validacion_reemplazada is not None and self._validacion_reemplazada[0] == archivo:
+            _, df_anterior = self._validacion_reemplazada
+            self._validacion_reemplazada = None
+            return df_anterior
+        if archivo is None or not archivo.exists():
+            return None
+        return self.leer_validacion_existente(archivo)
+
+    @staticmethod
+    def _claves_validacion(df: pd.DataFrame) -> pd.MultiIndex:
+        """(factura, orden, ocurrencia) de cada fila de la segunda hoja, como en las huellas"""
+        factura = limpiar_nulos(df['Invoice Numbers']).to_numpy()
+        orden = limpiar_nulos(df['Order Id Paypal']).to_numpy()
+        ocurrencia = pd.Series(0, index=df.index).groupby([factura, orden], sort=False).cumcount()
+        return pd.MultiIndex.from_arrays([factura, orden, ocurrencia.to_numpy()])
+
+    def conservar_revision(self, df_nuevo: pd.DataFrame, df_existente: pd.DataFrame) -> pd.DataFrame:
+        """
+        Devuelve a las filas reconstruidas la revisión de soportes ya escrita en la hoja
+        'Validación' (Config.COLUMNAS_REVISION_SOPORTES). Las filas se emparejan por factura,
+        orden y ocurrencia; solo se conservan valores no vacíos y "Proximo pago" se recalcula siempre.
+        """
+        anteriores = df_existente.set_axis(self._claves_validacion(df_existente))
+        claves = self._claves_validacion(df_nuevo)
+        df_nuevo = df_nuevo.copy()
+
+        conservadas = 0
+        for col in Config.COLUMNAS_REVISION_SOPORTES:
+            anterior = anteriores[col].astype(object).reindex(claves).set_axis(df_nuevo.index)
+            actual = df_nuevo[col].astype(object)
+            usar = ~self._es_vacio(anterior)
+            if col == 'Observaciones':
+                usar &= (anterior != "Proximo pago") & (actual != "Proximo pago")
+            if usar.any():
+                df_nuevo[col] = actual.where(~usar, anterior)
+                conservadas = max(conservadas, int(usar.sum()))
+
+        if conservadas:
+            self.logger.info(f"Se conservó la revisión de soportes de {conservadas} fila(s) ya escritas.")
+        return aplicar_esquema(df_nuevo)
+
+    def actualizar_segunda_hoja_incremental(self, archivo_pago: Optional[Path], archivo_maestro: Path,
+                                            df_filtrado: pd.DataFrame, mes: int, año: int) -> pd.DataFrame:
+        """
+        Segunda hoja del periodo reutilizando la 'Validación' ya escrita en el Excel del pago.
+
+        Solo se reconstruyen los grupos de factura con registros insertados, cambiados o
+        eliminados en el maestro desde el último procesamiento; el resto de filas (con sus
+        Observaciones) se conserva. Si una nueva descarga reemplazó el Excel del pago, se usa
+        la hoja que tenía (ver mover_y_renombrar_descarga). Sin procesamiento anterior se
+        construye completa. En las filas reconstruidas se mantiene la revisión de soportes
+        ya escrita (ver conservar_revision).
+        """
+        huellas = self._preparar_huellas(archivo_maestro, archivo_pago, df_filtrado, mes, año)
+        delta = (CacheMaestro().delta(archivo_maestro, self._clave_periodo(archivo_pago, mes, año), huellas)
+                 if huellas is not None else None)
+        df_existente = self._validacion_anterior(archivo_pago)
+
+        if df_existente is None:
+            self.logger.info(f"{mes:02d}/{año}: sin hoja 'Validación' anterior, se construye completa.")
+            return self._construir_segunda_hoja(df_filtrado)
+
+        if delta is None:
+            self.logger.info(f"{mes:02d}/{año}: sin procesamiento anterior utilizable, se construye completa.")
+            return self.conservar_revision(self._construir_segunda_hoja(df_filtrado), df_existente)
+
+        if delta.vacio:
+            self.logger.info(f"{mes:02d}/{año}: el maestro no cambió desde el último procesamiento.")
+            return df_existente
+
+        # 1. Reconstruir solo los grupos de factura afectados
+        afectadas = delta.facturas_afectadas
+        col_factura, _ = self._columnas_clave_maestro(df_filtrado)
+        factura_maestro = limpiar_ids(df_filtrado[col_factura]).astype(str)
+        df_nuevos = self.conservar_revision(
+            self._construir_segunda_hoja(df_filtrado[factura_maestro.isin(afectadas).values]), df_existente
+        )
+
+        # 2. Conservar las filas ya escritas de las demás facturas
+        factura_existente = limpiar_nulos(df_existente['Invoice Numbers'])
+        df_conservados = df_existente[~factura_existente.isin(afectadas)]
+
+        # 3. Unir y ordenar por la primera aparición de cada factura en el maestro
+        posicion = {factura: i for i, factura in enumerate(dict.fromkeys(factura_maestro))}
+        df_final = pd.concat([df_conservados, df_nuevos], ignore_index=True)
+        orden = limpiar_nulos(df_final['Invoice Numbers']).map(posicion).fillna(len(posicion))
+        df_final = df_final.iloc[orden.argsort(kind='stable')].reset_index(drop=True)
+
+        self.logger.info(
+            f"{mes:02d}/{año}: {len(afectadas)} factura(s) reconstruidas ({len(df_nuevos)} filas), "
+            f"{len(df_conservados)} filas conservadas de {archivo_pago.name}."
+        )
+        return aplicar_esquema(df_final)
+
+    def leer_valores_sap(self, archivo_principal: Path, col_ref: str, col_valor: str,
+                         referencias: Optional[set] = None) -> Optional[pd.Series]:
+        """
+        Construye la serie Referencia -> valor de la primera hoja (Data SAP).
+
+        La hoja se lee por lotes (Config.LOTE_FILAS_SAP filas) en modo read_only y de cada
+        lote solo se guardan las dos columnas, con tipos compactos (texto "string" y float64).
+        Si se pasan `referencias`, cada lote se filtra a esas referencias antes de acumularse.
+        Con Config.VOLCADO_SAP_PARQUET las dos columnas completas se vuelcan a Parquet y
+        se reutilizan mientras el Excel no cambie.
+        Ante referencias repetidas gana la última. Retorna None si falta alguna columna.
+        """
+        cache = CacheMaestro() if Config.VOLCADO_SAP_PARQUET else None
+        variante = f"sap:{col_ref}|{col_valor}"
+
+        df_sap = cache.obtener(archivo_principal, "SAP", variante, conservar_tipos=True) if cache else None
+        if df_sap is None:
+            lotes = self._leer_lotes_sap(archivo_principal, col_ref, col_valor)
+            if lotes is None:
+                return None
+            # Sin volcado se filtra lote a lote; con volcado se guardan todas las referencias
+            filtrar = referencias is not None and cache is None
+            partes = [lote[lote[col_ref].isin(referencias)] if filtrar else lote for lote in lotes]
+            df_sap = pd.concat(partes, ignore_index=True) if partes else self._lote_sap([], col_ref, col_valor)
+            if cache:
+                cache.guardar(archivo_principal, "SAP", df_sap, variante)
+
+        if referencias is not None:
+            df_sap = df_sap[df_sap[col_ref].isin(referencias)]
+        df_sap = df_sap.drop_duplicates(subset=col_ref, keep='last')
+        return pd.Series(df_sap[col_valor].to_numpy(), index=df_sap[col_ref].to_numpy(), name=col_valor)
+
+    def _leer_lotes_sap(self, archivo_principal: Path, col_ref: str, col_valor: str):
+        """
+        Generador de lotes de la hoja SAP como DataFrames compactos de dos columnas.
+        Retorna None (sin generar nada) si falta alguna de las columnas.
+        """
+        wb = load_workbook(archivo_principal, read_only=True, data_only=True)
+        lotes = None
+        try:
+            ws = wb.worksheets[0]
+            ws.reset_dimensions()
+            filas = ws.iter_rows(values_only=True)
+
+            # Limpiar nombres de columnas SAP
+            headers = [str(col).strip() if col is not None else "" for col in next(filas, ())]
+
+            # Verificar que existan las columnas necesarias en SAP
+            for col in (col_ref, col_valor):
+                if col not in headers:
+                    self.logger.error(f"ERROR: No se encontró columna '{col}' en la hoja de SAP.")
+                    return None
+
+            idx_ref = headers.index(col_ref)
+            idx_valor = headers.index(col_valor)
+
+            def _lotes():
+                try:
+                    lote = []
+                    for fila in filas:
+                        if len(fila) <= idx_ref or fila[idx_ref] is None:
+                            continue
+                        lote.append((str(fila[idx_ref]).strip(), fila[idx_valor] if len(fila) > idx_valor else None))
+                        if len(lote) >= Config.LOTE_FILAS_SAP:
+                            yield self._lote_sap(lote, col_ref, col_valor)
+                            lote = []
+                    if lote:
+                        yield self._lote_sap(lote, col_ref, col_valor)
+                finally:
+                    wb.close()
+
+            lotes = _lotes()
+            return lotes
+        finally:
+            # Si no se entrega el generador (falta una columna o falló la cabecera), cerrar aquí
+            if lotes is None:
+                wb.close()
+
+    @staticmethod
+    def _lote_sap(lote: list, col_ref: str, col_valor: str) -> pd.DataFrame:
+        """Convierte una lista de (referencia, valor) en un DataFrame con tipos compactos"""
+        referencias, valores = zip(*lote) if lote else ((), ())
+        return pd.DataFrame({
+            col_ref: pd.array(referencias, dtype="string"),
+            col_valor: pd.to_numeric(pd.Series(valores, dtype=object), errors='coerce').astype('float64'),
+        })
+
     def calcular_mon_grupo_y_diferencia(self, archivo_principal: Path, df_segunda_hoja: pd.DataFrame) -> pd.DataFrame:
         """
         Calcula Comparación flete (desde SAP) y Resultado comparación usando la primera hoja
         """
         try:
             self.logger.info("Calculando valores de Comparación flete y Resultado comparación...")
-            # Leer primera hoja (Data SAP) con dtype=object para IDs
-            df_sap = pd.read_excel(archivo_principal, sheet_name=0, engine='openpyxl', dtype=object)
-            
-            # Limpiar nombres de columnas SAP
-            df_sap.columns = [str(col).strip() for col in df_sap.columns]
-            
-            # Verificar que existan las columnas necesarias en SAP
             col_ref_sap = 'Referencia'
             col_valor_sap = 'Mon.grupo/Valoración grupo'
-            
-            if col_ref_sap not in df_sap.columns:
-                self.logger.error(f"ERROR: No se encontró columna '{col_ref_sap}' en la hoja de SAP.")
-                return df_segunda_hoja
-            
-            if col_valor_sap not in df_sap.columns:
-                self.logger.error(f"ERROR: No se encontró columna '{col_valor_sap}' en la hoja de SAP.")
+
+            # Limpiar invoice numbers para el mapeo
+            invoices = None
+            if 'Invoice Numbers' in df_segunda_hoja.columns:
+                invoices = df_segunda_hoja['Invoice Numbers'].astype(str).str.strip()
+
+            # Serie Referencia (SAP) -> Valor, leyendo la primera hoja por lotes y
+            # conservando solo las referencias de la segunda hoja
+            valores_sap = self.leer_valores_sap(
+                archivo_principal, col_ref_sap, col_valor_sap,
+                referencias=set(invoices) if invoices is not None else None
+            )
+            if valores_sap is None:
                 return df_segunda_hoja
             
-            # Crear diccionario de Referencia (SAP) -> Valor
-            df_sap[col_ref_sap] = df_sap[col_ref_sap].astype(str).str.strip()
-            dict_valores_sap = df_sap.set_index(col_ref_sap)[col_valor_sap].to_dict()
-            
             # Mapear a la segunda hoja usando Invoice Numbers
-            if 'Invoice Numbers' in df_segunda_hoja.columns:
-                # Limpiar invoice numbers para el mapeo
-                df_segunda_hoja['Invoice_Clean'] = df_segunda_hoja['Invoice Numbers'].astype(str).str.strip()
+            if invoices is not None:
+                df_segunda_hoja['Invoice_Clean'] = invoices
                 
                 # Comparación flete = Valor de SAP (Mon.grupo)
-                df_segunda_hoja['Valoración flete'] = df_segunda_hoja['Invoice_Clean'].map(dict_valores_sap)
+                df_segunda_hoja['Valoración flete'] = df_segunda_hoja['Invoice_Clean'].map(valores_sap)
                 
                 # Resultado comparación = Flete + Comparación flete
                 if 'Flete' in df_segunda_hoja.columns:
@@ -931,122 +1738,384 @@ class ProcesadorExcel:
             self.logger.error(f"ERROR EN CÁLCULOS DE MONEDA/DIFERENCIA: {str(e)}")
             return df_segunda_hoja
     
-    def guardar_excel_con_dos_hojas(self, archivo: Path, df_segunda_hoja: pd.DataFrame):
-        """Guarda el Excel con ambas hojas, aplica fórmulas dinámicas, totales y estilos"""
+    def guardar_excel_con_dos_hojas(self, archivo: Path, df_segunda_hoja: pd.DataFrame,
+                                    rapido: Optional[bool] = None):
+        """
+        Guarda el Excel con ambas hojas, aplica fórmulas dinámicas, totales y estilos.
+        Solo se escribe la hoja 'Validación' (reemplazándola o agregándola al final);
+        la hoja de SAP y el resto del libro se copian sin cambios, con sus anchos y estilos.
+        Con `rapido` (por defecto Config.EXPORTACION_RAPIDA) la hoja se genera con
+        xlsxwriter en lugar de openpyxl; el resultado tiene el mismo diseño.
+        """
         try:
             self.logger.info(f"Guardando cambios finales en {archivo.name} con fórmulas dinámicas y totales...")
             
+            # 1. Convertir a los valores de Excel (fechas dd/mm/aaaa, IDs como texto)
+            df_excel = preparar_para_excel(df_segunda_hoja)
+
             # Identificar registros de "Proximo pago" (aquellos que NO tienen factura/guia y su Net > 0)
             # O basándonos en la lógica del maestro: registros parciales.
-            df_normales = df_segunda_hoja[df_segunda_hoja['Observaciones'] != 'Proximo pago'].copy()
-            df_proximos = df_segunda_hoja[df_segunda_hoja['Observaciones'] == 'Proximo pago'].copy()
-
-            # 1. Guardar el DataFrame con pandas (solo los datos base)
-            # Asegurar que los IDs sean tratados como texto antes de guardar
-            for col in ["Order Id Paypal", "Invoice Numbers", "Número guía"]:
-                if col in df_normales.columns:
-                    df_normales[col] = df_normales[col].astype(str).replace(['nan', 'None', ''], "")
-                if col in df_proximos.columns:
-                    df_proximos[col] = df_proximos[col].astype(str).replace(['nan', 'None', ''], "")
-
-            with pd.ExcelWriter(archivo, engine='openpyxl', mode='a', if_sheet_exists='replace') as writer:
-                df_normales.to_excel(writer, sheet_name='Validación', index=False)
-            
-            # 2. Reabrir con openpyxl para insertar fórmulas, totales y registros parciales
-            wb = load_workbook(archivo)
-            ws = wb['Validación']
-            
-            # Identificar índices de columnas
-            headers = [cell.value for cell in ws[1]]
-            cols_totales = [
-                "Gross", "Fee", "Net",
-                "Prorrateo Disputa", "Prorrateo Normal", "Neto despues de prorrateo",
-                "Flete", "Valor mcia"
-            ]
-            indices_totales = {col: headers.index(col) + 1 for col in cols_totales if col in headers}
-            
-            idx_flete = headers.index('Flete') + 1 if 'Flete' in headers else None
-            idx_valoracion = headers.index('Valoración flete') + 1 if 'Valoración flete' in headers else None
-            idx_diferencia = headers.index('Diferencia') + 1 if 'Diferencia' in headers else None
-            idx_observaciones = headers.index('Observaciones') + 1 if 'Observaciones' in headers else None
-
-            last_row_data = ws.max_row
-
-            # 3. Aplicar fórmulas dinámicas fila por fila (Diferencia)
-            if idx_flete and idx_valoracion and idx_diferencia:
-                col_flete_letra = get_column_letter(idx_flete)
-                col_valoracion_letra = get_column_letter(idx_valoracion)
-                col_diferencia_letra = get_column_letter(idx_diferencia)
-                
-                for row_idx in range(2, last_row_data + 1):
-                    formula_diff = f"={col_flete_letra}{row_idx}+{col_valoracion_letra}{row_idx}"
-                    ws.cell(row=row_idx, column=idx_diferencia).value = formula_diff
-
-            # 4. Insertar fila de TOTALES
-            fila_totales = last_row_data + 1
-            for col_name, col_idx in indices_totales.items():
-                letra = get_column_letter(col_idx)
-                # Fórmula SUM desde fila 2 hasta la última de datos
-                formula_sum = f"=SUM({letra}2:{letra}{last_row_data})"
-                ws.cell(row=fila_totales, column=col_idx).value = formula_sum
-                ws.cell(row=fila_totales, column=col_idx).font = Font(bold=True)
-
-            # 5. Insertar registros de "Proximo pago" después de un espacio (si existen)
-            if not df_proximos.empty:
-                fila_proximos_start = fila_totales + 3 # Dejar 2 filas de espacio
-                for i, (_, row) in enumerate(df_proximos.iterrows()):
-                    current_row = fila_proximos_start + i
-                    for col_idx, header in enumerate(headers, 1):
-                        val = row.get(header)
-                        if pd.notna(val):
-                            # Si es uno de los IDs, forzarlo como string para evitar notación científica
-                            if header in ["Order Id Paypal", "Invoice Numbers", "Número guía"]:
-                                ws.cell(row=current_row, column=col_idx).value = str(val)
-                            else:
-                                ws.cell(row=current_row, column=col_idx).value = val
-                    # Asegurar que diga "Proximo pago" al final si corresponde
-                    if idx_observaciones:
-                        ws.cell(row=current_row, column=idx_observaciones).value = "Proximo pago"
-
-            # 6. Definir y aplicar estilos de cabecera
-            color_fondo = PatternFill(start_color='69E2FF', end_color='69E2FF', fill_type='solid')
-            fuente_cabecera = Font(bold=True)
-            alineacion_centrada = Alignment(horizontal='center', vertical='center')
-            
-            # Aplicar estilos a la fila de cabecera
-            for cell in ws[1]:
-                cell.fill = color_fondo
-                cell.font = fuente_cabecera
-                cell.alignment = alineacion_centrada
-            
-            # Configurar anchos de columna
-            anchos_config = {
-                "Observaciones": 44,
-                "Date": 15,
-                "Fecha del envío": 18,
-                "Prorrateo Disputa": 20,
-                "Prorrateo Normal": 20,
-                "Neto despues de prorrateo": 20,
-                "Fecha_pago": 15,
-                "Order Id Paypal": 20,
-                "Valoración flete": 20,
-                "Diferencia": 15,
-                "Número guía": 20,
-                "Invoice Numbers": 18
-            }
-            
-            for col_idx, col_name in enumerate(headers, 1):
-                if col_name in anchos_config:
-                    letra_col = get_column_letter(col_idx)
-                    ws.column_dimensions[letra_col].width = anchos_config[col_name]
-            
-            wb.save(archivo)
+            es_proximo = df_excel['Observaciones'] == 'Proximo pago'
+            df_normales = df_excel[~es_proximo]
+            df_proximos = df_excel[es_proximo]
+
+            # 2. Generar solo la hoja 'Validación' (valores, fórmulas, totales y estilos) en un libro aparte
+            if rapido is None:
+                rapido = Config.EXPORTACION_RAPIDA
+            with tempfile.TemporaryDirectory(prefix="validacion_") as carpeta:
+                libro_validacion = Path(carpeta) / "validacion.xlsx"
+                if not (rapido and self._libro_validacion_xlsxwriter(df_normales, df_proximos, libro_validacion)):
+                    self._libro_validacion_openpyxl(df_normales, df_proximos, libro_validacion)
+
+                # 3. Ponerla en el libro: las demás partes del archivo se copian tal cual
+                reemplazar_hoja(archivo, 'Validación', libro_validacion)
             self.logger.info("Archivo guardado con totales, fórmulas dinámicas y registros parciales.")
+            self._marcar_periodo_procesado(archivo)
         
         except Exception as e:
             self.logger.error(f"ERROR AL GUARDAR EL ARCHIVO EXCEL FINAL CON DISEÑO: {str(e)}")
             raise
 
+    def _libro_validacion_openpyxl(self, df_normales: pd.DataFrame, df_proximos: pd.DataFrame,
+                                   destino: Path) -> None:
+        """Escribe en `destino` un libro con solo la hoja 'Validación', con openpyxl (write_only)"""
+        wb = Workbook(write_only=True)
+        self._escribir_hoja_validacion(wb.create_sheet('Validación'), df_normales, df_proximos)
+        wb.save(destino)
+
+    @staticmethod
+    def _filas_validacion(df_normales: pd.DataFrame, df_proximos: pd.DataFrame):
+        """
+        Genera las filas de la hoja 'Validación' en orden como (tipo, valores):
+        'cabecera', 'datos' (con la fórmula de Diferencia), 'totales' (SUM por columna),
+        'vacia' (las dos filas de separación) y 'proximo' (registros de "Proximo pago").
+        Los vacíos se entregan como None. Lo comparten los dos escritores.
+        """
+        headers = [str(col) for col in df_normales.columns]
+        columnas_id = {"Order Id Paypal", "Invoice Numbers", "Número guía"}
+
+        idx_flete = headers.index('Flete') if 'Flete' in headers else None
+        idx_valoracion = headers.index('Valoración flete') if 'Valoración flete' in headers else None
+        idx_diferencia = headers.index('Diferencia') if 'Diferencia' in headers else None
+        idx_observaciones = headers.index('Observaciones') if 'Observaciones' in headers else None
+
+        def _valor(val):
+            return None if val is None or pd.isna(val) else val
+
+        # 1. Cabecera
+        yield 'cabecera', headers
+
+        # 2. Datos, con la fórmula dinámica de Diferencia
+        usar_formula = idx_flete is not None and idx_valoracion is not None and idx_diferencia is not None
+        if usar_formula:
+            col_flete_letra = get_column_letter(idx_flete + 1)
+            col_valoracion_letra = get_column_letter(idx_valoracion + 1)
+
+        fila_excel = 1
+        for valores in df_normales.itertuples(index=False, name=None):
+            fila_excel += 1
+            fila = [_valor(val) for val in valores]
+            if usar_formula:
+                fila[idx_diferencia] = f"={col_flete_letra}{fila_excel}+{col_valoracion_letra}{fila_excel}"
+            yield 'datos', fila
+        last_row_data = fila_excel
+
+        # 3. Fila de TOTALES
+        fila_totales = [None] * len(headers)
+        for col_name in _COLUMNAS_TOTALES_VALIDACION:
+            if col_name in headers:
+                col_idx = headers.index(col_name)
+                letra = get_column_letter(col_idx + 1)
+                fila_totales[col_idx] = f"=SUM({letra}2:{letra}{last_row_data})"
+        yield 'totales', fila_totales
+
+        # 4. Registros de "Proximo pago" después de dos filas de espacio (si existen)
+        if df_proximos.empty:
+            return
+        yield 'vacia', []
+        yield 'vacia', []
+        columnas_proximos = list(df_proximos.columns)
+        for valores in df_proximos.itertuples(index=False, name=None):
+            registro = dict(zip(columnas_proximos, valores))
+            fila = []
+            for header in headers:
+                val = _valor(registro.get(header))
+                if val is not None and header in columnas_id:
+                    # IDs como texto para evitar notación científica
+                    val = str(val)
+                fila.append(val)
+            if idx_observaciones is not None:
+                fila[idx_observaciones] = "Proximo pago"
+            yield 'proximo', fila
+
+    def _escribir_hoja_validacion(self, ws, df_normales: pd.DataFrame, df_proximos: pd.DataFrame):
+        """Escribe la hoja 'Validación' completa en una hoja write_only de openpyxl, fila a fila"""
+        # Estilos compartidos por todas las celdas que los usan
+        color_fondo = PatternFill(start_color=_COLOR_CABECERA_VALIDACION, end_color=_COLOR_CABECERA_VALIDACION,
+                                  fill_type='solid')
+        fuente_negrita = Font(bold=True)
+        alineacion_centrada = Alignment(horizontal='center', vertical='center')
+        lado = Side(style='thin')
+        borde_cabecera = Border(left=lado, right=lado, top=lado, bottom=lado)
+
+        # 1. Anchos de columna (en write_only deben definirse antes de escribir filas)
+        for col_idx, col_name in enumerate(df_normales.columns, 1):
+            if col_name in _ANCHOS_VALIDACION:
+                ws.column_dimensions[get_column_letter(col_idx)].width = _ANCHOS_VALIDACION[col_name]
+
+        # 2. Filas
+        for tipo, valores in self._filas_validacion(df_normales, df_proximos):
+            if tipo == 'cabecera':
+                fila = []
+                for col_name in valores:
+                    celda = WriteOnlyCell(ws, value=col_name)
+                    celda.fill = color_fondo
+                    celda.font = fuente_negrita
+                    celda.alignment = alineacion_centrada
+                    celda.border = borde_cabecera
+                    fila.append(celda)
+            elif tipo == 'totales':
+                fila = []
+                for val in valores:
+                    celda = None
+                    if val is not None:
+                        celda = WriteOnlyCell(ws, value=val)
+                        celda.font = fuente_negrita
+                    fila.append(celda)
+            else:
+                fila = [self._valor_celda_validacion(ws, val) for val in valores]
+            ws.append(fila)
+
+    @staticmethod
+    def _valor_celda_validacion(ws, val):
+        """Valor de celda como lo escribiría pandas: fechas con su formato numérico"""
+        if isinstance(val, (datetime, date)):
+            celda = WriteOnlyCell(ws, value=val)
+            celda.number_format = 'YYYY-MM-DD HH:MM:SS' if isinstance(val, datetime) else 'YYYY-MM-DD'
+            return celda
+        return val
+
+    def _libro_validacion_xlsxwriter(self, df_normales: pd.DataFrame,
+                                     df_proximos: pd.DataFrame, destino: Path) -> bool:
+        """
+        Escribe en `destino` un libro con solo la hoja 'Validación', con xlsxwriter.
+        Retorna False si xlsxwriter no está instalado.
+        """
+        try:
+            import xlsxwriter
+        except ImportError:
+            self.logger.warning("xlsxwriter no está instalado. Se usa el guardado estándar con openpyxl.")
+            return False
+
+        # constant_memory: cada fila se vuelca a disco al pasar a la siguiente, así la memoria
+        # no crece con la hoja (exige escribir las filas en orden, como hace _filas_validacion)
+        libro = xlsxwriter.Workbook(str(destino), {
+            'constant_memory': True,
+            'strings_to_urls': False,
+            'remove_timezone': True,
+        })
+        try:
+            formatos = _FormatosXlsxwriter(libro)
+            self._escribir_validacion_xlsxwriter(libro.add_worksheet('Validación'), formatos,
+                                                 df_normales, df_proximos)
+        finally:
+            libro.close()
+        return True
+
+    def _escribir_validacion_xlsxwriter(self, ws, formatos: "_FormatosXlsxwriter",
+                                        df_normales: pd.DataFrame, df_proximos: pd.DataFrame):
+        """Escribe la hoja 'Validación' con xlsxwriter usando el mismo diseño que openpyxl"""
+        for col_idx, col_name in enumerate(df_normales.columns):
+            if col_name in _ANCHOS_VALIDACION:
+                ws.set_column(col_idx, col_idx, _ANCHOS_VALIDACION[col_name])
+
+        for num_fila, (tipo, valores) in enumerate(self._filas_validacion(df_normales, df_proximos)):
+            formato = {'cabecera': formatos.cabecera, 'totales': formatos.negrita}.get(tipo)
+            for num_col, val in enumerate(valores):
+                if val is not None:
+                    formatos.escribir(ws, num_fila, num_col, val, formato)
+
+
+    # ------------------------------------------------------------------
+    # Actualización del maestro
+    # ------------------------------------------------------------------
+
+    def actualizar_maestro(self, archivo_maestro: Path, df_segunda_hoja: pd.DataFrame,
+                           numero_pago: int, nombre_hoja: str = Config.HOJA_MAESTRO) -> Optional[dict]:
+        """
+        Devuelve al maestro el número de pago, las Observaciones y la Fecha del envío
+        de los registros del pago.
+
+        El maestro se lee en streaming (read_only) para ubicar el encabezado, construir el
+        índice factura/orden -> fila de Excel y conocer los valores actuales; después solo
+        se reescriben en el XML de la hoja las celdas cuyo valor cambia (ver
+        paquete_excel.actualizar_celdas). Macros, otras hojas y estilos se copian sin tocar.
+        Retorna {'celdas', 'registros', 'no_encontrados', 'segundos'}, o None si el maestro
+        no se pudo actualizar (p. ej. abierto por otro usuario).
+        """
+        inicio = time.perf_counter()
+        self.logger.info(f"Actualizando maestro {archivo_maestro.name} con el pago #{numero_pago}...")
+        try:
+            # 1. Encabezado, columnas y valores actuales en una sola pasada de lectura
+            wb = load_workbook(archivo_maestro, read_only=True, data_only=True, keep_links=False)
+            try:
+                ws = wb[nombre_hoja]
+                ws.reset_dimensions()
+                filas = ws.iter_rows(values_only=True)
+                primeras = list(itertools.islice(filas, Config.FILAS_BUSQUEDA_ENCABEZADO))
+                pos_encabezado = self._detectar_fila_encabezado(
+                    primeras, self._columnas_maestro_requeridas(), archivo_maestro, nombre_hoja
+                )
+                columnas = self._resolver_columnas_maestro(primeras[pos_encabezado] if primeras else [])
+
+                faltantes = [c for c in ('invoice numbers', 'order id paypal', 'fecha_pago') if c not in columnas]
+                if faltantes:
+                    self.logger.error(f"El maestro no tiene las columnas {faltantes}; no se actualiza.")
+                    return None
+
+                destinos = {col: columnas[col.lower()] for col in Config.COLUMNAS_ACTUALIZAR_MAESTRO
+                            if col.lower() in columnas}
+                col_pago = columnas.get(Config.COLUMNA_PAGO_MAESTRO.lower())
+                if col_pago is None:
+                    self.logger.warning(f"No existe la columna '{Config.COLUMNA_PAGO_MAESTRO}' en el maestro; "
+                                        f"no se escribirá el número de pago.")
+
+                leidas = [columnas['invoice numbers'], columnas['order id paypal'], columnas['fecha_pago'],
+                          *destinos.values(), *([col_pago] if col_pago is not None else [])]
+                datos = pd.DataFrame(
+                    [[fila[i] if i < len(fila) else None for i in leidas]
+                     for fila in itertools.chain(primeras[pos_encabezado + 1:], filas)],
+                    columns=range(len(leidas)), dtype=object,
+                )
+            finally:
+                wb.close()
+
+            # 2. Índice de filas sobre las columnas clave (filas de Excel en base 1)
+            primera_fila = pos_encabezado + 2
+            datos.index = range(primera_fila, primera_fila + len(datos))
+            indice = self._indice_filas_maestro(datos[0], datos[1], datos[2])
+            actuales = {col: datos[pos] for pos, col in enumerate(leidas)}
+
+            # 3. Celdas que cambian, por fila y columna (base 1)
+            df_excel = preparar_para_excel(df_segunda_hoja)
+            claves = self._claves_registros(df_segunda_hoja)
+            usadas, cambios, no_encontrados = set(), {}, 0
+            for pos, clave in enumerate(claves):
+                fila = self._buscar_fila_maestro(indice, clave, usadas)
+                if fila is None:
+                    no_encontrados += 1
+                    continue
+                usadas.add(fila)
+
+                nuevos = {}
+                if col_pago is not None:
+                    nuevos[col_pago] = numero_pago
+                for col, col_maestro in destinos.items():
+                    # Las fechas se escriben como fecha; el resto, como en la hoja de validación
+                    fuente = df_segunda_hoja if col in COLUMNAS_FECHA else df_excel
+                    valor = fuente[col].iloc[pos]
+                    if valor is not None and not pd.isna(valor) and str(valor).strip() != "":
+                        nuevos[col_maestro] = valor.to_pydatetime() if isinstance(valor, pd.Timestamp) else valor
+
+                diferentes = {col + 1: valor for col, valor in nuevos.items() if actuales[col][fila] != valor}
+                if diferentes:
+                    cambios[fila] = diferentes
+
+            # 4. Reescribir solo esas celdas (temporal + reemplazo: el maestro nunca queda a medio escribir)
+            escritas = actualizar_celdas(archivo_maestro, nombre_hoja, cambios) if cambios else {}
+            celdas = sum(escritas.values())
+            registros = sum(1 for n in escritas.values() if n)
+
+            segundos = time.perf_counter() - inicio
+            self.logger.info(f"Maestro actualizado: {celdas} celdas en {registros} registros "
+                             f"({no_encontrados} no encontrados) en {segundos:.1f}s.")
+            return {'celdas': celdas, 'registros': registros,
+                    'no_encontrados': no_encontrados, 'segundos': segundos}
+
+        except PermissionError:
+            self.logger.error(f"No se pudo guardar {archivo_maestro.name}: el archivo está abierto por otro usuario.")
+            return None
+        except Exception as e:
+            self.logger.error(f"ERROR AL ACTUALIZAR EL MAESTRO: {str(e)}")
+            return None
+
+    @staticmethod
+    def _claves_registros(df: pd.DataFrame) -> List[Tuple[str, str, Optional[date]]]:
+        """(factura, orden, fecha de pago) de cada registro de la segunda hoja"""
+        fechas = pd.to_datetime(df['Fecha_pago'], errors='coerce', dayfirst=True)
+        return list(zip(limpiar_nulos(df['Invoice Numbers']), limpiar_nulos(df['Order Id Paypal']),
+                        [f.date() if pd.notna(f) else None for f in fechas]))
+
+    def _indice_filas_maestro(self, facturas: pd.Series, ordenes: pd.Series, fechas_pago: pd.Series) -> dict:
+        """
+        {'factura': {factura: [(fila, orden, fecha_pago), ...]}, 'orden': {orden: [...]}}
+        a partir de las columnas clave del maestro, indexadas por fila de Excel.
+        """
+        # Mismo criterio que preparar_maestro para interpretar Fecha_pago
+        fechas = pd.to_datetime(fechas_pago, errors='coerce')
+
+        entradas = list(zip(facturas.index, limpiar_ids(ordenes),
+                            [f.date() if pd.notna(f) else None for f in fechas]))
+        indice = {'factura': {}, 'orden': {}}
+        for factura, entrada in zip(limpiar_ids(facturas), entradas):
+            if factura:
+                indice['factura'].setdefault(factura, []).append(entrada)
+            elif entrada[1]:
+                indice['orden'].setdefault(entrada[1], []).append(entrada)
+        self.logger.info(f"Índice del maestro: {len(indice['factura'])} facturas, "
+                         f"{len(indice['orden'])} órdenes sin factura.")
+        return indice
+
+    @staticmethod
+    def _buscar_fila_maestro(indice: dict, clave: Tuple[str, str, Optional[date]], usadas: set) -> Optional[int]:
+        """
+        Primera fila libre del maestro con la misma factura (o la misma orden si no hay factura)
+        y la misma fecha de pago; entre ellas se prefiere la que tiene la misma orden.
+        """
+        factura, orden, fecha_pago = clave
+        candidatas = indice['factura'].get(factura, []) if factura else indice['orden'].get(orden, [])
+        libres = [(fila, orden_maestro) for fila, orden_maestro, fecha in candidatas
+                  if fila not in usadas and fecha == fecha_pago]
+        for fila, orden_maestro in libres:
+            if orden_maestro == orden:
+                return fila
+        return libres[0][0] if libres else None
+
+
+class _FormatosXlsxwriter:
+    """Formatos compartidos de un libro xlsxwriter y escritura de valores por tipo"""
+
+    def __init__(self, libro):
+        self.libro = libro
+        self.cabecera = libro.add_format({
+            'bold': True,
+            'bg_color': f"#{_COLOR_CABECERA_VALIDACION}",
+            'pattern': 1,
+            'align': 'center',
+            'valign': 'vcenter',
+            'border': 1,
+        })
+        self.negrita = libro.add_format({'bold': True})
+        self.fecha_hora = libro.add_format({'num_format': 'YYYY-MM-DD HH:MM:SS'})
+        self.fecha = libro.add_format({'num_format': 'YYYY-MM-DD'})
+
+    def escribir(self, ws, fila: int, col: int, valor, formato=None):
+        """Escribe un valor con el método de xlsxwriter que corresponde a su tipo"""
+        if isinstance(valor, np.generic):
+            valor = valor.item()  # escalares de numpy
+        if isinstance(valor, (datetime, date, dt_time, timedelta)):
+            if formato is None:
+                formato = self.fecha_hora if isinstance(valor, datetime) else self.fecha
+            ws.write_datetime(fila, col, valor, formato)
+        elif isinstance(valor, bool):
+            ws.write_boolean(fila, col, valor, formato)
+        elif isinstance(valor, (int, float)):
+            ws.write_number(fila, col, valor, formato)
+        elif isinstance(valor, str) and valor.startswith('=') and len(valor) > 1:
+            ws.write_formula(fila, col, valor, formato)
+        else:
+            ws.write_string(fila, col, str(valor), formato)
+
 # ============================================================================
 # FASE 4: GESTIÓN DE PDFs
 # ============================================================================
@@ -1222,19 +2291,21 @@ class GestorPDFs:
             total_procesar = len(df)
             self.logger.info(f"Iniciando flujo de soportes para {total_procesar} registros...")
             
+            # Limpiar una sola vez las columnas que se consultan en cada fila
+            # (para detectar si la fila está realmente vacía)
+            vacia = pd.Series("", index=df.index, dtype=object)
+            observaciones = limpiar_nulos(df['Observaciones'])
+            invoices = limpiar_nulos(df[col_invoices])
+            guias = limpiar_nulos(df[col_guias]) if col_guias in df.columns else vacia
+
             for idx, row in df.iterrows():
                 if progress_callback:
                     progreso = idx / total_procesar
                     progress_callback(progreso, f"Procesando soporte {idx+1}/{total_procesar}")
 
-                # Limpiar valores para detectar si la fila está realmente vacía
-                def _limpiar(val):
-                    v = str(val).strip().lower()
-                    return "" if v in ["nan", "none", ""] else str(val).strip()
-
-                obs_original = _limpiar(row.get('Observaciones', ''))
-                invoice_val = _limpiar(row.get(col_invoices, ''))
-                guia_val = _limpiar(row.get(col_guias, ''))
+                obs_original = observaciones[idx]
+                invoice_val = invoices[idx]
+                guia_val = guias[idx]
                 
                 # Si la fila está vacía (posible fila de separación), no procesar
                 if not invoice_val and not guia_val and not obs_original:
@@ -1332,8 +2403,8 @@ class GestorPDFs:
                                 fecha_coincide = False
 
                         # SIEMPRE actualizamos con la fecha del PDF si la encontramos
-                        # Convertimos a string dd/mm/yyyy para evitar errores de tipo en el DataFrame
-                        df.at[idx, 'Fecha del envío'] = fecha_pdf.strftime('%d/%m/%Y')
+                        # Se guarda como fecha (normalizada a medianoche); se formatea dd/mm/aaaa al escribir
+                        asignar_valor(df, idx, 'Fecha del envío', pd.Timestamp(fecha_pdf).normalize())
                     else:
                         self.logger.warning(f"No se pudo extraer fecha del PDF: {guia_encontrada_path.name}")
 
@@ -1357,7 +2428,7 @@ class GestorPDFs:
                         observacion_final = "Soportes OK"
 
                 self.logger.info(f"Registro {idx}: Factura={tiene_factura}, Guía={tiene_guia}, Coincide={fecha_coincide} -> {observacion_final}")
-                df.at[idx, 'Observaciones'] = observacion_final
+                asignar_valor(df, idx, 'Observaciones', observacion_final)
 
             self.logger.info("Procesamiento de soportes finalizado con el nuevo flujo.")
             return df
@@ -1366,14 +2437,149 @@ class GestorPDFs:
             self.logger.error(f"ERROR CRÍTICO EN PROCESAMIENTO DE DOCUMENTOS: {str(e)}")
             return df
 
+# ============================================================================
+# BACKFILL DE VARIOS MESES
+# ============================================================================
+
+def periodo_backfill(texto: str) -> Tuple[int, int, Optional[int]]:
+    """Convierte 'AAAA-MM' o 'AAAA-MM=PAGO' en (año, mes, pago o None). Para argparse."""
+    try:
+        periodo, _, pago = texto.partition("=")
+        año, mes = (int(parte) for parte in periodo.split("-"))
+        if not 1 <= mes <= 12:
+            raise ValueError
+        return año, mes, int(pago) if pago else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Periodo inválido '{texto}'. Use AAAA-MM o AAAA-MM=PAGO (ej: 2025-03=41).")
+
+
+def descargar_pagos(numeros_pago: List[int], procesador: 'ProcesadorExcel', logger) -> dict:
+    """
+    Descarga de SAP varios pagos con un solo navegador y un solo login (ver SesionSAP)
+    y deja cada reporte en su carpeta 'Pago #N' con la Referencia en la primera columna.
+    Retorna {numero_pago: Excel del pago} de los que se pudieron descargar.
+    """
+    logger.info(f"\n[SAP] Descargando {len(numeros_pago)} pago(s) en una sola sesión: {numeros_pago}")
+    with SesionSAP() as sesion:
+        descargas = sesion.descargar_reportes(numeros_pago)
+
+    gestor_carpetas = GestorCarpetas(Config.BASE_PAYPAL)
+    archivos = {}
+    for numero_pago, archivo_descarga in descargas.items():
+        if archivo_descarga is None:
+            logger.error(f"No se pudo descargar el reporte del pago #{numero_pago}.")
+            continue
+        carpeta_pago, _ = gestor_carpetas.crear_estructura_pago(numero_pago)
+        archivo_pago = procesador.mover_y_renombrar_descarga(archivo_descarga, carpeta_pago, numero_pago)
+        procesador.reorganizar_columnas_primera_hoja(archivo_pago)
+        archivos[numero_pago] = archivo_pago
+    return archivos
+
+
+def excel_del_pago(numero_pago: int) -> Optional[Path]:
+    """Excel más reciente de la carpeta 'Pago #N'; None si no hay ninguno"""
+    carpeta_pago = Config.BASE_PAYPAL / f"Pago #{numero_pago}"
+    candidatos = sorted(carpeta_pago.glob(f"EXPORT_*_Pago#{numero_pago}.xlsx"),
+                        key=lambda f: f.stat().st_mtime, reverse=True)
+    return candidatos[0] if candidatos else None
+
+
+def ejecutar_backfill(especificaciones: List[Tuple[int, int, Optional[int]]], logger,
+                      descargar: bool = False) -> int:
+    """
+    Reconstruye la segunda hoja de varios meses con una sola lectura del maestro.
+    Los periodos con número de pago se escriben en el Excel de la carpeta 'Pago #N'
+    (reconstruyendo solo las facturas que cambiaron desde su último guardado);
+    los que no lo tienen solo informan cuántos registros tendrían.
+    Con `descargar`, los pagos que aún no tienen Excel se descargan antes de SAP,
+    todos en la misma sesión.
+    """
+    if not Config.RUTA_MAESTRO or not Config.RUTA_MAESTRO.exists():
+        logger.error(f"ARCHIVO MAESTRO NO ENCONTRADO EN: {Config.RUTA_MAESTRO}")
+        return 1
+
+    periodos = list(dict.fromkeys((mes, año) for año, mes, _ in especificaciones))
+    logger.info(f"\n[BACKFILL] {len(periodos)} mes(es) desde una sola lectura del maestro...")
+
+    procesador = ProcesadorExcel()
+    if descargar:
+        faltantes = [numero_pago for _, _, numero_pago in especificaciones
+                     if numero_pago is not None and excel_del_pago(numero_pago) is None]
+        if faltantes:
+            descargar_pagos(list(dict.fromkeys(faltantes)), procesador, logger)
+
+    df_maestro = procesador.preparar_maestro(Config.RUTA_MAESTRO)
+    particiones = procesador.particionar_por_periodo(df_maestro, periodos)
+
+    errores = 0
+    for año, mes, numero_pago in especificaciones:
+        df_filtrado = particiones.get((mes, año))
+        if df_filtrado is None:
+            errores += 1
+            continue
+
+        if numero_pago is None:
+            logger.info(f"{mes:02d}/{año}: {len(df_filtrado)} registros (sin número de pago, no se escribe).")
+            continue
+
+        archivo_pago = excel_del_pago(numero_pago)
+        if archivo_pago is None:
+            logger.error(f"{mes:02d}/{año}: no se encontró el Excel del pago #{numero_pago} en "
+                         f"{Config.BASE_PAYPAL / f'Pago #{numero_pago}'}")
+            errores += 1
+            continue
+
+        # Solo se reconstruyen las facturas que cambiaron en el maestro desde el último guardado
+        df_mes = procesador.actualizar_segunda_hoja_incremental(
+            archivo_pago, Config.RUTA_MAESTRO, df_filtrado, mes, año
+        )
+        df_pago = procesador.calcular_mon_grupo_y_diferencia(archivo_pago, df_mes)
+        procesador.guardar_excel_con_dos_hojas(archivo_pago, df_pago)
+        logger.info(f"{mes:02d}/{año}: {len(df_pago)} registros escritos en {archivo_pago.name}")
+
+    return 1 if errores else 0
+
 # ============================================================================
 # FUNCIÓN PRINCIPAL
 # ============================================================================
 
-def main():
+def main(argv: Optional[List[str]] = None):
     """Función principal que orquesta todo el proceso"""
     
+    parser = argparse.ArgumentParser(description="Automatización de pagos PayPal")
+    parser.add_argument(
+        "--rapido", action="store_true",
+        help="Genera la hoja Validación con xlsxwriter en lugar de openpyxl"
+    )
+    parser.add_argument(
+        "--backfill", nargs="+", type=periodo_backfill, metavar="AAAA-MM[=PAGO]",
+        help="Reconstruye la segunda hoja de varios meses con una sola lectura del maestro"
+    )
+    parser.add_argument(
+        "--descargar", action="store_true",
+        help="Con --backfill, descarga de SAP (en una sola sesión) los pagos que aún no tienen Excel"
+    )
+    args = parser.parse_args(argv)
+    if args.rapido:
+        Config.EXPORTACION_RAPIDA = True
+
     logger = configurar_logging()
+
+    # Fuera de la interfaz, las rutas se cargan desde config_paypal.ini
+    if not Config.esta_configurado():
+        configurador = ConfiguradorRutasPayPal()
+        if configurador.cargar_config():
+            Config.cargar_desde_ini(configurador.obtener_rutas())
+        if not Config.esta_configurado():
+            logger.error("No hay rutas configuradas. Configure config_paypal.ini desde la interfaz.")
+            return 1
+
+    if args.backfill:
+        try:
+            return ejecutar_backfill(args.backfill, logger, descargar=args.descargar)
+        except Exception as e:
+            logger.error(f"ERROR CRÍTICO DURANTE EL BACKFILL: {str(e)}")
+            return 1
     logger.info("=" * 80)
     logger.info("INICIANDO SISTEMA DE AUTOMATIZACIÓN DE PAGOS PAYPAL")
     logger.info("=" * 80)
@@ -0,0 +1,277 @@
+"""
+NORMALIZACIÓN DE COLUMNAS - PayPal
+Funciones vectorizadas para fechas, IDs y valores nulos, compartidas por
+main.py (creación de la segunda hoja) y scripts/verificacion.py.
+"""
+
+from collections import Counter
+from datetime import date, datetime
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:  # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+
+FORMATO_FECHA_EXCEL = '%d/%m/%Y'
+
+# Textos que se consideran vacíos al limpiar columnas (comparación en minúsculas)
+TOKENS_NULOS = ("", "nan", "none", "nat", "<na>")
+
+# Último formato de fecha reconocido por columna, para no volver a inferirlo
+_FORMATOS_FECHA: Dict[str, str] = {}
+
+# Textos distintos que se miran para inferir el formato de fecha de una columna
+MUESTRA_FORMATO = 50
+
+
+def _mascara_tipo(serie: pd.Series, clases) -> pd.Series:
+    """Máscara de elementos que son instancia de `clases` (se evalúa una vez por tipo distinto)."""
+    tipos = serie.map(type)
+    es_clase = {tipo: issubclass(tipo, clases) for tipo in tipos.unique()}
+    return tipos.map(es_clase).astype(bool)
+
+
+def _formato_compatible(formato: Optional[str]) -> bool:
+    """Solo se reutilizan formatos que dan el mismo resultado que un parseo con dayfirst=True."""
+    if not formato or '%d' not in formato or '%m' not in formato:
+        return False
+    if formato.startswith('%Y'):
+        return formato.index('%m') < formato.index('%d')
+    return formato.index('%d') < formato.index('%m')
+
+
+def _inferir_formato(textos: pd.Series) -> Optional[str]:
+    """
+    Formato más frecuente entre una muestra de textos distintos, contando solo los compatibles:
+    un primer valor raro (texto libre, fecha con hora) no decide el formato de toda la columna.
+    """
+    conteo = Counter()
+    for texto in textos.drop_duplicates().head(MUESTRA_FORMATO):
+        formato = guess_datetime_format(texto, dayfirst=True)
+        if _formato_compatible(formato):
+            conteo[formato] += 1
+    return conteo.most_common(1)[0][0] if conteo else None
+
+
+def _formatear_escalar(valor, formato_salida: str) -> str:
+    """Camino elemento a elemento (el comportamiento original) para los casos que no se vectorizan."""
+    try:
+        if isinstance(valor, datetime):
+            return valor.strftime(formato_salida)
+        dt = pd.to_datetime(valor, dayfirst=True, errors='coerce')
+        if pd.notna(dt):
+            return dt.strftime(formato_salida)
+        return str(valor).strip()
+    except Exception:
+        return str(valor).strip()
+
+
+def _formatear_textos(textos: pd.Series, formato_salida: str, clave: Optional[str]) -> pd.Series:
+    """
+    Formatea textos de fecha en bloque: primero con el formato recordado (o inferido de una
+    muestra) y, para lo que no encaje, con format='mixed', que equivale a parsear uno a uno.
+    Lo que no es fecha se devuelve tal cual.
+    """
+    resultado = pd.Series(None, index=textos.index, dtype=object)
+
+    formato = _FORMATOS_FECHA.get(clave) if clave else None
+    if not formato:
+        formato = _inferir_formato(textos)
+
+    if _formato_compatible(formato):
+        fechas = pd.to_datetime(textos, format=formato, errors='coerce')
+        validas = fechas.notna()
+        if validas.any():
+            resultado[validas] = fechas[validas].dt.strftime(formato_salida)
+            if clave:
+                _FORMATOS_FECHA[clave] = formato
+
+    pendientes = resultado.isna()
+    if pendientes.any():
+        try:
+            fechas = pd.to_datetime(textos[pendientes], format='mixed', dayfirst=True, errors='coerce')
+            validas = fechas.notna()
+            resultado[validas.index[validas]] = fechas[validas].dt.strftime(formato_salida)
+        except (ValueError, TypeError, AttributeError):
+            # Zonas horarias mezcladas u otros casos raros: volver al camino escalar
+            resultado[pendientes] = textos[pendientes].map(lambda v: _formatear_escalar(v, formato_salida))
+
+    sin_fecha = resultado.isna()
+    resultado[sin_fecha] = textos[sin_fecha]
+    return resultado
+
+
+def formatear_fechas(serie: pd.Series, formato_salida: str = FORMATO_FECHA_EXCEL,
+                     clave: Optional[str] = None) -> pd.Series:
+    """
+    Formatea una columna de fechas como texto dd/mm/aaaa.
+
+    - Vacíos y nulos quedan como "".
+    - Fechas (datetime, Timestamp, date) se formatean directamente.
+    - Textos se parsean en bloque con dayfirst=True; si no son fecha se conservan tal cual.
+    `clave` (normalmente el nombre de la columna) permite recordar el formato detectado.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie.dt.strftime(formato_salida).fillna("").astype(object)
+
+    resultado = pd.Series("", index=serie.index, dtype=object)
+    texto = serie.astype(str).str.strip()
+    vacio = serie.isna() | (texto == "")
+
+    es_fecha = _mascara_tipo(serie, (datetime, date)) & ~vacio
+    es_texto = _mascara_tipo(serie, str) & ~vacio
+    otros = ~(vacio | es_fecha | es_texto)
+
+    if es_fecha.any():
+        fechas = pd.to_datetime(serie[es_fecha], errors='coerce')
+        validas = fechas.notna()
+        resultado[validas.index[validas]] = fechas[validas].dt.strftime(formato_salida)
+        # Fechas fuera del rango de pandas: formatear una a una
+        fuera = validas.index[~validas]
+        resultado[fuera] = serie[fuera].map(lambda v: _formatear_escalar(v, formato_salida))
+
+    if es_texto.any():
+        resultado[es_texto] = _formatear_textos(texto[es_texto], formato_salida, clave)
+
+    if otros.any():
+        resultado[otros] = serie[otros].map(lambda v: _formatear_escalar(v, formato_salida))
+
+    return resultado
+
+
+def limpiar_ids(serie: pd.Series) -> pd.Series:
+    """
+    Convierte una columna de IDs a texto sin notación científica.
+
+    - Nulos, "" y "nan" quedan como "".
+    - Flotantes se convierten a entero redondeado (1234.0 -> "1234", 1.5e15 -> "1500000000000000").
+    - El resto se convierte a texto sin espacios alrededor.
+    """
+    texto = serie.astype(str).str.strip()
+    resultado = texto.astype(object)
+    vacio = serie.isna() | texto.str.lower().isin(["", "nan"])
+
+    es_float = _mascara_tipo(serie, float) & ~vacio
+    if es_float.any():
+        numeros = serie[es_float].astype(float)
+        en_rango = np.isfinite(numeros) & (numeros.abs() < 2 ** 63)
+        resultado[en_rango.index[en_rango]] = numeros[en_rango].round().astype('int64').astype(str)
+        grandes = en_rango.index[~en_rango & np.isfinite(numeros)]
+        resultado[grandes] = numeros[grandes].map("{:.0f}".format)
+
+    resultado[vacio] = ""
+    return resultado
+
+
+def limpiar_nulos(serie: pd.Series) -> pd.Series:
+    """Convierte a texto sin espacios alrededor y vacía los tokens nulos ('nan', 'None', ...)."""
+    texto = serie.astype(str).str.strip()
+    # Con pandas 3, astype(str) conserva los nulos como NaN en lugar de 'nan'
+    nulo = serie.isna() | texto.str.lower().isin(TOKENS_NULOS)
+    return texto.where(~nulo, "").astype(object)
+
+
+def limpiar_nulo(valor) -> str:
+    """Versión escalar de limpiar_nulos, para código que trabaja fila a fila."""
+    texto = str(valor).strip()
+    return "" if texto.lower() in TOKENS_NULOS else texto
+
+
+# ---------------------------------------------------------------------------
+# Esquema tipado de la hoja de validación
+# ---------------------------------------------------------------------------
+
+# Solo columnas con un conjunto pequeño y conocido de valores; el texto libre queda como object
+COLUMNAS_CATEGORIA = ["Currency"]
+COLUMNAS_TEXTO_LIBRE = ["Observaciones"]
+COLUMNAS_MONTO = [
+    "Gross", "Fee", "Net", "Prorrateo Disputa", "Prorrateo Normal", "Neto despues de prorrateo",
+    "Flete", "Valor mcia", "Valoración flete", "Diferencia",
+]
+COLUMNAS_ID = ["Order Id Paypal", "Invoice Numbers", "Número guía"]
+COLUMNAS_FECHA = ["Date", "Fecha del envío", "Fecha_pago"]
+
+# Texto respaldado por Arrow cuando pyarrow está instalado (mucho más compacto que object)
+try:
+    import pyarrow  # noqa: F401
+    TIPO_TEXTO = "string[pyarrow]"
+except ImportError:
+    TIPO_TEXTO = "string"
+
+
+def _es_vacio(serie: pd.Series) -> pd.Series:
+    return serie.isna() | (serie.astype(str).str.strip() == "")
+
+
+def tipar_montos(serie: pd.Series) -> pd.Series:
+    """float64 si todos los valores no vacíos son numéricos; si hay texto se deja como está"""
+    if pd.api.types.is_float_dtype(serie):
+        return serie
+    numeros = pd.to_numeric(serie, errors='coerce')
+    if (numeros.isna() & ~_es_vacio(serie)).any():
+        return serie
+    return numeros.astype('float64')
+
+
+def tipar_fechas(serie: pd.Series, clave: Optional[str] = None) -> pd.Series:
+    """datetime64 si todas las fechas se reconocen; si alguna es texto libre se deja formateada dd/mm/aaaa"""
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie
+    texto = formatear_fechas(serie, clave=clave)
+    fechas = pd.to_datetime(texto, format=FORMATO_FECHA_EXCEL, errors='coerce')
+    if (fechas.isna() & (texto != "")).any():
+        return texto
+    return fechas
+
+
+def aplicar_esquema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convierte (en el mismo DataFrame) las columnas de la hoja de validación a tipos compactos:
+    categorías para Currency, object para Observaciones (nulos como None), float64 para
+    montos, "string" para IDs (vacíos como "") y datetime64 para fechas. Las conversiones que perderían datos
+    (texto en un monto o en una fecha) se omiten y la columna se queda como estaba.
+    """
+    for col in df.columns.intersection(COLUMNAS_CATEGORIA):
+        if not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    for col in df.columns.intersection(COLUMNAS_TEXTO_LIBRE):
+        serie = df[col].astype(object)
+        df[col] = serie.where(serie.notna(), None)
+    for col in df.columns.intersection(COLUMNAS_MONTO):
+        df[col] = tipar_montos(df[col])
+    for col in df.columns.intersection(COLUMNAS_ID):
+        df[col] = limpiar_nulos(df[col]).astype(TIPO_TEXTO)
+    for col in df.columns.intersection(COLUMNAS_FECHA):
+        df[col] = tipar_fechas(df[col], clave=col)
+    return df
+
+
+def preparar_para_excel(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Vista para escribir en Excel: fechas como texto dd/mm/aaaa, categorías como objetos
+    (vacíos como None) e IDs como texto. Solo se copian las columnas que cambian de tipo.
+    """
+    columnas = {}
+    for col in df.columns:
+        serie = df[col]
+        if col in COLUMNAS_FECHA:
+            columnas[col] = formatear_fechas(serie, clave=col)
+        elif isinstance(serie.dtype, pd.CategoricalDtype):
+            columnas[col] = serie.astype(object).where(serie.notna(), None)
+        elif col in COLUMNAS_ID:
+            columnas[col] = limpiar_nulos(serie)
+    return df.assign(**columnas) if columnas else df
+
+
+def asignar_valor(df: pd.DataFrame, indice, columna: str, valor) -> None:
+    """df.at[indice, columna] = valor, agregando la categoría si la columna es categórica"""
+    serie = df[columna]
+    if (isinstance(serie.dtype, pd.CategoricalDtype) and valor is not None
+            and valor not in serie.cat.categories):
+        df[columna] = serie.cat.add_categories([valor])
+    df.at[indice, columna] = valor
@@ -0,0 +1,859 @@
+"""
+PAQUETE EXCEL - PayPal
+Edición de libros .xlsx/.xlsm como paquete zip: solo se reescribe la parte XML de una
+hoja (completa o algunas de sus celdas) y, si hace falta, styles.xml; el resto de partes
+(otras hojas, macros, dibujos, controles, tablas dinámicas) se copian sin tocarlas.
+openpyxl, al cargar y guardar un libro completo, descarta parte de ese contenido y
+reescribe hojas que no cambiaron.
+"""
+
+import copy
+import numbers
+import os
+import posixpath
+import re
+import shutil
+import zipfile
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, Optional, Union
+from xml.sax.saxutils import escape, quoteattr
+
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, to_excel
+
+NS_PRINCIPAL = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+NS_RELACIONES = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+NS_PAQUETE_RELACIONES = "http://schemas.openxmlformats.org/package/2006/relationships"
+NS_TIPOS = "http://schemas.openxmlformats.org/package/2006/content-types"
+REL_LIBRO = NS_RELACIONES + "/officeDocument"
+REL_PROPIEDADES = NS_RELACIONES + "/extended-properties"
+REL_HOJA = NS_RELACIONES + "/worksheet"
+REL_ESTILOS = NS_RELACIONES + "/styles"
+REL_CADENAS = NS_RELACIONES + "/sharedStrings"
+REL_CALCULO = NS_RELACIONES + "/calcChain"
+TIPO_HOJA = "application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"
+
+# Contenido de una parte reemplazada: bytes, o una función (origen, destino) que la
+# transforma en streaming (origen es None si la parte es nueva)
+Contenido = Union[bytes, Callable]
+
+
+def _local(etiqueta: str) -> str:
+    return etiqueta.rsplit("}", 1)[-1]
+
+
+def _ns(etiqueta: str) -> str:
+    return etiqueta[1:].split("}", 1)[0] if etiqueta.startswith("{") else ""
+
+
+def _resolver(base: str, destino: str) -> str:
+    """Ruta de una parte a partir del Target de una relación (relativo a `base` o absoluto)"""
+    if destino.startswith("/"):
+        return destino[1:]
+    return posixpath.normpath(posixpath.join(base, destino))
+
+
+def _relaciones(zf: zipfile.ZipFile, parte: str) -> list:
+    """[(Id, Type, ruta de la parte destino)] de las relaciones de `parte`"""
+    carpeta = posixpath.dirname(parte)
+    if ruta_rels(parte) not in zf.NameToInfo:
+        return []
+    raiz = ET.fromstring(zf.read(ruta_rels(parte)))
+    return [(rel.get("Id"), rel.get("Type"), _resolver(carpeta, rel.get("Target", "")))
+            for rel in raiz if rel.get("TargetMode") != "External"]
+
+
+def ruta_rels(parte: str) -> str:
+    """Parte .rels con las relaciones de `parte` (p. ej. xl/_rels/workbook.xml.rels)"""
+    carpeta, nombre = posixpath.split(parte)
+    return posixpath.join(carpeta, "_rels", nombre + ".rels")
+
+
+def parte_libro(zf: zipfile.ZipFile) -> str:
+    """Ruta de workbook.xml según _rels/.rels (normalmente xl/workbook.xml)"""
+    for _, tipo, ruta in _relaciones(zf, ""):
+        if tipo == REL_LIBRO:
+            return ruta
+    return "xl/workbook.xml"
+
+
+def parte_relacionada(zf: zipfile.ZipFile, tipo: str, parte: Optional[str] = None) -> Optional[str]:
+    """Primera parte relacionada con `parte` (por defecto el libro) por una relación del tipo indicado"""
+    for _, tipo_rel, ruta in _relaciones(zf, parte_libro(zf) if parte is None else parte):
+        if tipo_rel == tipo:
+            return ruta
+    return None
+
+
+def hojas(zf: zipfile.ZipFile) -> Dict[str, str]:
+    """{nombre de hoja: ruta de su parte XML}, en el orden del libro"""
+    libro = parte_libro(zf)
+    destinos = {id_rel: ruta for id_rel, _, ruta in _relaciones(zf, libro)}
+    raiz = ET.fromstring(zf.read(libro))
+    resultado = {}
+    for hoja in raiz.iter(f"{{{NS_PRINCIPAL}}}sheet"):
+        id_rel = hoja.get(f"{{{NS_RELACIONES}}}id")
+        if id_rel in destinos:
+            resultado[hoja.get("name")] = destinos[id_rel]
+    return resultado
+
+
+def reescribir_paquete(archivo: Path, reemplazos: Dict[str, Contenido],
+                       eliminar: Iterable[str] = (), finales: Optional[Dict[str, Callable]] = None) -> None:
+    """
+    Reescribe `archivo` cambiando solo las partes indicadas:
+    - `reemplazos`: parte -> bytes nuevos, o función (origen, destino) que la transforma
+      en streaming; las partes que no existen se agregan al final.
+    - `eliminar`: partes que se quitan del paquete.
+    - `finales`: parte -> función sin argumentos que se llama después de escribir todo
+      lo demás y retorna los bytes nuevos (o None para dejar la parte como estaba).
+    El resto de partes se copia sin modificar su contenido. Se escribe un temporal
+    junto al archivo que lo reemplaza al final; el temporal nunca queda en disco.
+    """
+    finales = finales or {}
+    eliminar = set(eliminar)
+    temporal = archivo.with_name(f"~tmp_{archivo.name}")
+    try:
+        with zipfile.ZipFile(archivo) as origen, \
+                zipfile.ZipFile(temporal, "w", zipfile.ZIP_DEFLATED) as destino:
+            fecha = origen.infolist()[0].date_time if origen.infolist() else (1980, 1, 1, 0, 0, 0)
+            diferidas = []
+            for info in origen.infolist():
+                if info.filename in eliminar:
+                    continue
+                if info.filename in finales:
+                    diferidas.append(info)
+                    continue
+                _escribir_parte(origen, destino, info, reemplazos.get(info.filename))
+
+            for nombre, contenido in reemplazos.items():
+                if nombre not in origen.NameToInfo:
+                    _escribir_parte(origen, destino, zipfile.ZipInfo(nombre, fecha), contenido)
+
+            for info in diferidas:
+                _escribir_parte(origen, destino, info, finales[info.filename]())
+
+        os.replace(temporal, archivo)
+    finally:
+        if temporal.exists():
+            temporal.unlink()
+
+
+def _escribir_parte(origen: zipfile.ZipFile, destino: zipfile.ZipFile, info: zipfile.ZipInfo,
+                    contenido: Optional[Contenido]) -> None:
+    existe = info.filename in origen.NameToInfo
+    nueva = zipfile.ZipInfo(info.filename, info.date_time)
+    nueva.compress_type = info.compress_type if existe else zipfile.ZIP_DEFLATED
+    nueva.external_attr = info.external_attr
+    if isinstance(contenido, bytes):
+        destino.writestr(nueva, contenido)
+        return
+    # Tamaño original como referencia para decidir ZIP64 en partes grandes
+    nueva.file_size = info.file_size
+    with destino.open(nueva, "w") as salida:
+        if contenido is None:
+            with origen.open(info) as entrada:
+                shutil.copyfileobj(entrada, salida, 1 << 20)
+        elif existe:
+            with origen.open(info) as entrada:
+                contenido(entrada, salida)
+        else:
+            contenido(None, salida)
+
+
+def _xml(raiz: ET.Element, ns: str) -> bytes:
+    """Serializa una parte plana de un solo espacio de nombres (.rels, [Content_Types].xml)"""
+    hijos = "".join(f"<{_local(hijo.tag)}" + "".join(f" {k}={quoteattr(v)}" for k, v in hijo.attrib.items())
+                    + "/>" for hijo in raiz)
+    etiqueta = _local(raiz.tag)
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<{etiqueta} xmlns="{ns}">{hijos}</{etiqueta}>').encode("utf-8")
+
+
+# ---------------------------------------------------------------------------
+# Transformación de una hoja en streaming
+# ---------------------------------------------------------------------------
+
+BLOQUE_HOJA = 1 << 20
+
+
+class TransformacionHoja:
+    """
+    Transforma en streaming el XML de una hoja. Se lee por bloques cortados después de
+    un fin de fila, así cada fila (y cada elemento fuera de sheetData) llega entero a
+    `transformar` y la memoria no depende del tamaño de la hoja. Por defecto se aplica
+    `_fila` a cada <row>; las subclases la redefinen.
+    """
+
+    patron_fila = None
+
+    def __call__(self, origen, destino) -> None:
+        resto = b""
+        while True:
+            bloque = origen.read(BLOQUE_HOJA)
+            datos = resto + bloque
+            if self.patron_fila is None:
+                self._preparar(datos)
+            if not bloque:
+                destino.write(self.transformar(datos))
+                break
+            corte = datos.rfind(self.cierre_fila)
+            if corte < 0:
+                resto = datos
+                continue
+            corte += len(self.cierre_fila)
+            destino.write(self.transformar(datos[:corte]))
+            resto = datos[corte:]
+
+    def _preparar(self, inicio: bytes) -> None:
+        """Patrones de fila y celda con el prefijo de espacio de nombres de la hoja"""
+        encontrado = re.search(rb"<(\w+:)?worksheet\b", inicio)
+        self.prefijo = (encontrado.group(1) or b"") if encontrado else b""
+        p = re.escape(self.prefijo)
+        self.cierre_fila = b"</" + self.prefijo + b"row>"
+        self.patron_fila = re.compile(rb"<" + p + rb"row\b([^>]*?)(/>|>(.*?)</" + p + rb"row>)", re.S)
+        self.patron_celda = re.compile(rb"<" + p + rb"c\b([^>]*?)(?:/>|>(.*?)</" + p + rb"c>)", re.S)
+        self.formula = b"<" + self.prefijo + b"f"
+        self.fila = 0
+
+    def transformar(self, bloque: bytes) -> bytes:
+        return self.patron_fila.sub(self._fila, bloque)
+
+    def _fila(self, m) -> bytes:
+        return m.group(0)
+
+    def _numero_fila(self, atributos: bytes) -> int:
+        """Número de la fila actual (atributo r, o la siguiente si no lo declara)"""
+        numero = re.search(rb'\br="(\d+)"', atributos)
+        self.fila = int(numero.group(1)) if numero else self.fila + 1
+        return self.fila
+
+    def _celdas(self, contenido: bytes):
+        """(columna base 1, coincidencia) de cada celda de una fila"""
+        columna = 0
+        for celda in self.patron_celda.finditer(contenido):
+            referencia = re.search(rb'\br="([A-Z]+)\d+"', celda.group(1))
+            columna = column_index_from_string(referencia.group(1).decode()) if referencia else columna + 1
+            yield columna, celda
+
+    def _etiqueta_fila(self, atributos: bytes, contenido: bytes) -> bytes:
+        return b"<" + self.prefijo + b"row" + atributos + b">" + contenido + b"</" + self.prefijo + b"row>"
+
+
+# ---------------------------------------------------------------------------
+# Estilos
+# ---------------------------------------------------------------------------
+
+def _clave(elemento: ET.Element) -> tuple:
+    """Clave comparable de un elemento de estilos (etiqueta, atributos e hijos)"""
+    return (_local(elemento.tag), tuple(sorted((_local(k), v) for k, v in elemento.attrib.items())),
+            tuple(_clave(hijo) for hijo in elemento if _ns(hijo.tag) == NS_PRINCIPAL))
+
+
+def _serializar(elemento: ET.Element, prefijo: str) -> str:
+    """Elemento del espacio principal como texto XML con el prefijo del libro destino"""
+    etiqueta = prefijo + _local(elemento.tag)
+    atributos = "".join(f" {k}={quoteattr(v)}" for k, v in elemento.attrib.items() if not k.startswith("{"))
+    hijos = "".join(_serializar(hijo, prefijo) for hijo in elemento if _ns(hijo.tag) == NS_PRINCIPAL)
+    texto = escape(elemento.text or "")
+    if not hijos and not texto:
+        return f"<{etiqueta}{atributos}/>"
+    return f"<{etiqueta}{atributos}>{texto}{hijos}</{etiqueta}>"
+
+
+class EstilosLibro:
+    """
+    styles.xml de un libro. Permite agregar formatos de celda (con sus fuentes, rellenos,
+    bordes y formatos numéricos) sin renumerar ni reescribir los existentes; lo que ya
+    existe igual se reutiliza, así guardar varias veces no hace crecer los estilos.
+    """
+
+    COLECCIONES = ("numFmts", "fonts", "fills", "borders", "cellXfs")
+    # Hijos de styleSheet en el orden del esquema (CT_Stylesheet)
+    ORDEN_ESQUEMA = ("numFmts", "fonts", "fills", "borders", "cellStyleXfs", "cellXfs", "cellStyles",
+                     "dxfs", "tableStyles", "colors", "extLst")
+
+    def __init__(self, xml: bytes):
+        self.texto = xml.decode("utf-8")
+        encontrado = re.search(r"<(\w+:)?styleSheet\b", self.texto)
+        self.prefijo = (encontrado.group(1) or "") if encontrado else ""
+        raiz = ET.fromstring(xml)
+        self.existentes = {coleccion: [] for coleccion in self.COLECCIONES}
+        for hijo in raiz:
+            if _local(hijo.tag) in self.existentes:
+                self.existentes[_local(hijo.tag)] = list(hijo)
+        self.nuevos = {coleccion: [] for coleccion in self.COLECCIONES}
+        self.indices = {coleccion: {} for coleccion in self.COLECCIONES}
+        for coleccion, elementos in self.existentes.items():
+            for indice, elemento in enumerate(elementos):
+                self.indices[coleccion].setdefault(_clave(elemento), indice)
+        self.formatos = {int(fmt.get("numFmtId")): fmt.get("formatCode") for fmt in self.existentes["numFmts"]}
+
+    @property
+    def modificado(self) -> bool:
+        return any(self.nuevos.values())
+
+    def _agregar(self, coleccion: str, elemento: ET.Element) -> int:
+        clave = _clave(elemento)
+        if clave not in self.indices[coleccion]:
+            self.indices[coleccion][clave] = len(self.existentes[coleccion]) + len(self.nuevos[coleccion])
+            self.nuevos[coleccion].append(elemento)
+        return self.indices[coleccion][clave]
+
+    def formato_numerico(self, codigo: str) -> int:
+        """numFmtId del código indicado: integrado, existente o agregado"""
+        for id_formato, existente in list(BUILTIN_FORMATS.items()) + list(self.formatos.items()):
+            if existente == codigo:
+                return id_formato
+        id_formato = max([163, *self.formatos]) + 1
+        self.formatos[id_formato] = codigo
+        self._agregar("numFmts", ET.Element(f"{{{NS_PRINCIPAL}}}numFmt",
+                                            {"numFmtId": str(id_formato), "formatCode": codigo}))
+        return id_formato
+
+    def xf_con_formato(self, indice: int, codigo: str) -> int:
+        """Índice de un formato de celda igual al `indice` pero con el formato numérico `codigo`"""
+        xfs = self.existentes["cellXfs"] + self.nuevos["cellXfs"]
+        id_formato = self.formato_numerico(codigo)
+        if indice < len(xfs):
+            if int(xfs[indice].get("numFmtId", 0)) == id_formato:
+                return indice
+            nuevo = copy.deepcopy(xfs[indice])
+        else:
+            nuevo = ET.Element(f"{{{NS_PRINCIPAL}}}xf", {"fontId": "0", "fillId": "0", "borderId": "0", "xfId": "0"})
+        nuevo.set("numFmtId", str(id_formato))
+        nuevo.set("applyNumberFormat", "1")
+        return self._agregar("cellXfs", nuevo)
+
+    def incorporar(self, xml_origen: bytes) -> Dict[int, int]:
+        """
+        Agrega los formatos de celda de otro styles.xml y retorna {índice origen: índice aquí}.
+        Los elementos por defecto del origen (fuente, relleno y borde 0, formato de celda 0)
+        se asimilan a los por defecto de este libro.
+        """
+        raiz = ET.fromstring(xml_origen)
+        origen = {_local(hijo.tag): list(hijo) for hijo in raiz}
+        formatos_origen = {int(fmt.get("numFmtId")): fmt.get("formatCode") for fmt in origen.get("numFmts", [])}
+        por_defecto = {"fonts": 1, "fills": 2, "borders": 1}
+
+        def mapear(coleccion: str, indice: str) -> str:
+            indice = int(indice or 0)
+            if indice < por_defecto[coleccion]:
+                return str(indice)
+            return str(self._agregar(coleccion, origen[coleccion][indice]))
+
+        mapa = {0: 0}
+        for indice, xf in enumerate(origen.get("cellXfs", [])):
+            if indice == 0:
+                continue
+            nuevo = copy.deepcopy(xf)
+            nuevo.set("fontId", mapear("fonts", xf.get("fontId")))
+            nuevo.set("fillId", mapear("fills", xf.get("fillId")))
+            nuevo.set("borderId", mapear("borders", xf.get("borderId")))
+            id_formato = int(xf.get("numFmtId", 0))
+            if id_formato in formatos_origen:
+                id_formato = self.formato_numerico(formatos_origen[id_formato])
+            nuevo.set("numFmtId", str(id_formato))
+            nuevo.set("xfId", "0")
+            mapa[indice] = self._agregar("cellXfs", nuevo)
+        return mapa
+
+    def serializar(self) -> bytes:
+        """
+        styles.xml con los elementos nuevos al final de cada colección (el resto, igual).
+        Una colección que no existía se crea en su lugar según el orden del esquema.
+        """
+        texto, p = self.texto, self.prefijo
+        for coleccion in self.COLECCIONES:
+            nuevos = self.nuevos[coleccion]
+            if not nuevos:
+                continue
+            contenido = "".join(_serializar(elemento, p) for elemento in nuevos)
+            total = len(self.existentes[coleccion]) + len(nuevos)
+            apertura = self._apertura(texto, coleccion)
+            if apertura is None:
+                posicion = self._posicion_coleccion(texto, coleccion)
+                texto = (texto[:posicion] + f'<{p}{coleccion} count="{total}">{contenido}</{p}{coleccion}>'
+                         + texto[posicion:])
+                continue
+            etiqueta = re.sub(r'\s*/?>$', '', apertura.group(0))
+            etiqueta = (re.sub(r'\bcount="\d*"', f'count="{total}"', etiqueta) if 'count="' in etiqueta
+                        else f'{etiqueta} count="{total}"')
+            if apertura.group(1):
+                texto = (texto[:apertura.start()] + f"{etiqueta}>{contenido}</{p}{coleccion}>"
+                         + texto[apertura.end():])
+            else:
+                cierre = texto.index(f"</{p}{coleccion}>", apertura.end())
+                texto = (texto[:apertura.start()] + etiqueta + ">" + texto[apertura.end():cierre]
+                         + contenido + texto[cierre:])
+        return texto.encode("utf-8")
+
+    def _apertura(self, texto: str, coleccion: str):
+        return re.search(rf"<{re.escape(self.prefijo)}{coleccion}\b[^>]*?(/?)>", texto)
+
+    def _posicion_coleccion(self, texto: str, coleccion: str) -> int:
+        """Posición donde va una colección nueva: antes del primer hijo que la sigue en el esquema"""
+        for siguiente in self.ORDEN_ESQUEMA[self.ORDEN_ESQUEMA.index(coleccion) + 1:]:
+            apertura = self._apertura(texto, siguiente)
+            if apertura is not None:
+                return apertura.start()
+        return texto.rindex(f"</{self.prefijo}styleSheet>")
+
+
+# ---------------------------------------------------------------------------
+# Reemplazo de una hoja completa
+# ---------------------------------------------------------------------------
+
+_CELDA = re.compile(rb'<c\b([^>]*?)(/>|>(.*?)</c>)', re.S)
+_ESTILO = re.compile(rb'\b(s|style)="(\d+)"')
+
+
+def _texto_compartido(si: ET.Element) -> str:
+    return "".join(t.text or "" for t in si.iter(f"{{{NS_PRINCIPAL}}}t"))
+
+
+def _texto_en_linea(texto: str) -> bytes:
+    espacio = ' xml:space="preserve"' if texto != texto.strip() else ""
+    return f"<is><t{espacio}>{escape(texto)}</t></is>".encode("utf-8")
+
+
+class _Trasplante(TransformacionHoja):
+    """
+    XML de la primera hoja de `libro_hoja` (un libro de una sola hoja) preparado para otro
+    libro, en streaming: sus formatos se incorporan a `estilos`, los textos compartidos
+    pasan a texto en línea (el sharedStrings.xml destino no se toca) y la hoja no queda
+    seleccionada. La parte que reemplaza en el destino no se lee.
+    """
+
+    def __init__(self, libro_hoja: Path, estilos: EstilosLibro):
+        self.libro_hoja = libro_hoja
+        with zipfile.ZipFile(libro_hoja) as zf:
+            self.ruta = next(iter(hojas(zf).values()))
+            ruta_estilos = parte_relacionada(zf, REL_ESTILOS)
+            self.mapa = estilos.incorporar(zf.read(ruta_estilos)) if ruta_estilos else {0: 0}
+            ruta_cadenas = parte_relacionada(zf, REL_CADENAS)
+            self.cadenas = ([_texto_compartido(si) for si in ET.fromstring(zf.read(ruta_cadenas))]
+                            if ruta_cadenas else [])
+
+    def __call__(self, origen, destino) -> None:
+        with zipfile.ZipFile(self.libro_hoja) as zf, zf.open(self.ruta) as entrada:
+            super().__call__(entrada, destino)
+
+    def transformar(self, bloque: bytes) -> bytes:
+        bloque = _CELDA.sub(self._celda, bloque)
+        bloque = re.sub(rb"<(row|col)\b[^>]*>", lambda m: _ESTILO.sub(self._estilo, m.group(0)), bloque)
+        return re.sub(rb'\s*\btabSelected="1"', b"", bloque)
+
+    def _estilo(self, m) -> bytes:
+        return m.group(1) + b'="' + str(self.mapa.get(int(m.group(2)), 0)).encode() + b'"'
+
+    def _celda(self, m) -> bytes:
+        atributos, cuerpo = _ESTILO.sub(self._estilo, m.group(1)), m.group(3)
+        if cuerpo is not None and re.search(rb'\bt="s"', atributos):
+            indice = int(re.search(rb"<v>(\d+)</v>", cuerpo).group(1))
+            atributos = re.sub(rb'\bt="s"', b't="inlineStr"', atributos)
+            return b"<c" + atributos + b">" + _texto_en_linea(self.cadenas[indice]) + b"</c>"
+        return b"<c" + atributos + m.group(2)
+
+
+def reemplazar_hoja(archivo: Path, nombre_hoja: str, libro_hoja: Path) -> None:
+    """
+    Pone en `archivo` la hoja `nombre_hoja` tomada de `libro_hoja` (libro de una sola hoja
+    escrito aparte). Si ya existe se reemplaza su parte en su posición; si no, se agrega
+    al final. Solo cambian esa hoja, styles.xml y, al agregarla, los índices del paquete
+    (workbook.xml, sus relaciones, [Content_Types].xml y docProps/app.xml); el resto se
+    copia tal cual.
+    """
+    with zipfile.ZipFile(archivo) as zf:
+        ruta_estilos = parte_relacionada(zf, REL_ESTILOS)
+        if ruta_estilos is None:
+            raise ValueError(f"{archivo.name} no tiene hoja de estilos (styles.xml)")
+        estilos = EstilosLibro(zf.read(ruta_estilos))
+        trasplante = _Trasplante(libro_hoja, estilos)
+
+        reemplazos: Dict[str, Contenido] = {}
+        eliminar = set()
+        existentes = hojas(zf)
+        if nombre_hoja in existentes:
+            reemplazos[existentes[nombre_hoja]] = trasplante
+            # La cadena de cálculo de Excel apunta a fórmulas de la hoja anterior
+            ruta_calculo = parte_relacionada(zf, REL_CALCULO)
+            if ruta_calculo:
+                eliminar.add(ruta_calculo)
+                reemplazos.update(_quitar_parte(zf, parte_libro(zf), ruta_calculo))
+        else:
+            reemplazos.update(_agregar_hoja(zf, nombre_hoja, trasplante))
+
+        if estilos.modificado:
+            reemplazos[ruta_estilos] = estilos.serializar()
+
+    reescribir_paquete(archivo, reemplazos, eliminar)
+
+
+def _agregar_hoja(zf: zipfile.ZipFile, nombre_hoja: str, contenido: Contenido) -> Dict[str, Contenido]:
+    """Partes nuevas o modificadas para agregar una hoja al final del libro"""
+    libro = parte_libro(zf)
+    carpeta = posixpath.dirname(libro)
+    numero = 1
+    while posixpath.join(carpeta, f"worksheets/sheet{numero}.xml") in zf.NameToInfo:
+        numero += 1
+    ruta_hoja = posixpath.join(carpeta, f"worksheets/sheet{numero}.xml")
+
+    # Relación del libro con la hoja
+    rels = ET.fromstring(zf.read(ruta_rels(libro)))
+    ids = {rel.get("Id") for rel in rels}
+    numero_rel = len(ids) + 1
+    while f"rId{numero_rel}" in ids:
+        numero_rel += 1
+    id_rel = f"rId{numero_rel}"
+    ET.SubElement(rels, f"{{{NS_PAQUETE_RELACIONES}}}Relationship",
+                  {"Id": id_rel, "Type": REL_HOJA, "Target": f"worksheets/sheet{numero}.xml"})
+
+    # Tipo de contenido de la parte nueva
+    tipos = ET.fromstring(zf.read("[Content_Types].xml"))
+    ET.SubElement(tipos, f"{{{NS_TIPOS}}}Override", {"PartName": f"/{ruta_hoja}", "ContentType": TIPO_HOJA})
+
+    # <sheet> al final de <sheets>; workbook.xml se edita como texto para no perder los
+    # espacios de nombres que Excel declara (mc:Ignorable)
+    xml_libro = zf.read(libro).decode("utf-8")
+    p = re.search(r"<(\w+:)?sheets\b", xml_libro).group(1) or ""
+    prefijo_r = re.search(rf'xmlns:(\w+)="{re.escape(NS_RELACIONES)}"', xml_libro).group(1)
+    id_hoja = max([0, *map(int, re.findall(r'\bsheetId="(\d+)"', xml_libro))]) + 1
+    xml_libro = xml_libro.replace(f"</{p}sheets>",
+                                  f'<{p}sheet name={quoteattr(nombre_hoja)} sheetId="{id_hoja}" '
+                                  f'{prefijo_r}:id="{id_rel}"/></{p}sheets>')
+
+    partes = {ruta_hoja: contenido, ruta_rels(libro): _xml(rels, NS_PAQUETE_RELACIONES),
+              libro: xml_libro.encode("utf-8"), "[Content_Types].xml": _xml(tipos, NS_TIPOS)}
+
+    ruta_app = parte_relacionada(zf, REL_PROPIEDADES, "")
+    if ruta_app and ruta_app in zf.NameToInfo:
+        xml_app = _agregar_titulo(zf.read(ruta_app), nombre_hoja, len(hojas(zf)))
+        if xml_app is not None:
+            partes[ruta_app] = xml_app
+    return partes
+
+
+def _agregar_titulo(xml_app: bytes, nombre_hoja: str, hojas_previas: int) -> Optional[bytes]:
+    """
+    docProps/app.xml con la hoja nueva en TitlesOfParts y en la cuenta de hojas de
+    HeadingPairs (el primer par, como lo escribe Excel). Si esa cuenta no coincide con
+    las hojas del libro, ambas listas (opcionales) se quitan para no dejarlas
+    inconsistentes. Retorna None si no hay nada que actualizar.
+    """
+    texto = xml_app.decode("utf-8")
+    pares = re.search(r"<(?:\w+:)?HeadingPairs\b.*?</(?:\w+:)?HeadingPairs>", texto, re.S)
+    titulos = re.search(r"<(?:\w+:)?TitlesOfParts\b.*?</(?:\w+:)?TitlesOfParts>", texto, re.S)
+    if pares is None and titulos is None:
+        return None
+
+    cuenta = re.search(r"<((?:\w+:)?)i4>(\d+)</", pares.group(0)) if pares else None
+    nombres = list(re.finditer(r"<((?:\w+:)?)lpstr>.*?</(?:\w+:)?lpstr>", titulos.group(0), re.S)) if titulos else []
+    if cuenta is None or int(cuenta.group(2)) != hojas_previas or len(nombres) < hojas_previas:
+        for lista in sorted(filter(None, (pares, titulos)), key=lambda m: m.start(), reverse=True):
+            texto = texto[:lista.start()] + texto[lista.end():]
+        return texto.encode("utf-8")
+
+    # Título nuevo después del último título de hoja (los rangos con nombre van detrás)
+    vt = re.search(r"<((?:\w+:)?)vector\b", titulos.group(0)).group(1)
+    posicion = nombres[hojas_previas - 1].end()
+    bloque_titulos = titulos.group(0)[:posicion] + f"<{vt}lpstr>{escape(nombre_hoja)}</{vt}lpstr>" \
+        + titulos.group(0)[posicion:]
+    bloque_titulos = re.sub(r'\bsize="(\d+)"', lambda m: f'size="{int(m.group(1)) + 1}"', bloque_titulos, count=1)
+    bloque_pares = pares.group(0)[:cuenta.start(2)] + str(hojas_previas + 1) + pares.group(0)[cuenta.end(2):]
+
+    for lista, bloque in sorted([(titulos, bloque_titulos), (pares, bloque_pares)],
+                                key=lambda par: par[0].start(), reverse=True):
+        texto = texto[:lista.start()] + bloque + texto[lista.end():]
+    return texto.encode("utf-8")
+
+
+def _quitar_parte(zf: zipfile.ZipFile, parte: str, ruta_destino: str) -> Dict[str, bytes]:
+    """Relaciones de `parte` y [Content_Types].xml sin la parte `ruta_destino`"""
+    carpeta = posixpath.dirname(parte)
+    rels = ET.fromstring(zf.read(ruta_rels(parte)))
+    for rel in list(rels):
+        if rel.get("TargetMode") != "External" and _resolver(carpeta, rel.get("Target", "")) == ruta_destino:
+            rels.remove(rel)
+    tipos = ET.fromstring(zf.read("[Content_Types].xml"))
+    for tipo in list(tipos):
+        if tipo.get("PartName") == f"/{ruta_destino}":
+            tipos.remove(tipo)
+    return {ruta_rels(parte): _xml(rels, NS_PAQUETE_RELACIONES), "[Content_Types].xml": _xml(tipos, NS_TIPOS)}
+
+
+# ---------------------------------------------------------------------------
+# Reordenamiento de columnas
+# ---------------------------------------------------------------------------
+
+_RANGO = re.compile(rb"\$?([A-Z]+)\$?(\d+)(?::\$?([A-Z]+)\$?(\d+))?")
+
+
+class _ReordenColumnas(TransformacionHoja):
+    """
+    Reordena en streaming las columnas de una hoja: `orden` lista, en su nueva posición,
+    las columnas de origen (base 1); las que quedan a la derecha no se mueven. Se reubican
+    las celdas de cada fila (con su estilo), los anchos y estilos de columna (<cols>) y los
+    rangos de la hoja (dimensión, selección, celdas combinadas, filtros). Las fórmulas no
+    se reescriben: si la hoja tiene alguna se lanza ValueError.
+    """
+
+    def __init__(self, orden: list):
+        self.ancho = len(orden)
+        self.nueva = {origen: destino for destino, origen in enumerate(orden, 1)}
+
+    def _preparar(self, inicio: bytes) -> None:
+        super()._preparar(inicio)
+        p = re.escape(self.prefijo)
+        # Las filas se consumen enteras, así los rangos solo se buscan fuera de sheetData
+        self.patron = re.compile(self.patron_fila.pattern + rb"|<" + p + rb"cols>(.*?)</" + p + rb"cols>"
+                                 + rb'|\b(ref|sqref|activeCell|topLeftCell)="([^"]*)"', re.S)
+        self.patron_col = re.compile(rb"<" + p + rb"col\b([^>]*?)/>")
+
+    def transformar(self, bloque: bytes) -> bytes:
+        return self.patron.sub(self._elemento, bloque)
+
+    def _elemento(self, m) -> bytes:
+        if m.group(4) is not None:
+            return self._columnas(m.group(4))
+        if m.group(5) is not None:
+            rangos = b" ".join(r for rango in m.group(6).split() for r in self._rango(rango, m.group(5) == b"sqref"))
+            return m.group(5) + b'="' + rangos + b'"'
+        return self._fila(m)
+
+    def _fila(self, m) -> bytes:
+        atributos, contenido = m.group(1), m.group(3)
+        fila = self._numero_fila(atributos)
+        if contenido is None:
+            return m.group(0)
+        celdas, resto, fin = [], [], 0
+        for columna, celda in self._celdas(contenido):
+            if celda.group(2) is not None and self.formula in celda.group(2):
+                raise ValueError(f"La fila {fila} tiene fórmulas; no se pueden reordenar sus columnas")
+            resto.append(contenido[fin:celda.start()].strip())
+            fin = celda.end()
+            nueva = self.nueva.get(columna, columna)
+            atributos_celda = re.sub(rb'\s*\br="[^"]*"', b"", celda.group(1))
+            cuerpo = celda.group(0)[len(self.prefijo) + 2 + len(celda.group(1)):]
+            celdas.append((nueva, b"<" + self.prefijo + b'c r="' + f"{get_column_letter(nueva)}{fila}".encode()
+                           + b'"' + atributos_celda + cuerpo))
+        if not celdas:
+            return m.group(0)
+        celdas.sort(key=lambda celda: celda[0])
+        spans = b'spans="%d:%d"' % (celdas[0][0], celdas[-1][0])
+        atributos = re.sub(rb'\bspans="[^"]*"', spans, atributos)
+        return self._etiqueta_fila(atributos, b"".join(c for _, c in celdas) + b"".join(resto) + contenido[fin:])
+
+    def _columnas(self, contenido: bytes) -> bytes:
+        """<cols> con cada columna movida a su nueva posición (los tramos a la derecha no cambian)"""
+        columnas = []
+        for col in self.patron_col.finditer(contenido):
+            minimo = int(re.search(rb'\bmin="(\d+)"', col.group(1)).group(1))
+            maximo = int(re.search(rb'\bmax="(\d+)"', col.group(1)).group(1))
+            atributos = re.sub(rb'\s*\b(min|max)="\d+"', b"", col.group(1))
+            for columna in range(minimo, min(maximo, self.ancho) + 1):
+                columnas.append((self.nueva.get(columna, columna),) * 2 + (atributos,))
+            if maximo > self.ancho:
+                columnas.append((max(minimo, self.ancho + 1), maximo, atributos))
+        p = self.prefijo
+        return (b"<" + p + b"cols>"
+                + b"".join(b"<" + p + b'col min="%d" max="%d"' % (a, b) + atributos + b"/>"
+                           for a, b, atributos in sorted(columnas))
+                + b"</" + p + b"cols>")
+
+    def _rango(self, rango: bytes, dividir: bool) -> list:
+        """
+        Rango con sus columnas reubicadas. Si dejan de ser contiguas, en sqref se divide
+        en tramos y en ref se usa el rango que las contiene.
+        """
+        partes = _RANGO.fullmatch(rango)
+        if partes is None:
+            return [rango]
+        inicio = column_index_from_string(partes.group(1).decode())
+        fin = column_index_from_string((partes.group(3) or partes.group(1)).decode())
+        filas = (partes.group(2), partes.group(4) or partes.group(2))
+        columnas = sorted(self.nueva.get(c, c) for c in range(inicio, fin + 1))
+        tramos = [[columnas[0], columnas[0]]]
+        for columna in columnas[1:]:
+            if columna == tramos[-1][1] + 1:
+                tramos[-1][1] = columna
+            else:
+                tramos.append([columna, columna])
+        if not dividir:
+            tramos = [[columnas[0], columnas[-1]]]
+
+        resultado = []
+        for a, b in tramos:
+            celda_a = get_column_letter(a).encode() + filas[0]
+            celda_b = get_column_letter(b).encode() + filas[1]
+            resultado.append(celda_a if partes.group(3) is None else celda_a + b":" + celda_b)
+        return resultado
+
+
+def reordenar_columnas(archivo: Path, nombre_hoja: str, orden: list) -> None:
+    """
+    Reordena las columnas de la hoja `nombre_hoja`: `orden` lista, en su nueva posición,
+    las columnas actuales (base 1). Solo se reescribe el XML de esa hoja, en streaming;
+    estilos, anchos, textos compartidos y el resto del libro no cambian.
+    """
+    with zipfile.ZipFile(archivo) as zf:
+        existentes = hojas(zf)
+    if nombre_hoja not in existentes:
+        raise ValueError(f"{archivo.name} no tiene la hoja '{nombre_hoja}'")
+    reescribir_paquete(archivo, {existentes[nombre_hoja]: _ReordenColumnas(orden)})
+
+
+# ---------------------------------------------------------------------------
+# Actualización de celdas sueltas
+# ---------------------------------------------------------------------------
+
+# Hijos de workbook que van después de calcPr, en el orden del esquema
+_DESPUES_DE_CALCPR = ("oleSize", "customWorkbookViews", "pivotCaches", "smartTagPr", "smartTagTypes",
+                      "webPublishing", "fileRecoveryPr", "webPublishObjects", "extLst")
+
+
+class _ParcheHoja(TransformacionHoja):
+    """Escribe en streaming los valores de `cambios` ({fila: {columna: valor}}, base 1) en una hoja"""
+
+    def __init__(self, cambios: Dict[int, Dict[int, object]], estilos: EstilosLibro,
+                 epoca: datetime, formato_fecha: str):
+        self.cambios = cambios
+        self.estilos = estilos
+        self.epoca = epoca
+        self.formato_fecha = formato_fecha
+        self.escritas: Dict[int, int] = {}
+
+    def __call__(self, origen, destino) -> None:
+        super().__call__(origen, destino)
+        faltantes = sorted(set(self.cambios) - set(self.escritas))
+        if faltantes:
+            raise ValueError(f"La hoja no tiene las filas {faltantes[:10]}")
+
+    def _fila(self, m) -> bytes:
+        atributos, contenido = m.group(1), m.group(3) or b""
+        nuevos = self.cambios.get(self._numero_fila(atributos))
+        if nuevos is None:
+            return m.group(0)
+
+        partes, escritas, fin_celdas = [], 0, 0
+        pendientes = sorted(nuevos)
+        for columna, celda in self._celdas(contenido):
+            partes.append(contenido[fin_celdas:celda.start()])
+            while pendientes and pendientes[0] < columna:
+                partes.append(self._celda(pendientes.pop(0), nuevos, b""))
+                escritas += 1
+            if pendientes and pendientes[0] == columna:
+                pendientes.pop(0)
+                # Las celdas con fórmula no se sobrescriben
+                if celda.group(2) is not None and self.formula in celda.group(2):
+                    partes.append(celda.group(0))
+                else:
+                    partes.append(self._celda(columna, nuevos, celda.group(1)))
+                    escritas += 1
+            else:
+                partes.append(celda.group(0))
+            fin_celdas = celda.end()
+        for columna in pendientes:
+            partes.append(self._celda(columna, nuevos, b""))
+            escritas += 1
+        partes.append(contenido[fin_celdas:])
+
+        self.escritas[self.fila] = escritas
+        return self._etiqueta_fila(self._ajustar_spans(atributos, nuevos), b"".join(partes))
+
+    def _celda(self, columna: int, nuevos: dict, atributos: bytes) -> bytes:
+        """Celda con el valor nuevo; conserva el estilo y los atributos que no dependen del valor"""
+        valor = nuevos[columna]
+        estilo = re.search(rb'\bs="(\d+)"', atributos)
+        estilo = int(estilo.group(1)) if estilo else 0
+        otros = re.sub(rb'\s*\b(r|s|t|vm|cm)="[^"]*"', b"", atributos).strip()
+
+        tipo, cuerpo = None, b""
+        if isinstance(valor, bool):
+            tipo, cuerpo = b"b", b"<v>%d</v>" % valor
+        elif isinstance(valor, (datetime, date)):
+            estilo = self.estilos.xf_con_formato(estilo, self.formato_fecha)
+            cuerpo = b"<v>" + repr(to_excel(valor, self.epoca)).encode() + b"</v>"
+        elif isinstance(valor, numbers.Number):
+            cuerpo = b"<v>" + repr(valor).encode() + b"</v>"
+        elif valor is not None:
+            tipo, cuerpo = b"inlineStr", _texto_en_linea(str(valor))
+
+        celda = b"<" + self.prefijo + b'c r="' + f"{get_column_letter(columna)}{self.fila}".encode() + b'"'
+        if estilo:
+            celda += b' s="%d"' % estilo
+        if tipo:
+            celda += b' t="' + tipo + b'"'
+        if otros:
+            celda += b" " + otros
+        if not cuerpo:
+            return celda + b"/>"
+        return celda + b">" + cuerpo + b"</" + self.prefijo + b"c>"
+
+    @staticmethod
+    def _ajustar_spans(atributos: bytes, nuevos: dict) -> bytes:
+        """Amplía el rango de columnas declarado de la fila (spans) si se agregan celdas fuera de él"""
+        spans = re.search(rb'\bspans="(\d+):(\d+)"', atributos)
+        if not spans:
+            return atributos
+        minimo = min(int(spans.group(1)), *nuevos)
+        maximo = max(int(spans.group(2)), *nuevos)
+        return atributos[:spans.start()] + b'spans="%d:%d"' % (minimo, maximo) + atributos[spans.end():]
+
+
+def _recalcular_al_abrir(xml_libro: bytes) -> Optional[bytes]:
+    """workbook.xml con fullCalcOnLoad, para que Excel recalcule las fórmulas al abrir (None si ya está)"""
+    texto = xml_libro.decode("utf-8")
+    p = re.search(r"<(\w+:)?workbook\b", texto).group(1) or ""
+    calculo = re.search(rf"<{re.escape(p)}calcPr\b[^>]*?/?>", texto)
+    if calculo:
+        etiqueta = calculo.group(0)
+        if re.search(r'\bfullCalcOnLoad="(1|true)"', etiqueta):
+            return None
+        etiqueta = re.sub(r'\s*\bfullCalcOnLoad="[^"]*"', "", etiqueta)
+        etiqueta = re.sub(r"\s*(/?>)$", r' fullCalcOnLoad="1"\1', etiqueta)
+        return (texto[:calculo.start()] + etiqueta + texto[calculo.end():]).encode("utf-8")
+
+    nuevo = f'<{p}calcPr fullCalcOnLoad="1"/>'
+    siguiente = re.search(rf"<{re.escape(p)}({'|'.join(_DESPUES_DE_CALCPR)})\b", texto)
+    posicion = siguiente.start() if siguiente else texto.rindex(f"</{p}workbook>")
+    return (texto[:posicion] + nuevo + texto[posicion:]).encode("utf-8")
+
+
+def actualizar_celdas(archivo: Path, nombre_hoja: str, cambios: Dict[int, Dict[int, object]],
+                      formato_fecha: str = "DD/MM/YYYY", recalcular: bool = True) -> Dict[int, int]:
+    """
+    Escribe en la hoja `nombre_hoja` los valores de `cambios` ({fila: {columna: valor}}, base 1)
+    modificando solo esas celdas: el XML de la hoja se transforma en streaming y el resto del
+    paquete se copia tal cual. Los textos se escriben en línea, los números como valor y las
+    fechas como número de serie con `formato_fecha` (sobre el estilo que ya tenía la celda).
+    Las celdas con fórmula no se tocan. Con `recalcular`, Excel recalcula las fórmulas al abrir.
+    Retorna {fila: celdas escritas}; si alguna fila no existe en la hoja lanza ValueError.
+    """
+    with zipfile.ZipFile(archivo) as zf:
+        existentes = hojas(zf)
+        if nombre_hoja not in existentes:
+            raise ValueError(f"{archivo.name} no tiene la hoja '{nombre_hoja}'")
+        ruta_estilos = parte_relacionada(zf, REL_ESTILOS)
+        if ruta_estilos is None:
+            raise ValueError(f"{archivo.name} no tiene hoja de estilos (styles.xml)")
+        estilos = EstilosLibro(zf.read(ruta_estilos))
+        libro = parte_libro(zf)
+        xml_libro = zf.read(libro)
+
+    fecha1904 = re.search(rb'\bdate1904="(1|true)"', xml_libro) is not None
+    parche = _ParcheHoja(cambios, estilos, CALENDAR_MAC_1904 if fecha1904 else CALENDAR_WINDOWS_1900,
+                         formato_fecha)
+    reemplazos: Dict[str, Contenido] = {existentes[nombre_hoja]: parche}
+    if recalcular:
+        recalculado = _recalcular_al_abrir(xml_libro)
+        if recalculado is not None:
+            reemplazos[libro] = recalculado
+
+    # Los estilos se escriben al final: el parche agrega el formato de fecha al recorrer la hoja
+    finales = {ruta_estilos: lambda: estilos.serializar() if estilos.modificado else None}
+    reescribir_paquete(archivo, reemplazos, finales=finales)
+    return parche.escritas
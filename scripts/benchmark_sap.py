@@ -0,0 +1,110 @@
+"""
+BENCHMARK DE LA DESCARGA DE SAP - PayPal
+Recorre la WebGUI simulada (scripts/mock_sap_webgui.py) con la máquina de estados de
+DescargadorSAP, incluida la descarga real del .xlsx, y mide cada paso. Compara el
+perfil estándar de Chrome con el perfil ligero (Config.PERFIL_SAP_LIGERO).
+
+Uso (desde la raíz del proyecto):
+    python scripts/benchmark_sap.py --repeticiones 5 --latencia 0.3 --latencia-recursos 0.5
+    python scripts/benchmark_sap.py --perfil ligero --latencia-lista 3 --filas 20000
+
+Muestra la mediana de cada fase (arranque de Chrome, carga de la URL y cada paso)
+por perfil, y la mejora del perfil ligero cuando se miden los dos.
+
+El perfil ligero usa el user-data-dir persistente perfil_chrome_sap, que Chrome
+bloquea mientras está abierto: no ejecutar el benchmark mientras la aplicación
+descarga de SAP desde la misma carpeta, porque el segundo Chrome no arranca.
+Las repeticiones se ejecutan una tras otra, así que entre ellas no hay conflicto.
+"""
+
+import argparse
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from main import Config, DescargadorSAP  # noqa: E402
+from scripts.mock_sap_webgui import iniciar_servidor  # noqa: E402
+
+PERFILES = {"estandar": False, "ligero": True}
+
+
+def medir_ejecucion(ligero: bool) -> dict:
+    """Una descarga completa contra la WebGUI simulada; retorna los segundos por fase"""
+    descargador = DescargadorSAP()
+    tiempos = {}
+
+    configurar = descargador.configurar_chrome
+    abrir = descargador.abrir_sap
+
+    def configurar_medido():
+        inicio = time.perf_counter()
+        driver = configurar(ligero=ligero)
+        tiempos["arranque"] = time.perf_counter() - inicio
+        return driver
+
+    def abrir_medido():
+        inicio = time.perf_counter()
+        abierto = abrir()
+        tiempos["carga_url"] = time.perf_counter() - inicio
+        return abierto
+
+    descargador.configurar_chrome = configurar_medido
+    descargador.abrir_sap = abrir_medido
+
+    archivo = descargador.descargar_reporte_sap(0)
+    if archivo is None:
+        raise RuntimeError("La WebGUI simulada no entregó el archivo exportado")
+    DescargadorSAP.limpiar_carpeta_sesion(archivo.parent)
+
+    tiempos.update(descargador.tiempos_pasos)
+    tiempos["total"] = sum(tiempos.values())
+    return tiempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la descarga de SAP contra la WebGUI simulada")
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--perfil", choices=["ambos", *PERFILES], default="ambos")
+    parser.add_argument("--latencia", type=float, default=0.3, help="Segundos de 'ocupado' por pantalla")
+    parser.add_argument("--latencia-lista", type=float, default=None, help="Segundos que tarda la lista de FAGLL03")
+    parser.add_argument("--latencia-recursos", type=float, default=0.5, help="Retardo de imágenes y fuentes")
+    parser.add_argument("--peso-recursos", type=int, default=500, help="KB de cada recurso")
+    parser.add_argument("--filas", type=int, default=500, help="Filas del archivo exportado")
+    parser.add_argument("--latencia-descarga", type=float, default=0.5, help="Segundos que dura la descarga")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    latencias = {"lista": args.latencia_lista} if args.latencia_lista is not None else None
+    servidor, url = iniciar_servidor(latencia=args.latencia, peso_recursos_kb=args.peso_recursos,
+                                     latencia_recursos=args.latencia_recursos, latencias=latencias,
+                                     filas_exportacion=args.filas, latencia_descarga=args.latencia_descarga)
+    Config.SAP_URL = url
+
+    perfiles = PERFILES if args.perfil == "ambos" else {args.perfil: PERFILES[args.perfil]}
+    resultados = {}
+    try:
+        for nombre, ligero in perfiles.items():
+            medidas = [medir_ejecucion(ligero) for _ in range(args.repeticiones)]
+            resultados[nombre] = {fase: statistics.median(m[fase] for m in medidas) for fase in medidas[0]}
+    finally:
+        servidor.shutdown()
+
+    comparar = len(resultados) == 2
+    print(f"\n{'Fase':<14}" + "".join(f"{nombre:>12}" for nombre in resultados)
+          + (f"{'mejora':>10}" if comparar else ""))
+    for fase in next(iter(resultados.values())):
+        fila = [resultados[nombre][fase] for nombre in resultados]
+        linea = f"{fase:<14}" + "".join(f"{seg:>11.2f}s" for seg in fila)
+        if comparar:
+            estandar, ligero = fila
+            linea += f"{(1 - ligero / estandar) * 100 if estandar else 0.0:>9.0f}%"
+        print(linea)
+    print(f"\nMediana de {args.repeticiones} ejecuciones por perfil (URL simulada: {url})")
+
+
+if __name__ == "__main__":
+    main()
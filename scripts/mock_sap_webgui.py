@@ -0,0 +1,237 @@
+"""
+WEBGUI DE SAP SIMULADA - PayPal
+Página local que reproduce las pantallas y los IDs que usa DescargadorSAP
+(login, transacción, selección, lista, exportación y diálogo de descarga),
+con un indicador de "ocupado" que tarda `latencia` segundos en desaparecer.
+Para simular una sesión expirada basta con ejecutar mostrar("login") en la página.
+La página carga además una imagen y una fuente web (como la WebGUI real) servidas
+con `latencia_recursos` segundos de retardo, para comparar perfiles de navegador.
+Al confirmar el diálogo de descarga se sirve un .xlsx con la hoja de SAP
+(Referencia, Mon.grupo/Valoración grupo) en trozos durante `latencia_descarga` segundos.
+Con `solo_teclado`, los campos de la pantalla de selección solo toman el valor escrito
+con el teclado (keyup real), como los controles de la WebGUI que escuchan teclas: un
+valor asignado por script se ve en el campo pero no llega a SAP.
+
+Uso:
+    python scripts/mock_sap_webgui.py --puerto 8765 --latencia 0.5
+y apuntar Config.SAP_URL a http://127.0.0.1:8765/
+"""
+
+import argparse
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+from openpyxl import Workbook
+
+PAGINA = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>SAP WebGUI (simulada)</title>
+<style>
+  @font-face { font-family: "SAP72"; src: url("/recursos/72-Regular.woff2") format("woff2"); }
+  body { font-family: "SAP72", sans-serif; }
+  #ur-loading { position: fixed; inset: 0; background: rgba(0, 0, 0, .15); display: none; }
+</style></head>
+<body>
+<img src="/recursos/fondo.png" alt="">
+<div id="ur-loading">Procesando...</div>
+<div id="contenido"></div>
+<script>
+var LATENCIA = __LATENCIA__;
+var LATENCIAS = __LATENCIAS__;  // milisegundos por pantalla (las que no están usan LATENCIA)
+var TRANSACCION = "__TRANSACCION__";
+var SOLO_TECLADO = __SOLO_TECLADO__;
+var PANTALLAS = {
+  login: '<input id="sap-user"><input id="sap-password" type="password">',
+  inicio: '<input id="ToolbarOkCode">',
+  seleccion: '<input id="ToolbarOkCode"><input id="M0:46:::1:34"><input id="M0:46:::2:34">' +
+             '<button id="M0:50::btn[8]">Ejecutar</button>',
+  lista: '<input id="ToolbarOkCode"><table id="lista"><tr><td>Referencia</td><td>Importe</td></tr></table>',
+  exportacion: '<table id="lista"></table><input id="M1:46:1::1:17"><button id="M1:48::btn[20]">Generar</button>',
+  dialogo: '<table id="lista"></table><button id="UpDownDialogChoose">Guardar</button>'
+};
+// Lo que envió el cliente, para que las pruebas lo consulten
+window.sapSimulada = { pantalla: null, datos: {} };
+
+function valor(id) { return document.getElementById(id).value; }
+
+// Valores confirmados por teclado (solo eventos reales: los sintéticos tienen isTrusted = false)
+var confirmados = {};
+document.addEventListener("keyup", function (ev) {
+  if (ev.isTrusted && ev.target.id) { confirmados[ev.target.id] = ev.target.value; }
+});
+function valor_confirmado(id) { return SOLO_TECLADO ? (confirmados[id] || "") : valor(id); }
+
+// Como la WebGUI: la pantalla se vuelve a generar completa y queda "ocupada" un momento
+function mostrar(pantalla) {
+  var ocupado = document.getElementById("ur-loading");
+  ocupado.style.display = "block";
+  document.getElementById("contenido").innerHTML = PANTALLAS[pantalla];
+  confirmados = {};
+  window.sapSimulada.pantalla = pantalla;
+  var espera = (pantalla in LATENCIAS) ? LATENCIAS[pantalla] : LATENCIA;
+  setTimeout(function () { ocupado.style.display = "none"; }, espera);
+}
+
+// Descarga sin salir de la página, como la ventana de descarga de la WebGUI
+function descargar(nombre) {
+  var enlace = document.createElement("a");
+  enlace.href = "/descarga/" + encodeURIComponent(nombre) + ".xlsx";
+  enlace.download = nombre + ".xlsx";
+  document.body.appendChild(enlace);
+  enlace.click();
+  enlace.remove();
+}
+
+document.addEventListener("keydown", function (ev) {
+  var id = ev.target.id;
+  var datos = window.sapSimulada.datos;
+  if (ev.key === "Enter" && id === "sap-password") {
+    datos.usuario = valor("sap-user");
+    datos.clave = valor("sap-password");
+    datos.logins = (datos.logins || 0) + 1;
+    mostrar("inicio");
+  } else if (ev.key === "Enter" && id === "ToolbarOkCode") {
+    // "/nFAGLL03" abre la transacción desde cualquier pantalla
+    datos.transaccion = valor("ToolbarOkCode").replace(/^\\/n/i, "");
+    if (datos.transaccion.toUpperCase() === TRANSACCION) { mostrar("seleccion"); }
+  } else if (ev.key === "F4" && ev.shiftKey && window.sapSimulada.pantalla === "lista") {
+    ev.preventDefault();
+    mostrar("exportacion");
+  }
+});
+
+document.addEventListener("click", function (ev) {
+  var id = ev.target.id;
+  var datos = window.sapSimulada.datos;
+  if (id === "M0:50::btn[8]") {
+    datos.cuenta = valor_confirmado("M0:46:::1:34");
+    datos.sociedad = valor_confirmado("M0:46:::2:34");
+    mostrar("lista");
+  } else if (id === "M1:48::btn[20]") {
+    datos.nombre = valor("M1:46:1::1:17");
+    mostrar("dialogo");
+  } else if (id === "UpDownDialogChoose") {
+    datos.descargado = true;
+    descargar(datos.nombre || "EXPORT");
+    mostrar("lista");
+  }
+});
+
+mostrar("login");
+</script>
+</body></html>
+"""
+
+
+def libro_exportacion(filas: int) -> bytes:
+    """Contenido .xlsx de una exportación de FAGLL03 con la columna Referencia"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Data SAP"
+    ws.append(["Referencia", "Mon.grupo/Valoración grupo", "Texto"])
+    for i in range(filas):
+        ws.append([f"COUR{i}", round(-1.5 * (i % 97), 2), "Pago PayPal"])
+    salida = io.BytesIO()
+    wb.save(salida)
+    return salida.getvalue()
+
+
+def crear_manejador(latencia: float, transaccion: str, peso_recursos_kb: int = 200,
+                    latencia_recursos: float = 0.0, latencias: Optional[Dict[str, float]] = None,
+                    filas_exportacion: int = 500, latencia_descarga: float = 0.5,
+                    solo_teclado: bool = False):
+    """Manejador HTTP que sirve la página simulada, sus recursos y la exportación"""
+    latencias_ms = {pantalla: int(seg * 1000) for pantalla, seg in (latencias or {}).items()}
+    pagina = (PAGINA.replace("__LATENCIA__", str(int(latencia * 1000)))
+              .replace("__LATENCIAS__", repr(latencias_ms).replace("'", '"'))
+              .replace("__TRANSACCION__", transaccion.upper())
+              .replace("__SOLO_TECLADO__", "true" if solo_teclado else "false")
+              .encode("utf-8"))
+    recurso = bytes(peso_recursos_kb * 1024)
+    exportacion = libro_exportacion(filas_exportacion)
+
+    class ManejadorSAP(BaseHTTPRequestHandler):
+        def do_GET(self):
+            ruta = urlparse(self.path).path
+            if ruta.startswith("/recursos/"):
+                time.sleep(latencia_recursos)
+                self._responder(recurso, "application/octet-stream")
+            elif ruta.startswith("/descarga/"):
+                self._descargar(unquote(ruta[len("/descarga/"):]))
+            else:
+                self._responder(pagina, "text/html; charset=utf-8")
+
+        def _responder(self, cuerpo: bytes, tipo: str):
+            self.send_response(200)
+            self.send_header("Content-Type", tipo)
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def _descargar(self, nombre: str):
+            """Envía la exportación en 10 trozos repartidos en `latencia_descarga` segundos"""
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+            self.send_header("Content-Disposition", f'attachment; filename="{nombre}"')
+            self.send_header("Content-Length", str(len(exportacion)))
+            self.end_headers()
+            trozo = len(exportacion) // 10 + 1
+            for inicio in range(0, len(exportacion), trozo):
+                self.wfile.write(exportacion[inicio:inicio + trozo])
+                self.wfile.flush()
+                time.sleep(latencia_descarga / 10)
+
+        def log_message(self, formato, *args):
+            pass
+
+    return ManejadorSAP
+
+
+def iniciar_servidor(puerto: int = 0, latencia: float = 0.3, transaccion: str = "FAGLL03",
+                     peso_recursos_kb: int = 200, latencia_recursos: float = 0.0,
+                     latencias: Optional[Dict[str, float]] = None, filas_exportacion: int = 500,
+                     latencia_descarga: float = 0.5,
+                     solo_teclado: bool = False) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Arranca el servidor en un hilo en segundo plano y retorna (servidor, url).
+    `latencias` fija segundos de "ocupado" por pantalla (p. ej. {"lista": 5}).
+    """
+    manejador = crear_manejador(latencia, transaccion, peso_recursos_kb, latencia_recursos,
+                                latencias, filas_exportacion, latencia_descarga, solo_teclado)
+    servidor = ThreadingHTTPServer(("127.0.0.1", puerto), manejador)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}/"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebGUI de SAP simulada para probar la descarga")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia", type=float, default=0.3, help="Segundos con el indicador de ocupado")
+    parser.add_argument("--peso-recursos", type=int, default=200, help="KB de la imagen y la fuente")
+    parser.add_argument("--latencia-recursos", type=float, default=0.0, help="Segundos de retardo de cada recurso")
+    parser.add_argument("--latencia-lista", type=float, default=None, help="Segundos que tarda la lista de FAGLL03")
+    parser.add_argument("--filas", type=int, default=500, help="Filas del archivo exportado")
+    parser.add_argument("--latencia-descarga", type=float, default=0.5, help="Segundos que dura la descarga")
+    parser.add_argument("--solo-teclado", action="store_true",
+                        help="Los campos de selección solo toman valores escritos con el teclado")
+    args = parser.parse_args()
+
+    latencias = {"lista": args.latencia_lista} if args.latencia_lista is not None else None
+    manejador = crear_manejador(args.latencia, "FAGLL03", args.peso_recursos, args.latencia_recursos,
+                                latencias, args.filas, args.latencia_descarga, args.solo_teclado)
+    servidor = ThreadingHTTPServer(("127.0.0.1", args.puerto), manejador)
+    print(f"WebGUI simulada en http://127.0.0.1:{args.puerto}/ (Ctrl+C para salir)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+
+if __name__ == "__main__":
+    main()
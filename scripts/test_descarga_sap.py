@@ -0,0 +1,201 @@
+import pandas as pd
+import pytest
+from selenium import webdriver
+from selenium.webdriver.common.by import By
+
+from main import Config, DescargadorSAP, SesionSAP
+from scripts.mock_sap_webgui import iniciar_servidor
+
+
+@pytest.fixture
+def chrome():
+    """Chrome headless; la prueba se omite si no hay Chrome/ChromeDriver disponible"""
+    opciones = webdriver.ChromeOptions()
+    opciones.add_argument("--headless=new")
+    opciones.add_argument("--no-sandbox")
+    try:
+        driver = webdriver.Chrome(options=opciones)
+    except Exception as e:
+        pytest.skip(f"Chrome no disponible: {e}")
+    yield driver
+    try:
+        driver.quit()
+    except Exception:
+        pass
+
+
+def descargador_simulado(monkeypatch, driver, latencia, **opciones):
+    """DescargadorSAP contra la WebGUI simulada; el paso de descarga retorna lo que recibió la página"""
+    servidor, url = iniciar_servidor(latencia=latencia, **opciones)
+    monkeypatch.setattr(Config, "SAP_URL", url)
+    descargador = DescargadorSAP()
+    monkeypatch.setattr(descargador, "configurar_chrome", lambda: driver)
+    monkeypatch.setattr(descargador, "_paso_descarga",
+                        lambda timeout, contexto: driver.execute_script("return window.sapSimulada"))
+    return servidor, descargador
+
+
+class DriverFalso:
+    """Driver sin navegador: el script de llenado rechaza `rechazados` y se registra lo tecleado"""
+
+    def __init__(self, rechazados):
+        self.rechazados = rechazados
+        self.scripts = []
+        self.tecleado = []
+
+    def execute_script(self, script, *argumentos):
+        self.scripts.append(argumentos)
+        return list(self.rechazados)
+
+    def find_element(self, by, id_campo):
+        assert by == By.ID
+        driver = self
+
+        class Campo:
+            def clear(self):
+                driver.tecleado.append((id_campo, "clear"))
+
+            def send_keys(self, valor):
+                driver.tecleado.append((id_campo, valor))
+        return Campo()
+
+
+class TestDescargaSAP():
+    def test_llenar_campos_teclea_los_rechazados_por_el_script(self, monkeypatch):
+        valores = {"M0:46:::1:34": "2815050000", "M0:46:::2:34": "CO01"}
+        descargador = DescargadorSAP()
+
+        monkeypatch.setattr(Config, "LLENADO_SAP_JS", True)
+        descargador.driver = DriverFalso(rechazados=["M0:46:::2:34"])
+        descargador._llenar_campos(valores)
+        assert descargador.driver.scripts == [(valores,)]
+        assert descargador.driver.tecleado == [("M0:46:::2:34", "clear"), ("M0:46:::2:34", "CO01")]
+
+        # Sin script todos los campos se teclean
+        monkeypatch.setattr(Config, "LLENADO_SAP_JS", False)
+        descargador.driver = DriverFalso(rechazados=[])
+        descargador._llenar_campos(valores)
+        assert descargador.driver.scripts == []
+        assert descargador.driver.tecleado == [
+            ("M0:46:::1:34", "clear"), ("M0:46:::1:34", "2815050000"),
+            ("M0:46:::2:34", "clear"), ("M0:46:::2:34", "CO01"),
+        ]
+
+    def test_pasos_avanzan_cuando_la_pantalla_esta_lista(self, chrome, monkeypatch):
+        servidor, descargador = descargador_simulado(monkeypatch, chrome, latencia=0.5)
+        try:
+            simulada = descargador.descargar_reporte_sap(7)
+        finally:
+            servidor.shutdown()
+
+        assert simulada["datos"] == {
+            "usuario": Config.SAP_USER, "clave": Config.SAP_PASSWORD, "logins": 1,
+            "transaccion": Config.SAP_TRANSACCION, "cuenta": Config.SAP_CUENTA,
+            "sociedad": Config.SAP_SOCIEDAD, "nombre": "pago 7", "descargado": True,
+        }
+        assert list(descargador.tiempos_pasos) == list(DescargadorSAP.PASOS_DESCARGA)
+        # Cada pantalla espera a que desaparezca el indicador de ocupado, sin esperas fijas
+        assert descargador.tiempos_pasos["resultados"] >= 0.4
+        assert sum(descargador.tiempos_pasos.values()) < 10
+
+    def test_timeout_por_paso(self, chrome, monkeypatch):
+        servidor, descargador = descargador_simulado(monkeypatch, chrome, latencia=3)
+        monkeypatch.setattr(Config, "TIMEOUTS_PASOS_SAP", dict(Config.TIMEOUTS_PASOS_SAP, resultados=1))
+        try:
+            with pytest.raises(Exception, match="resultados"):
+                descargador.descargar_reporte_sap(7)
+        finally:
+            servidor.shutdown()
+        assert descargador.tiempos_pasos["resultados"] < 2
+
+    def test_descarga_el_archivo_exportado(self, chrome, monkeypatch):
+        servidor, url = iniciar_servidor(latencia=0.2, filas_exportacion=50, latencia_descarga=1)
+        monkeypatch.setattr(Config, "SAP_URL", url)
+        descargador = DescargadorSAP()
+
+        def configurar():
+            descargador.driver = chrome
+            descargador.dirigir_descargas(descargador.download_path)
+            return chrome
+
+        monkeypatch.setattr(descargador, "configurar_chrome", configurar)
+        try:
+            archivo = descargador.descargar_reporte_sap(7)
+        finally:
+            servidor.shutdown()
+
+        try:
+            assert archivo.name == "pago 7.xlsx"
+            assert DescargadorSAP.es_carpeta_sesion(archivo.parent)
+            # El paso de descarga espera a que el archivo termine de escribirse
+            assert len(pd.read_excel(archivo)) == 50
+            assert descargador.tiempos_pasos["descarga"] >= 0.8
+        finally:
+            DescargadorSAP.limpiar_carpeta_sesion(archivo.parent)
+
+    def test_sesion_reutiliza_login_y_reautentica_si_expira(self, chrome, monkeypatch):
+        servidor, descargador = descargador_simulado(monkeypatch, chrome, latencia=0.2)
+        nombres = []
+
+        def descarga(timeout, contexto):
+            nombres.append(contexto["nombre_archivo"])
+            return chrome.execute_script("return window.sapSimulada.datos.logins")
+
+        monkeypatch.setattr(descargador, "_paso_descarga", descarga)
+        try:
+            with SesionSAP(descargador) as sesion:
+                logins = sesion.descargar_reportes([7, 8])
+                # Sesión expirada: SAP vuelve a la pantalla de login
+                chrome.execute_script('mostrar("login")')
+                logins.update(sesion.descargar_reportes([9]))
+        finally:
+            servidor.shutdown()
+
+        assert nombres == ["pago 7", "pago 8", "pago 9"]
+        assert logins == {7: 1, 8: 1, 9: 2}
+        assert sesion.inicios_sesion == 2
+        assert set(sesion.tiempos) == {7, 8, 9}
+
+    def test_llenado_por_script_ahorra_comandos(self, chrome, monkeypatch):
+        servidor, descargador = descargador_simulado(monkeypatch, chrome, latencia=0.2)
+        comandos, datos = [], []
+
+        def descarga(timeout, contexto):
+            comandos.append(dict(descargador.comandos_pasos))
+            datos.append(chrome.execute_script("return window.sapSimulada.datos"))
+
+        monkeypatch.setattr(descargador, "_paso_descarga", descarga)
+        try:
+            with SesionSAP(descargador) as sesion:
+                monkeypatch.setattr(Config, "LLENADO_SAP_JS", True)
+                sesion.descargar_reporte(7)
+                monkeypatch.setattr(Config, "LLENADO_SAP_JS", False)
+                sesion.descargar_reporte(8)
+        finally:
+            servidor.shutdown()
+
+        por_script, por_teclado = comandos
+        assert datos[0]["cuenta"] == datos[1]["cuenta"] == Config.SAP_CUENTA
+        assert datos[0]["sociedad"] == datos[1]["sociedad"] == Config.SAP_SOCIEDAD
+        assert por_script["formulario"] < por_teclado["formulario"]
+        assert por_script["transaccion"] < por_teclado["transaccion"]
+
+    def test_campos_que_solo_confirman_con_teclado(self, chrome, monkeypatch):
+        servidor, descargador = descargador_simulado(monkeypatch, chrome, latencia=0.2, solo_teclado=True)
+        datos = []
+        monkeypatch.setattr(descargador, "_paso_descarga", lambda timeout, contexto: datos.append(
+            chrome.execute_script("return window.sapSimulada.datos")))
+        try:
+            with SesionSAP(descargador) as sesion:
+                # Por script el valor se ve en el campo pero la WebGUI no lo recibe
+                monkeypatch.setattr(Config, "LLENADO_SAP_JS", True)
+                sesion.descargar_reporte(7)
+                monkeypatch.setattr(Config, "LLENADO_SAP_JS", False)
+                sesion.descargar_reporte(8)
+        finally:
+            servidor.shutdown()
+
+        por_script, por_teclado = datos
+        assert (por_script["cuenta"], por_script["sociedad"]) == ("", "")
+        assert (por_teclado["cuenta"], por_teclado["sociedad"]) == (Config.SAP_CUENTA, Config.SAP_SOCIEDAD)
+
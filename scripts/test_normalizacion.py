@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import normalizacion
+from normalizacion import (aplicar_esquema, asignar_valor, limpiar_ids, limpiar_nulo, limpiar_nulos,
+                           preparar_para_excel)
+
+
+class TestNormalizacion():
+    def test_limpiar_nulos_vacia_nan_y_na(self):
+        serie = pd.Series([np.nan, pd.NA, None, " a ", "nan", "None", "<NA>", 1.0], dtype=object)
+        assert limpiar_nulos(serie).tolist() == ["", "", "", "a", "", "", "", "1.0"]
+        # Columnas numéricas y de texto con nulos propios del dtype
+        assert limpiar_nulos(pd.Series([1.5, np.nan])).tolist() == ["1.5", ""]
+        assert limpiar_nulos(pd.Series(["x", pd.NA], dtype="string")).tolist() == ["x", ""]
+        # Igual que la versión escalar, fila a fila
+        assert limpiar_nulos(serie).tolist() == [limpiar_nulo(v) for v in serie]
+
+    def test_limpiar_ids_vacia_nan_y_na(self):
+        serie = pd.Series([np.nan, pd.NA, None, 1234.0, 1.5e15, " 77 "], dtype=object)
+        assert limpiar_ids(serie).tolist() == ["", "", "", "1234", "1500000000000000", "77"]
+
+    def test_esquema_deja_observaciones_como_texto_libre(self):
+        df = aplicar_esquema(pd.DataFrame({"Currency": ["USD", "EUR"], "Observaciones": [np.nan, "Soportes OK"]}))
+        assert isinstance(df["Currency"].dtype, pd.CategoricalDtype)
+        assert df["Observaciones"].dtype == object and df["Observaciones"].tolist() == [None, "Soportes OK"]
+        # Cada observación distinta no agrega categorías
+        asignar_valor(df, 0, "Observaciones", "Fecha anterior registrada 26/01/02")
+        assert df["Observaciones"].dtype == object
+        assert df["Currency"].cat.categories.tolist() == ["EUR", "USD"]
+
+    def test_formato_de_fecha_no_depende_del_primer_valor(self, monkeypatch):
+        monkeypatch.setattr(normalizacion, "_FORMATOS_FECHA", {})
+        df = aplicar_esquema(pd.DataFrame({
+            "Date": ["Pendiente", "05/01/2026", " 15/03/2026", datetime(2026, 2, 1), None, "7/4/2026"],
+            "Fecha_pago": ["01/02/2026 10:30:00", "02/02/2026", "13/02/2026", "", None, "28/02/2026"],
+        }, dtype=object))
+        # Con texto libre la columna queda formateada como texto; sin él, como fecha (sin horas)
+        assert df["Date"].tolist() == ["Pendiente", "05/01/2026", "15/03/2026", "01/02/2026", "", "07/04/2026"]
+        assert df["Fecha_pago"].tolist()[:3] == [pd.Timestamp(2026, 2, 1), pd.Timestamp(2026, 2, 2),
+                                                 pd.Timestamp(2026, 2, 13)]
+        # El formato inferido es el de la mayoría de la muestra, no el del primer valor
+        assert normalizacion._FORMATOS_FECHA == {"Date": "%d/%m/%Y", "Fecha_pago": "%d/%m/%Y"}
+
+    def test_esquema_y_vista_para_excel(self):
+        original = pd.DataFrame({
+            "Date": ["31/01/2026", "01/02/2026", None],
+            "Currency": ["USD", None, "EUR"],
+            "Gross": ["10.5", 3, None],
+            "Fee": ["1", "n/d", None],
+            "Invoice Numbers": ["1234", " COUR7 ", None],
+            "Observaciones": [None, "Soportes OK", np.nan],
+        }, dtype=object)
+        df = aplicar_esquema(original.copy())
+        assert pd.api.types.is_datetime64_any_dtype(df["Date"])
+        assert df["Gross"].dtype == "float64" and df["Fee"].dtype == object
+        assert df["Invoice Numbers"].tolist() == ["1234", "COUR7", ""]
+
+        excel = preparar_para_excel(df)
+        assert excel["Date"].tolist() == ["31/01/2026", "01/02/2026", ""]
+        assert excel["Currency"].tolist() == ["USD", None, "EUR"]
+        assert excel["Invoice Numbers"].tolist() == ["1234", "COUR7", ""]
+        assert excel["Observaciones"].tolist() == [None, "Soportes OK", None]
+        # La vista no modifica el DataFrame tipado
+        assert pd.api.types.is_datetime64_any_dtype(df["Date"])
@@ -0,0 +1,762 @@
+import logging
+import random
+import re
+import shutil
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.formatting.rule import CellIsRule
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.datavalidation import DataValidation
+from openpyxl.worksheet.table import Table
+
+import cache_maestro
+import main
+import paquete_excel
+from main import Config, GestorPDFs, ProcesadorExcel, ejecutar_backfill
+
+VT = "http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes"
+COLUMNAS_A_LLENAR = ["Order Id Paypal", "Número guía", "Gross", "Fee", "Flete", "Valor mcia"]
+
+
+def frame_sintetico(filas, semilla=7):
+    """Segunda hoja sintética con facturas repetidas, vacíos y tipos mezclados"""
+    rnd = random.Random(semilla)
+    facturas = [f"COUR{i}" for i in range(filas // 3)] + [1000 + i for i in range(filas // 10)]
+    vacios = [None, "", "  ", float("nan")]
+    datos = []
+    for _ in range(filas):
+        datos.append({
+            "Invoice Numbers": rnd.choice(facturas + vacios),
+            "Order Id Paypal": rnd.choice([f"ORD{rnd.randint(1, 99)}", None, ""]),
+            "Número guía": rnd.choice([rnd.randint(10**9, 10**10), None, " "]),
+            "Gross": rnd.choice([round(rnd.uniform(1, 100), 2), None, 0]),
+            "Fee": rnd.choice([round(rnd.uniform(0, 5), 2), None]),
+            "Flete": rnd.choice([round(rnd.uniform(1, 50), 2), None, ""]),
+            "Valor mcia": rnd.choice([round(rnd.uniform(1, 50), 2), None, 0, "abc"]),
+        })
+    return pd.DataFrame(datos, dtype=object)
+
+
+def rellenar_referencia(df, col_invoice="Invoice Numbers"):
+    """Implementación original (bucle por grupo) usada como referencia"""
+    for invoice_val, grupo in df.groupby(col_invoice):
+        if pd.isna(invoice_val) or str(invoice_val).strip() == "":
+            continue
+        for col in COLUMNAS_A_LLENAR:
+            serie_fuente = grupo[col]
+            serie_fuente = serie_fuente[serie_fuente.notna()]
+            serie_fuente = serie_fuente[serie_fuente.astype(str).str.strip() != ""]
+            if serie_fuente.empty:
+                continue
+            valor = serie_fuente.iloc[0]
+            mask_faltante = (df[col_invoice] == invoice_val) & (
+                df[col].isna() | (df[col].astype(str).str.strip() == "")
+            )
+            df.loc[mask_faltante, col] = valor
+    return df
+
+
+def deduplicar_referencia(df, col_invoice="Invoice Numbers"):
+    """Implementación original de la deduplicación de 'Valor mcia' usada como referencia"""
+    df["Valor mcia"] = pd.to_numeric(df["Valor mcia"], errors="coerce")
+    for invoice_val, grupo in df.groupby(col_invoice):
+        if pd.isna(invoice_val) or str(invoice_val).strip() == "":
+            continue
+        idxs = grupo.index.tolist()
+        if len(idxs) <= 1:
+            continue
+        vals = df.loc[idxs, "Valor mcia"].fillna(0)
+        nz = vals[vals != 0]
+        if nz.empty:
+            continue
+        keep_idx = nz.index[0]
+        to_zero = [i for i in idxs if i != keep_idx]
+        df.loc[to_zero, "Valor mcia"] = 0
+    return df
+
+
+def valoracion_referencia(archivo, df):
+    """Cálculo original de Valoración flete y Diferencia (read_excel completo y diccionario)"""
+    df_sap = pd.read_excel(archivo, sheet_name=0, engine="openpyxl", dtype=object)
+    df_sap.columns = [str(col).strip() for col in df_sap.columns]
+    df_sap["Referencia"] = df_sap["Referencia"].astype(str).str.strip()
+    valores = df_sap.set_index("Referencia")["Mon.grupo/Valoración grupo"].to_dict()
+    df["Valoración flete"] = df["Invoice Numbers"].astype(str).str.strip().map(valores)
+    df["Diferencia"] = (pd.to_numeric(df["Flete"], errors="coerce").fillna(0)
+                        + pd.to_numeric(df["Valoración flete"], errors="coerce").fillna(0))
+    return df
+
+
+def libro_sap(archivo, semilla=7):
+    """Libro de pago con la hoja de SAP (Referencia ya en primera columna)"""
+    rnd = random.Random(semilla)
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Data SAP"
+    ws.append(["Referencia", "Importe", "Fecha doc.", "Texto"])
+    for i in range(200):
+        ws.append([f"COUR{i}", round(rnd.uniform(-500, 500), 2), datetime(2026, 1, 1 + i % 28), "Pago PayPal"])
+        ws.cell(row=ws.max_row, column=2).number_format = "#,##0.00"
+    wb.save(archivo)
+
+
+def libro_sap_valoracion(archivo):
+    """Hoja SAP con referencias repetidas, con espacios, numéricas y vacías, y valores de varios tipos"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Data SAP"
+    ws.append(["Texto", "Referencia", "Mon.grupo/Valoración grupo"])
+    for i in range(40):
+        ws.append(["Pago PayPal", f"COUR{i}", round(-10.5 - i, 2)])
+    ws.append(["Repetida", "COUR3", -99.0])
+    ws.append(["Con espacios", "  COUR50 ", -7])
+    ws.append(["Numérica", 1001, "-12.5"])
+    ws.append(["Sin referencia", None, -1.0])
+    ws.append([])
+    ws.append(["Sin valor", "COUR60", None])
+    ws.append(["Texto", "COUR61", "n/a"])
+    wb.save(archivo)
+    return archivo
+
+
+def segunda_hoja_sintetica(filas, semilla=7):
+    """Segunda hoja con todas las columnas de Validación y algunos 'Proximo pago'"""
+    rnd = random.Random(semilla)
+    datos = []
+    for i in range(filas):
+        fila = {col: None for col in Config.COLUMNAS_SEGUNDA_HOJA}
+        fila.update({
+            "Date": f"{1 + i % 28:02d}/01/2026",
+            "Currency": "USD",
+            "Gross": round(rnd.uniform(1, 100), 2),
+            "Fee": rnd.choice([round(rnd.uniform(0, 5), 2), None]),
+            "Net": round(rnd.uniform(1, 100), 2),
+            "Flete": rnd.choice([round(rnd.uniform(1, 50), 2), None]),
+            "Valor mcia": rnd.choice([rnd.randint(1, 50), 0]),
+            "Invoice Numbers": f"COUR{i // 2}",
+            "Número guía": rnd.choice([str(rnd.randint(10**9, 10**10)), ""]),
+            "Order Id Paypal": f"ORD{i}",
+            "Valoración flete": round(rnd.uniform(-50, 0), 2),
+            "Observaciones": rnd.choice(["Soportes OK", "Falta factura", "Proximo pago", ""]),
+        })
+        datos.append(fila)
+    return pd.DataFrame(datos, dtype=object)
+
+
+def maestro_sintetico(archivo, gross_cour3=40.0):
+    """Maestro con un mes de pagos (enero 2026): dos registros por factura y la columna del pago"""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = Config.HOJA_MAESTRO
+    ws.append(Config.COLUMNAS_SEGUNDA_HOJA + ["Pago#"])
+    for i in range(20):
+        fila = {col: None for col in Config.COLUMNAS_SEGUNDA_HOJA}
+        fila.update({
+            "Date": datetime(2026, 1, 1 + i), "Currency": "USD",
+            "Gross": gross_cour3 if i // 2 == 3 else 10.0 + i, "Fee": 1.0, "Net": 9.0 + i,
+            "Invoice Numbers": f"COUR{i // 2}", "Order Id Paypal": f"ORD{i}",
+            "Fecha del envío": datetime(2026, 1, 2), "Fecha_pago": datetime(2026, 1, 15),
+        })
+        ws.append(list(fila.values()) + [None])
+    wb.create_sheet("Resumen")["A1"] = "no tocar"
+    wb.save(archivo)
+
+
+def orden_estilos(xml):
+    """Hijos de styleSheet en el orden del archivo"""
+    return [hijo.tag.rsplit("}", 1)[-1] for hijo in ET.fromstring(xml)]
+
+
+def partes_libro(archivo):
+    """{parte del paquete: bytes} de un .xlsx"""
+    with zipfile.ZipFile(archivo) as zf:
+        return {nombre: zf.read(nombre) for nombre in zf.namelist()}
+
+
+def contenido_libro(archivo):
+    """Hojas, valores, estilos de cabecera/totales y anchos de un libro guardado"""
+    wb = load_workbook(archivo)
+    contenido = {}
+    for ws in wb.worksheets:
+        celdas = {}
+        for fila in ws.iter_rows():
+            for celda in fila:
+                # xlsxwriter escribe los textos vacíos como celdas en blanco
+                if celda.value not in (None, ""):
+                    celdas[celda.coordinate] = (
+                        celda.value,
+                        celda.number_format,
+                        bool(celda.font.b),
+                        celda.fill.fgColor.rgb[-6:] if celda.fill.fill_type == "solid" else None,
+                    )
+        anchos = {}
+        for dim in ws.column_dimensions.values():
+            if dim.width:
+                # Columnas contiguas con el mismo ancho pueden venir agrupadas (min..max)
+                anchos.update({col: round(dim.width) for col in range(dim.min, dim.max + 1)})
+        contenido[ws.title] = (celdas, anchos)
+    return contenido
+
+
+class TestProcesadorExcel():
+    def test_relleno_por_factura_igual_al_original(self):
+        for semilla in range(3):
+            original = frame_sintetico(300, semilla)
+            esperado = rellenar_referencia(original.copy())
+            obtenido = original.copy()
+            ProcesadorExcel()._rellenar_por_factura(obtenido, "Invoice Numbers", COLUMNAS_A_LLENAR)
+            pd.testing.assert_frame_equal(obtenido, esperado)
+
+    def test_deduplicacion_valor_mcia_50k_filas(self):
+        # Mismo resultado que el bucle original, también con otras semillas y tamaños pequeños
+        for filas, semilla in ((30, 1), (300, 2), (3_000, 3)):
+            original = frame_sintetico(filas, semilla)
+            obtenido = original.copy()
+            ProcesadorExcel()._deduplicar_valor_mcia(obtenido, "Invoice Numbers")
+            pd.testing.assert_frame_equal(obtenido, deduplicar_referencia(original.copy()))
+
+        original = frame_sintetico(50_000)
+        inicio = time.perf_counter()
+        esperado = deduplicar_referencia(original.copy())
+        segundos_bucle = time.perf_counter() - inicio
+
+        obtenido = original.copy()
+        inicio = time.perf_counter()
+        ProcesadorExcel()._deduplicar_valor_mcia(obtenido, "Invoice Numbers")
+        segundos_vectorizado = time.perf_counter() - inicio
+
+        pd.testing.assert_frame_equal(obtenido, esperado)
+        # El bucle recorre ~21.000 facturas con una escritura .loc por grupo; el margen es amplio
+        assert segundos_vectorizado * 10 < segundos_bucle, (segundos_vectorizado, segundos_bucle)
+
+    def test_valoracion_sap_igual_al_calculo_original(self, tmp_path, monkeypatch):
+        archivo = libro_sap_valoracion(tmp_path / "pago.xlsx")
+        # Facturas presentes, repetidas, con espacios, numéricas y que no están en SAP
+        df = pd.DataFrame({
+            "Invoice Numbers": ["COUR0", "COUR3", "COUR3", " COUR50", 1001, "COUR999", "COUR60", "COUR61", "1002"],
+            "Flete": [10.0, 20.0, None, 5, "", 3.0, 1.0, 2.0, 4.0],
+        }, dtype=object)
+        esperado = valoracion_referencia(archivo, df.copy())
+
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        for volcado in (False, True):
+            monkeypatch.setattr(Config, "VOLCADO_SAP_PARQUET", volcado)
+            obtenido = ProcesadorExcel().calcular_mon_grupo_y_diferencia(archivo, df.copy())
+            pd.testing.assert_series_equal(obtenido["Diferencia"], esperado["Diferencia"])
+            # Los valores ya llegan numéricos: el texto no numérico ("n/a") queda vacío
+            pd.testing.assert_series_equal(
+                obtenido["Valoración flete"],
+                pd.to_numeric(esperado["Valoración flete"], errors="coerce").astype("float64"),
+            )
+            assert obtenido["Valoración flete"].isna().tolist() == [False, False, False, False, False,
+                                                                     True, True, True, True]
+
+    def test_lectura_por_lotes_de_sap_igual_a_lectura_completa(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(Config, "VOLCADO_SAP_PARQUET", False)
+        archivo = libro_sap_valoracion(tmp_path / "pago.xlsx")
+        completo = pd.read_excel(archivo, sheet_name=0, dtype=object)
+        completo = completo[completo["Referencia"].notna()]
+        completo = completo.assign(Referencia=completo["Referencia"].astype(str).str.strip())
+        completo = completo.drop_duplicates(subset="Referencia", keep="last")
+        esperado = pd.to_numeric(completo["Mon.grupo/Valoración grupo"], errors="coerce").astype("float64")
+        esperado = pd.Series(esperado.to_numpy(), index=completo["Referencia"].to_numpy(),
+                             name="Mon.grupo/Valoración grupo")
+
+        for lote in (1, 7, 50_000):
+            monkeypatch.setattr(Config, "LOTE_FILAS_SAP", lote)
+            obtenido = ProcesadorExcel().leer_valores_sap(archivo, "Referencia", "Mon.grupo/Valoración grupo")
+            pd.testing.assert_series_equal(obtenido, esperado)
+
+        # Si la cabecera no se puede leer, el libro read_only se cierra igualmente
+        cerrados = []
+        abrir = main.load_workbook
+
+        def abrir_espiado(*args, **kwargs):
+            wb = abrir(*args, **kwargs)
+            cerrar = wb.close
+            wb.close = lambda: (cerrados.append(True), cerrar())
+            wb.worksheets[0].iter_rows = lambda **kwargs: iter([1])  # fila ilegible
+            return wb
+
+        monkeypatch.setattr(main, "load_workbook", abrir_espiado)
+        with pytest.raises(TypeError):
+            ProcesadorExcel()._leer_lotes_sap(archivo, "Referencia", "Mon.grupo/Valoración grupo")
+        assert cerrados == [True]
+
+    def test_exportacion_rapida_igual_al_guardado_estandar(self, tmp_path):
+        pytest.importorskip("xlsxwriter")
+        df = segunda_hoja_sintetica(120)
+
+        estandar = tmp_path / "estandar.xlsx"
+        rapido = tmp_path / "rapido.xlsx"
+        libro_sap(estandar)
+        shutil.copy(estandar, rapido)
+
+        ProcesadorExcel().guardar_excel_con_dos_hojas(estandar, df.copy(), rapido=False)
+        ProcesadorExcel().guardar_excel_con_dos_hojas(rapido, df.copy(), rapido=True)
+
+        esperado = contenido_libro(estandar)
+        obtenido = contenido_libro(rapido)
+        assert list(obtenido) == ["Data SAP", "Validación"]
+        for hoja, (celdas, anchos) in esperado.items():
+            celdas_rapido, anchos_rapido = obtenido[hoja]
+            assert celdas_rapido == celdas
+            # xlsxwriter guarda el ancho con el margen de Excel incluido
+            for columna, ancho in anchos.items():
+                assert abs(anchos_rapido[columna] - ancho) <= 1
+
+    def test_guardado_solo_escribe_la_hoja_validacion(self, tmp_path):
+        archivo = tmp_path / "pago.xlsx"
+        libro_sap(archivo)
+        wb = load_workbook(archivo)
+        wb["Data SAP"].column_dimensions["A"].width = 31
+        wb["Data SAP"]["A1"].font = Font(bold=True, color="FF0000")
+        wb.create_sheet("Notas")["A1"] = "no tocar"
+        wb.save(archivo)
+        antes = partes_libro(archivo)
+
+        ProcesadorExcel().guardar_excel_con_dos_hojas(archivo, segunda_hoja_sintetica(20))
+        primera = partes_libro(archivo)
+        ProcesadorExcel().guardar_excel_con_dos_hojas(archivo, segunda_hoja_sintetica(30))
+        segunda = partes_libro(archivo)
+
+        # La hoja de SAP, la otra hoja y el tema se copian sin cambios
+        cambiadas = {n for n in primera if antes.get(n) != primera[n]}
+        assert cambiadas == {"xl/worksheets/sheet3.xml", "xl/styles.xml", "xl/workbook.xml",
+                             "xl/_rels/workbook.xml.rels", "[Content_Types].xml"}
+        # Al volver a guardar solo cambia la hoja 'Validación' (los estilos se reutilizan)
+        assert {n for n in segunda if primera.get(n) != segunda[n]} == {"xl/worksheets/sheet3.xml"}
+        assert not list(tmp_path.glob("~tmp_*"))
+
+        wb = load_workbook(archivo)
+        assert wb.sheetnames == ["Data SAP", "Notas", "Validación"]
+        assert wb["Data SAP"].column_dimensions["A"].width == 31
+        assert wb["Data SAP"]["A1"].font.b and wb["Data SAP"]["A1"].font.color.rgb == "00FF0000"
+        validacion = wb["Validación"]
+        assert validacion["A1"].value == "Date" and validacion["A1"].font.b
+        assert validacion["A1"].fill.fgColor.rgb.endswith("69E2FF")
+
+    def test_hoja_nueva_mantiene_app_xml_y_el_orden_de_estilos(self, tmp_path):
+        xlsxwriter = pytest.importorskip("xlsxwriter")
+        archivo = tmp_path / "pago.xlsx"
+        libro = xlsxwriter.Workbook(str(archivo))
+        libro.add_worksheet("Data SAP").write_row(0, 0, ["Referencia", "Importe"])
+        libro.add_worksheet("Notas")
+        libro.define_name("Rango", "=Notas!$A$1")
+        libro.close()
+
+        ProcesadorExcel().guardar_excel_con_dos_hojas(archivo, segunda_hoja_sintetica(10))
+
+        partes = partes_libro(archivo)
+        app = ET.fromstring(partes["docProps/app.xml"])
+        assert [e.text for e in app.iter(f"{{{VT}}}lpstr")] == ["Worksheets", "Named Ranges",
+                                                               "Data SAP", "Notas", "Validación", "Rango"]
+        assert [e.text for e in app.iter(f"{{{VT}}}i4")] == ["3", "1"]
+        assert app.find(f".//{{{VT}}}vector[@baseType='lpstr']").get("size") == "4"
+        orden = orden_estilos(partes["xl/styles.xml"])
+        assert orden == sorted(orden, key=paquete_excel.EstilosLibro.ORDEN_ESQUEMA.index)
+        assert load_workbook(archivo).sheetnames == ["Data SAP", "Notas", "Validación"]
+
+    def test_estilos_nuevos_siguen_el_orden_del_esquema(self):
+        estilos = paquete_excel.EstilosLibro(
+            f'<styleSheet xmlns="{paquete_excel.NS_PRINCIPAL}"><fonts count="1"><font/></fonts>'
+            '<fills count="2"><fill/><fill/></fills><cellXfs count="1"><xf/></cellXfs>'
+            '<dxfs count="0"/></styleSheet>'.encode()
+        )
+        borde = ET.fromstring(f'<border xmlns="{paquete_excel.NS_PRINCIPAL}"><left style="thin"/></border>')
+        assert estilos._agregar("borders", borde) == 0
+        assert estilos.xf_con_formato(0, "DD/MM/YYYY") == 1
+        assert orden_estilos(estilos.serializar()) == ["numFmts", "fonts", "fills", "borders", "cellXfs", "dxfs"]
+
+    def test_reordenar_referencia_conserva_formatos_y_anchos(self, tmp_path, monkeypatch):
+        archivo = tmp_path / "EXPORT.xlsx"
+        wb = Workbook()
+        ws = wb.active
+        ws.title = "Data SAP"
+        ws.append(["Fecha doc.", "Importe", "Referencia", "Texto"])
+        for i in range(50):
+            ws.append([datetime(2026, 1, 1 + i % 28), i * 1.5, f"COUR{i}", "Pago PayPal"])
+            ws.cell(row=i + 2, column=1).number_format = "DD/MM/YYYY"
+            ws.cell(row=i + 2, column=2).number_format = "#,##0.00"
+        for letra, ancho in zip("ABCD", (12, 15, 25, 40)):
+            ws.column_dimensions[letra].width = ancho
+        ws["C1"].font = Font(bold=True, color="FF0000")
+        ws.auto_filter.ref = "A1:D51"
+        wb.create_sheet("Notas")["A1"] = "no tocar"
+        wb.save(archivo)
+        antes = partes_libro(archivo)
+
+        # Si el reemplazo falla no queda el temporal y el archivo sigue igual
+        def bloqueado(origen, destino):
+            raise PermissionError(destino)
+
+        with monkeypatch.context() as m:
+            m.setattr(paquete_excel.os, "replace", bloqueado)
+            with pytest.raises(PermissionError):
+                ProcesadorExcel().reorganizar_columnas_primera_hoja(archivo)
+        assert not list(tmp_path.glob("~tmp_*"))
+        assert partes_libro(archivo) == antes
+
+        ProcesadorExcel().reorganizar_columnas_primera_hoja(archivo)
+        despues = partes_libro(archivo)
+        # Solo cambia el XML de la hoja SAP
+        assert {n for n in despues if antes.get(n) != despues[n]} == {"xl/worksheets/sheet1.xml"}
+
+        ws = load_workbook(archivo)["Data SAP"]
+        assert [c.value for c in ws[1]] == ["Referencia", "Fecha doc.", "Importe", "Texto"]
+        assert [c.value for c in ws[3]] == ["COUR1", datetime(2026, 1, 2), 1.5, "Pago PayPal"]
+        assert [c.number_format for c in ws[3]][1:3] == ["DD/MM/YYYY", "#,##0.00"]
+        assert [ws.column_dimensions[letra].width for letra in "ABCD"] == [25, 12, 15, 40]
+        assert ws["A1"].font.b and ws["A1"].font.color.rgb == "00FF0000" and not ws["C1"].font.b
+        assert ws.auto_filter.ref == "A1:D51"
+
+    def test_backfill_descarga_los_pagos_faltantes_en_una_sesion(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        monkeypatch.setattr(Config, "RUTA_MAESTRO", tmp_path / "maestro.xlsx")
+        monkeypatch.setattr(Config, "BASE_PAYPAL", tmp_path)
+        maestro_sintetico(Config.RUTA_MAESTRO)
+        (tmp_path / "Pago #9").mkdir()
+        libro_sap(tmp_path / "Pago #9" / "EXPORT_1_Pago#9.xlsx")
+
+        sesiones = []
+
+        def descargar_reportes(sesion, numeros_pago):
+            sesiones.append(list(numeros_pago))
+            descargas = {}
+            for numero_pago in numeros_pago:
+                descargas[numero_pago] = tmp_path / f"pago {numero_pago}.xlsx"
+                libro_sap(descargas[numero_pago], semilla=numero_pago)
+            descargas[8] = None  # exportación fallida
+            return descargas
+
+        monkeypatch.setattr(main.SesionSAP, "descargar_reportes", descargar_reportes)
+        logger = logging.getLogger(__name__)
+        especificaciones = [(2026, 1, 7), (2026, 1, 8), (2026, 1, 9), (2026, 1, 7)]
+        # El pago 8 no se pudo descargar: el backfill informa el error y sigue con los demás
+        assert ejecutar_backfill(especificaciones, logger, descargar=True) == 1
+
+        # Un solo inicio de sesión para todos los pagos sin Excel (el 9 ya lo tenía)
+        assert sesiones == [[7, 8]]
+        archivo = main.excel_del_pago(7)
+        assert archivo is not None and archivo.parent == tmp_path / "Pago #7"
+        assert (tmp_path / "Pago #7" / "Soporte").is_dir()
+        assert load_workbook(archivo).sheetnames == ["Data SAP", "Validación"]
+        assert main.excel_del_pago(8) is None
+
+        # Con todo descargado no se vuelve a abrir SAP
+        assert ejecutar_backfill([(2026, 1, 7), (2026, 1, 9)], logger, descargar=True) == 0
+        assert sesiones == [[7, 8]]
+
+    def test_backfill_conserva_la_revision_de_soportes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        monkeypatch.setattr(Config, "RUTA_MAESTRO", tmp_path / "maestro.xlsx")
+        monkeypatch.setattr(Config, "BASE_PAYPAL", tmp_path)
+        (tmp_path / "Pago #7").mkdir()
+        archivo = tmp_path / "Pago #7" / "EXPORT_1_Pago#7.xlsx"
+        libro_sap(archivo)
+        maestro_sintetico(Config.RUTA_MAESTRO)
+        logger = logging.getLogger(__name__)
+        assert ejecutar_backfill([(2026, 1, 7)], logger) == 0
+
+        # Revisión de soportes ya hecha sobre la hoja 'Validación'
+        df = ProcesadorExcel().leer_validacion_existente(archivo)
+        df["Observaciones"] = [f"Revisado {i}" for i in range(len(df))]
+        df["Fecha del envío"] = pd.Timestamp(2026, 1, 20)
+        ProcesadorExcel().guardar_excel_con_dos_hojas(archivo, df)
+
+        # Cambia una factura en el maestro (reconstrucción incremental) y después sin caché (completa)
+        maestro_sintetico(Config.RUTA_MAESTRO, gross_cour3=55.0)
+        for usar_cache in (True, False):
+            monkeypatch.setattr(Config, "USAR_CACHE_MAESTRO", usar_cache)
+            assert ejecutar_backfill([(2026, 1, 7)], logger) == 0
+            df = ProcesadorExcel().leer_validacion_existente(archivo)
+            assert df["Observaciones"].astype(str).tolist() == [f"Revisado {i}" for i in range(20)]
+            assert (df["Fecha del envío"] == pd.Timestamp(2026, 1, 20)).all()
+            assert df.loc[df["Invoice Numbers"] == "COUR3", "Gross"].tolist() == [55.0, 55.0]
+
+    def test_proyeccion_del_maestro_con_columnas_extra_renombradas_y_faltantes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(Config, "USAR_CACHE_MAESTRO", False)
+        monkeypatch.setattr(Config, "USAR_ESPEJO_MAESTRO", False)
+        # Título encima del encabezado; "Prorrateo Disputa" falta, el neto usa su alias,
+        # Gross viene en mayúsculas con espacios y hay columnas que la segunda hoja no usa
+        nombres = {"Gross": " GROSS ", "Neto despues de prorrateo": "Neto, despues de prorrateo"}
+        encabezado = ["Comentario interno"] + [nombres.get(col, col) for col in Config.COLUMNAS_SEGUNDA_HOJA
+                                               if col != "Prorrateo Disputa"] + ["Pago#", "Columna extra"]
+        wb = Workbook()
+        ws = wb.active
+        ws.title = Config.HOJA_MAESTRO
+        ws.append(["REPORTE COURIER 2026"])
+        ws.append(encabezado)
+        for i in range(12):
+            fila = {col: None for col in encabezado}
+            fila.update({
+                "Comentario interno": f"nota {i}", "Date": datetime(2026, 1, 1 + i), "Currency": "USD",
+                " GROSS ": 10.0 + i, "Fee": 1.5, "Net": "N/A" if i == 4 else 8.5 + i,
+                "Neto, despues de prorrateo": 7.0 + i, "Invoice Numbers": f"COUR{i // 2}",
+                "Order Id Paypal": f"ORD{i}", "Fecha_pago": datetime(2026, 1, 15), "Columna extra": i,
+            })
+            ws.append(list(fila.values()))
+            if i == 5:
+                ws.append([])
+        wb.save(tmp_path / "maestro.xlsx")
+        maestro = tmp_path / "maestro.xlsx"
+
+        procesador = ProcesadorExcel()
+        proyectado = procesador._leer_hoja_maestro_proyectada(maestro, Config.HOJA_MAESTRO)
+
+        # Mismas columnas (con el nombre del maestro) y valores que una lectura completa
+        requeridas = procesador._columnas_maestro_requeridas()
+        completo = pd.read_excel(maestro, sheet_name=Config.HOJA_MAESTRO, header=1, dtype=object)
+        completo.columns = [str(col).strip() for col in completo.columns]
+        completo = completo[[col for col in completo.columns if col.lower() in requeridas]]
+        completo = completo.dropna(how="all").reset_index(drop=True)
+        completo = completo.astype(object).where(completo.notna(), None)
+        pd.testing.assert_frame_equal(proyectado, completo)
+        assert "Neto, despues de prorrateo" in proyectado.columns and "GROSS" in proyectado.columns
+        assert not {"Comentario interno", "Columna extra", "Pago#", "Prorrateo Disputa"} & set(proyectado.columns)
+
+        # La segunda hoja toma el neto del alias y deja vacía la columna que falta
+        df = procesador.crear_segunda_hoja(None, maestro, 1, 2026)
+        assert len(df) == 12
+        assert df["Neto despues de prorrateo"].tolist() == [7.0 + i for i in range(12)]
+        assert df["Gross"].tolist() == [10.0 + i for i in range(12)]
+        assert df["Prorrateo Disputa"].isna().all()
+
+    def test_encabezado_recordado_sobrevive_a_cambios_del_maestro(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        monkeypatch.setattr(Config, "USAR_CACHE_MAESTRO", True)
+        monkeypatch.setattr(Config, "USAR_ESPEJO_MAESTRO", False)
+        maestro = tmp_path / "maestro.xlsx"
+        maestro_sintetico(maestro)
+        cache = cache_maestro.CacheMaestro()
+        ProcesadorExcel().leer_maestro(maestro)
+        recordado = cache.obtener_encabezado(maestro, Config.HOJA_MAESTRO)
+        assert recordado["fila"] == 0
+
+        # El maestro cambia: la instantánea se descarta, el encabezado recordado no
+        maestro_sintetico(maestro, gross_cour3=55.0)
+        detecciones = []
+        monkeypatch.setattr(cache_maestro.CacheMaestro, "guardar_encabezado",
+                            lambda *args: detecciones.append(args))
+        df = ProcesadorExcel().leer_maestro(maestro)
+        assert df.loc[df["Invoice Numbers"] == "COUR3", "Gross"].tolist() == [55.0, 55.0]
+        assert detecciones == []
+        assert cache.obtener_encabezado(maestro, Config.HOJA_MAESTRO) == recordado
+
+        # Solo una invalidación explícita lo olvida
+        cache.invalidar(maestro, Config.HOJA_MAESTRO)
+        assert cache.obtener_encabezado(maestro, Config.HOJA_MAESTRO) == recordado
+        cache.invalidar(maestro, Config.HOJA_MAESTRO, encabezado=True)
+        assert cache.obtener_encabezado(maestro, Config.HOJA_MAESTRO) is None
+
+    def test_segunda_ejecucion_de_la_interfaz_es_incremental(self, tmp_path, monkeypatch):
+        pytest.importorskip("customtkinter")
+        from interfaz import PaymentApp
+
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        monkeypatch.setattr(Config, "RUTA_MAESTRO", tmp_path / "maestro.xlsx")
+        monkeypatch.setattr(Config, "BASE_PAYPAL", tmp_path)
+        maestro_sintetico(Config.RUTA_MAESTRO)
+
+        construidas = []
+        construir = ProcesadorExcel._construir_segunda_hoja
+
+        def contar_construccion(procesador, df_filtrado):
+            construidas.append(len(df_filtrado))
+            return construir(procesador, df_filtrado)
+
+        def revisar_soportes(gestor, df, carpeta_soporte, progress_callback=None):
+            df["Observaciones"] = [f"Revisado {i}" for i in range(len(df))]
+            return df
+
+        monkeypatch.setattr(ProcesadorExcel, "_construir_segunda_hoja", contar_construccion)
+        monkeypatch.setattr(GestorPDFs, "procesar_documentos_soporte", revisar_soportes)
+
+        for gross_cour3 in (40.0, 55.0):
+            maestro_sintetico(Config.RUTA_MAESTRO, gross_cour3=gross_cour3)
+            descarga = tmp_path / "Descargas" / "export.xlsx"
+            descarga.parent.mkdir(exist_ok=True)
+            libro_sap(descarga)
+            # Los pasos 3 a 5 de la interfaz, con el mismo procesador que crea start_workflow
+            app = SimpleNamespace(
+                procesador=ProcesadorExcel(), archivo_descargado=descarga, numero_pago=7,
+                mes_pago=1, año_pago=2026, exportacion_rapida=False, workflow_steps=[None] * 5,
+                log_message=lambda mensaje: None,
+            )
+            PaymentApp._process_excel(app)
+            PaymentApp._search_pdfs(app)
+
+        # Primera ejecución completa; en la segunda solo se reconstruye la factura que cambió
+        assert construidas == [20, 2]
+        df = ProcesadorExcel().leer_validacion_existente(app.archivo_movido)
+        assert df["Observaciones"].astype(str).tolist() == [f"Revisado {i}" for i in range(20)]
+        assert df.loc[df["Invoice Numbers"] == "COUR3", "Gross"].tolist() == [55.0, 55.0]
+
+    def test_actualizar_maestro_solo_reescribe_las_celdas_del_pago(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        maestro = tmp_path / "maestro.xlsx"
+        maestro_sintetico(maestro)
+        procesador = ProcesadorExcel()
+        df = procesador.crear_segunda_hoja(None, maestro, 1, 2026)
+        df["Observaciones"] = [f"Revisado {i}" for i in range(len(df))]
+        df["Fecha del envío"] = pd.Timestamp(2026, 1, 20)
+        antes = partes_libro(maestro)
+
+        resultado = procesador.actualizar_maestro(maestro, df, 7)
+        assert (resultado["celdas"], resultado["registros"], resultado["no_encontrados"]) == (60, 20, 0)
+        despues = partes_libro(maestro)
+        # Solo cambian la hoja del maestro y los estilos (formato de fecha); openpyxl ya deja
+        # el recálculo al abrir en workbook.xml
+        assert {n for n in despues if antes.get(n) != despues[n]} == {"xl/worksheets/sheet1.xml", "xl/styles.xml"}
+
+        ws = load_workbook(maestro)[Config.HOJA_MAESTRO]
+        encabezado = [celda.value for celda in ws[1]]
+        fila = [celda for celda in ws[8]]
+        assert fila[encabezado.index("Pago#")].value == 7
+        assert fila[encabezado.index("Observaciones")].value == "Revisado 6"
+        assert fila[encabezado.index("Fecha del envío")].value == datetime(2026, 1, 20)
+        assert fila[encabezado.index("Fecha del envío")].number_format == "DD/MM/YYYY"
+        assert fila[encabezado.index("Gross")].value == 40.0
+
+        # Sin cambios no se reescribe nada
+        assert procesador.actualizar_maestro(maestro, df, 7)["celdas"] == 0
+        assert partes_libro(maestro) == despues
+
+        # Maestro abierto por otro usuario: no se actualiza y no queda el temporal
+        def bloqueado(origen, destino):
+            raise PermissionError(destino)
+
+        monkeypatch.setattr(paquete_excel.os, "replace", bloqueado)
+        assert procesador.actualizar_maestro(maestro, df, 8) is None
+        assert partes_libro(maestro) == despues
+        assert not list(tmp_path.glob("~tmp_*"))
+
+    def test_actualizar_maestro_conserva_tablas_validaciones_y_formulas(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        maestro = tmp_path / "maestro.xlsx"
+        maestro_sintetico(maestro)
+
+        # Maestro "de producción": tabla, validación de datos, formato condicional y una
+        # columna de control con fórmula compartida
+        wb = load_workbook(maestro)
+        ws = wb[Config.HOJA_MAESTRO]
+        encabezado = [celda.value for celda in ws[1]]
+        letra = {col: get_column_letter(i + 1) for i, col in enumerate(encabezado)}
+        control = get_column_letter(len(encabezado) + 1)
+        ws[f"{control}1"] = "Control"
+        for fila in range(2, 22):
+            ws[f"{control}{fila}"] = f"={letra['Gross']}{fila}*2"
+        ws.add_table(Table(displayName="Pagos", ref=f"A1:{control}21"))
+        validacion = DataValidation(type="list", formula1='"Revisado 1,Revisado 2"', allow_blank=True)
+        validacion.add(f"{letra['Observaciones']}2:{letra['Observaciones']}21")
+        ws.add_data_validation(validacion)
+        ws.conditional_formatting.add(f"{letra['Gross']}2:{letra['Gross']}21",
+                                      CellIsRule(operator="greaterThan", formula=["20"], font=Font(b=True)))
+        wb.save(maestro)
+
+        partes = partes_libro(maestro)
+        hoja = partes["xl/worksheets/sheet1.xml"].decode()
+        formula = f"<f>{letra['Gross']}2*2</f>"
+        assert formula in hoja
+        hoja = re.sub(rf"<f>{letra['Gross']}(\d+)\*2</f>",
+                      lambda m: (f'<f t="shared" ref="{control}2:{control}21" si="0">{letra["Gross"]}2*2</f>'
+                                 if m.group(1) == "2" else '<f t="shared" si="0"/>'), hoja)
+        partes["xl/worksheets/sheet1.xml"] = hoja.encode()
+        with zipfile.ZipFile(maestro, "w", zipfile.ZIP_DEFLATED) as zf:
+            for nombre, contenido in partes.items():
+                zf.writestr(nombre, contenido)
+
+        procesador = ProcesadorExcel()
+        df = procesador.crear_segunda_hoja(None, maestro, 1, 2026)
+        df["Observaciones"] = [f"Revisado {i % 2 + 1}" for i in range(len(df))]
+        antes = partes_libro(maestro)
+
+        resultado = procesador.actualizar_maestro(maestro, df, 7)
+        assert (resultado["celdas"], resultado["registros"], resultado["no_encontrados"]) == (40, 20, 0)
+        despues = partes_libro(maestro)
+        assert {n for n in despues if antes.get(n) != despues[n]} == {"xl/worksheets/sheet1.xml"}
+
+        # Fórmulas compartidas, validación, formato condicional y tabla quedan como estaban
+        def bloques(xml):
+            xml = xml.decode()
+            return (re.findall(r"<f[ >][^<]*(?:</f>)?|<f [^>]*/>", xml),
+                    re.search(r"<conditionalFormatting.*</dataValidations>", xml, re.S).group(0),
+                    re.search(r"<tableParts.*</tableParts>", xml, re.S).group(0))
+
+        hoja_antes, hoja_despues = antes["xl/worksheets/sheet1.xml"], despues["xl/worksheets/sheet1.xml"]
+        assert bloques(hoja_despues) == bloques(hoja_antes)
+        assert len(re.findall(r't="shared"', hoja_despues.decode())) == 20
+
+        wb = load_workbook(maestro)
+        ws = wb[Config.HOJA_MAESTRO]
+        assert ws[f"{letra['Observaciones']}8"].value == "Revisado 1"
+        assert ws[f"{letra['Pago#']}8"].value == 7
+        assert ws[f"{control}2"].value == f"={letra['Gross']}2*2"
+        assert ws.tables["Pagos"].ref == f"A1:{control}21"
+        assert len(ws.data_validations.dataValidation) == 1 and len(ws.conditional_formatting) == 1
+
+    def test_espejo_anterior_no_queda_en_cache(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro, "directorio_aplicacion", lambda: tmp_path)
+        monkeypatch.setattr(Config, "USAR_ESPEJO_MAESTRO", True)
+        monkeypatch.setattr(Config, "USAR_CACHE_MAESTRO", True)
+
+        def sin_espera(segundos):
+            raise AssertionError("el espejo solo debe esperar entre reintentos")
+
+        monkeypatch.setattr(cache_maestro.time, "sleep", sin_espera)
+        maestro = tmp_path / "red" / "maestro.xlsx"
+        maestro.parent.mkdir()
+        maestro_sintetico(maestro)
+
+        def gross_cour3():
+            df = ProcesadorExcel().leer_maestro(maestro)
+            return df.loc[df["Invoice Numbers"] == "COUR3", "Gross"].tolist()
+
+        assert gross_cour3() == [40, 40]
+
+        # El maestro cambia y la copia falla: se lee el espejo anterior sin guardarlo en caché
+        maestro_sintetico(maestro, gross_cour3=55.0)
+        copiar = cache_maestro.shutil.copyfile
+
+        def copia_fallida(origen, destino):
+            raise OSError("unidad de red no disponible")
+
+        monkeypatch.setattr(cache_maestro.shutil, "copyfile", copia_fallida)
+        assert gross_cour3() == [40, 40]
+
+        monkeypatch.setattr(cache_maestro.shutil, "copyfile", copiar)
+        assert gross_cour3() == [55, 55]
+
+    def test_espejo_no_copia_el_maestro_abierto_en_excel(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cache_maestro.time, "sleep", lambda segundos: None)
+        maestro = tmp_path / "red" / "maestro.xlsx"
+        maestro.parent.mkdir()
+        propietario = maestro.with_name("~$maestro.xlsx")
+        espejo = cache_maestro.EspejoMaestro(tmp_path / "espejo")
+
+        # Sin espejo anterior se copia aunque esté abierto
+        maestro.write_bytes(b"version 1")
+        propietario.write_bytes(b"usuario")
+        assert espejo.sincronizar(maestro).read_bytes() == b"version 1"
+
+        # Abierto y con cambios: se usa el espejo anterior sin copiar
+        maestro.write_bytes(b"version 2 (guardando)")
+        copias = []
+        monkeypatch.setattr(cache_maestro.shutil, "copyfile", lambda *args: copias.append(args))
+        assert espejo.sincronizar(maestro).read_bytes() == b"version 1"
+        assert espejo.desactualizado and copias == []
+
+        # Cerrado en Excel: se copia la versión nueva
+        monkeypatch.undo()
+        propietario.unlink()
+        assert espejo.sincronizar(maestro).read_bytes() == b"version 2 (guardando)"
+        assert not espejo.desactualizado
+
@@ -0,0 +1,145 @@
+import os
+import zipfile
+from datetime import datetime
+
+import pandas as pd
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import Font, PatternFill
+
+from normalizacion import aplicar_esquema
+from scripts.verificacion import VerificadorActualizadorSoportes, sondear_libro
+
+
+def libro(archivo, hojas):
+    """Libro con las hojas indicadas ({nombre: filas})"""
+    wb = Workbook()
+    wb.remove(wb.active)
+    for nombre, filas in hojas.items():
+        ws = wb.create_sheet(nombre)
+        for fila in filas:
+            ws.append(fila)
+    wb.save(archivo)
+    return archivo
+
+
+def mover_workbook_xml(archivo, nueva_ruta="xl/principal.xml"):
+    """Reescribe el paquete con workbook.xml en otra ruta (declarada en _rels/.rels)"""
+    with zipfile.ZipFile(archivo) as zf:
+        partes = {nombre: zf.read(nombre) for nombre in zf.namelist()}
+    rels_nuevas = f"xl/_rels/{os.path.basename(nueva_ruta)}.rels"
+    partes[nueva_ruta] = partes.pop("xl/workbook.xml")
+    partes[rels_nuevas] = partes.pop("xl/_rels/workbook.xml.rels")
+    partes["_rels/.rels"] = partes["_rels/.rels"].replace(b'Target="xl/workbook.xml"',
+                                                          f'Target="{nueva_ruta}"'.encode())
+    partes["[Content_Types].xml"] = partes["[Content_Types].xml"].replace(b"/xl/workbook.xml",
+                                                                          f"/{nueva_ruta}".encode())
+    with zipfile.ZipFile(archivo, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nombre, contenido in partes.items():
+            zf.writestr(nombre, contenido)
+
+
+def celdas(archivo):
+    """{(hoja, coordenada): (valor, formato, negrita, relleno)} de todas las celdas del libro"""
+    wb = load_workbook(archivo)
+    return {(ws.title, c.coordinate): (c.value, c.number_format, c.font.b, c.fill.fgColor.rgb)
+            for ws in wb for fila in ws.iter_rows() for c in fila}
+
+
+def partes(archivo):
+    with zipfile.ZipFile(archivo) as zf:
+        return {nombre: zf.read(nombre) for nombre in zf.namelist()}
+
+
+class TestVerificacion():
+    def test_sondeo_ubica_workbook_por_las_relaciones(self, tmp_path):
+        archivo = libro(tmp_path / "pago.xlsx", {"Data SAP": [["Referencia"]],
+                                                 "Validación": [["Date"], ["01/01/2026"], ["02/01/2026"]]})
+        mover_workbook_xml(archivo)
+
+        sondeo = sondear_libro(archivo)
+        assert sondeo.hojas == ["Data SAP", "Validación"]
+        assert sondeo.hoja_validacion == "Validación" and sondeo.filas("Validación") == 3
+        assert sondear_libro(tmp_path / "no_existe.xlsx") is None
+
+    def test_ranking_de_candidatos(self, tmp_path):
+        validacion = {"Data SAP": [["Referencia"]], "Validación": [["Date"], ["01/01/2026"]]}
+        ganador = libro(tmp_path / "EXPORT_20260101_Pago#5.xlsx", validacion)
+        vacio = libro(tmp_path / "EXPORT_20260102_Pago#5.xlsx", {"Data SAP": [["Referencia"]],
+                                                                  "Validación": [["Date"]]})
+        por_indice = libro(tmp_path / "EXPORT_20260103_Pago#5.xlsx", {"Data SAP": [["Referencia"]],
+                                                                       "Hoja2": [["Date"], ["x"]]})
+        nombrado = libro(tmp_path / "revision.xlsx", validacion)
+        libro(tmp_path / "EXPORT_solo_sap.xlsx", {"Data SAP": [["Referencia"]]})
+        libro(tmp_path / "~$EXPORT_20260101_Pago#5.xlsx", validacion)
+        libro(tmp_path / "Soporte EXPORT.xlsx", validacion)
+        antiguo = tmp_path / "EXPORT_antiguo.xls"
+        antiguo.write_bytes(b"no es un zip")
+
+        candidatos = VerificadorActualizadorSoportes([]).obtener_archivo_excel_pago(tmp_path)
+
+        # Hoja 'Validación' con datos primero (el nombre EXPORT desempata), luego vacía,
+        # luego segunda hoja por índice; los .xls al final; sin segunda hoja se descartan
+        assert candidatos == [ganador, nombrado, vacio, por_indice, antiguo]
+
+    def test_guardar_observaciones_solo_cambia_esas_celdas(self, tmp_path):
+        archivo = libro(tmp_path / "pago.xlsx", {
+            "Data SAP": [["Referencia", "Valor"], ["INV1", 10], ["INV2", 20]],
+            "Validación": [["Date", "Invoice Numbers", "Gross", "Diferencia", "Observaciones"],
+                           ["01/02/2026", "INV1", 10, "=C2-1", None],
+                           ["02/02/2026", "INV2", 20, "=C3-1", " Soportes OK"],
+                           ["03/02/2026", "INV3", 30, "=C4-1", "Falta la guia de transporte"],
+                           [None, "TOTALES", "=SUM(C2:C4)", "=SUM(D2:D4)", None]]})
+        wb = load_workbook(archivo)
+        ws = wb["Validación"]
+        for celda in ws[1]:
+            celda.font = Font(bold=True)
+            celda.fill = PatternFill(start_color="FF69E2FF", end_color="FF69E2FF", fill_type="solid")
+        ws.column_dimensions["E"].width = 44
+        wb.save(archivo)
+        antes, partes_antes = celdas(archivo), partes(archivo)
+
+        verificador = VerificadorActualizadorSoportes([])
+        df = verificador.leer_segunda_hoja_excel(archivo)
+        df.at[0, "Observaciones"] = "Falta la factura comercial"
+        df.at[2, "Observaciones"] = " Soportes OK"
+        assert verificador.actualizar_excel_con_nuevas_observaciones(archivo, df)
+
+        despues = celdas(archivo)
+        cambiadas = {k for k in antes if antes[k] != despues[k]}
+        assert cambiadas == {("Validación", "E2"), ("Validación", "E4")}
+        assert despues[("Validación", "E2")][0] == "Falta la factura comercial"
+        assert despues[("Validación", "E4")][0] == " Soportes OK"
+        assert load_workbook(archivo)["Validación"].column_dimensions["E"].width == 44
+
+        # Solo se reescribe la hoja de validación; el resto del paquete queda idéntico
+        partes_despues = partes(archivo)
+        distintas = {n for n in partes_antes if partes_antes[n] != partes_despues.get(n)}
+        assert distintas == {"xl/worksheets/sheet2.xml"}
+
+        # Sin cambios no se toca el archivo
+        contenido = archivo.read_bytes()
+        assert verificador.actualizar_excel_con_nuevas_observaciones(archivo, verificador.leer_segunda_hoja_excel(archivo))
+        assert archivo.read_bytes() == contenido
+
+    def test_lectura_proyectada_igual_a_lectura_completa(self, tmp_path):
+        filas = [["Date", "Currency", "Gross", "Invoice Numbers", "Número guía", "Fecha del envío",
+                  "Order Id Paypal", "Fecha_pago", "Diferencia", "Observaciones"]]
+        for i in range(30):
+            filas.append([datetime(2026, 1, 1 + i % 28) if i % 3 else f"{1 + i % 28:02d}/01/2026", "USD", 10.5 + i,
+                          f"COUR{i // 2}" if i % 7 else 1000 + i, 9_000_000_000 + i if i % 4 else None,
+                          "15/01/2026", f"ORD{i}", datetime(2026, 1, 20), f"=C{i + 2}-1",
+                          None if i % 5 else "Falta la guia de transporte"])
+        filas.append([None, None, "=SUM(C2:C31)", "TOTALES"])
+
+        verificador = VerificadorActualizadorSoportes([])
+        for nombre in ("Validación", "Hoja2"):
+            archivo = libro(tmp_path / f"{nombre}.xlsx", {"Data SAP": [["Referencia"], ["COUR1"]], nombre: filas})
+            obtenido = verificador.leer_segunda_hoja_excel(archivo)
+
+            # Lectura anterior: hoja completa con read_excel y después las columnas de la verificación
+            completo = pd.read_excel(archivo, sheet_name=1, engine="openpyxl", dtype=object)
+            esperado = aplicar_esquema(completo[[c for c in completo.columns
+                                                 if c in VerificadorActualizadorSoportes.COLUMNAS_VERIFICACION]])
+            pd.testing.assert_frame_equal(obtenido, esperado)
+            assert verificador._ultima_hoja_leida == nombre
@@ -4,13 +4,20 @@ Busca documentos en OneDrive, los copia a Soporte y actualiza Excel automáticam
 """
 
 import logging
+import re
 import shutil
+import zipfile
+from itertools import islice
+import xml.etree.ElementTree as ET
 from pathlib import Path
 from typing import Optional, Tuple, List, Dict
 import pandas as pd
 from dataclasses import dataclass, field
 from enum import Enum
 
+from normalizacion import aplicar_esquema, asignar_valor, limpiar_nulo, preparar_para_excel
+from paquete_excel import actualizar_celdas, hojas as rutas_hojas
+
 
 class EstadoSoporte(Enum):
     """Estados posibles de un soporte"""
@@ -37,6 +44,58 @@ class ResultadoVerificacion:
     carpeta_soporte: Optional[Path] = None
 
 
+# Nombres posibles de la hoja procesada, en orden de preferencia
+HOJAS_VALIDACION = ['Validación', 'Validación Nataly']
+
+_PATRON_DIMENSION = re.compile(rb'<(?:\w+:)?dimension\s+ref="([^"]+)"')
+
+
+@dataclass
+class SondeoLibro:
+    """Hojas y dimensiones de un .xlsx/.xlsm leídas sin parsear las celdas"""
+    archivo: Path
+    hojas: List[str]
+    dimensiones: Dict[str, Optional[str]] = field(default_factory=dict)
+
+    @property
+    def hoja_validacion(self) -> Optional[str]:
+        """Hoja que leería la verificación: una de HOJAS_VALIDACION o, si no, la segunda"""
+        for nombre in HOJAS_VALIDACION:
+            if nombre in self.hojas:
+                return nombre
+        return self.hojas[1] if len(self.hojas) >= 2 else None
+
+    def filas(self, hoja: str) -> Optional[int]:
+        """Última fila declarada en <dimension> (None si el archivo no la declara)"""
+        ref = self.dimensiones.get(hoja)
+        if not ref:
+            return None
+        coincidencia = re.search(r"(\d+)$", ref.split(":")[-1])
+        return int(coincidencia.group(1)) if coincidencia else None
+
+
+def sondear_libro(archivo: Path) -> Optional[SondeoLibro]:
+    """
+    Lista las hojas de un .xlsx/.xlsm leyendo solo el directorio del zip, workbook.xml
+    (ubicado por _rels/.rels, ver paquete_excel.hojas) y el inicio de cada hoja (donde
+    está <dimension>). Retorna None si no es un zip válido.
+    """
+    try:
+        with zipfile.ZipFile(archivo) as z:
+            rutas = rutas_hojas(z)
+            dimensiones = {}
+            for nombre, ruta in rutas.items():
+                dimensiones[nombre] = None
+                if ruta in z.NameToInfo:
+                    with z.open(ruta) as f:
+                        coincidencia = _PATRON_DIMENSION.search(f.read(4096))
+                    if coincidencia:
+                        dimensiones[nombre] = coincidencia.group(1).decode("ascii")
+            return SondeoLibro(archivo=archivo, hojas=list(rutas), dimensiones=dimensiones)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, OSError):
+        return None
+
+
 class VerificadorActualizadorSoportes:
     """
     Verifica soportes de pagos, copia documentos de OneDrive a Soporte
@@ -110,7 +169,25 @@ class VerificadorActualizadorSoportes:
                 score += (f.stat().st_mtime / 1_000_000_000) 
                 return score
 
-            candidatos.sort(key=prioridad, reverse=True)
+            # Sondeo barato (sin parsear celdas): hojas y dimensiones de cada candidato.
+            # Los .xls no se pueden sondear y van al final; los libros sin segunda hoja se descartan.
+            sondeos = {f: sondear_libro(f) for f in candidatos if f.suffix.lower() != ".xls"}
+
+            def prioridad_contenido(f: Path):
+                sondeo = sondeos.get(f)
+                if sondeo is None:
+                    return (0, 0, 0)
+                hoja = sondeo.hoja_validacion
+                con_nombre = hoja in HOJAS_VALIDACION
+                con_datos = (sondeo.filas(hoja) or 2) > 1 if hoja else False
+                return (2 if hoja else -1, int(con_nombre), int(con_datos))
+
+            descartados = [f for f in candidatos if prioridad_contenido(f)[0] < 0]
+            if descartados:
+                self.logger.info(f"Candidatos sin hoja de validación (no se leerán): {[f.name for f in descartados]}")
+            candidatos = [f for f in candidatos if f not in descartados]
+
+            candidatos.sort(key=lambda f: (prioridad_contenido(f), prioridad(f)), reverse=True)
             self.logger.info(f"Candidatos encontrados: {[f.name for f in candidatos]}")
             return candidatos
             
@@ -118,60 +195,49 @@ class VerificadorActualizadorSoportes:
             self.logger.error(f"Error buscando candidatos Excel en {carpeta_pago}: {e}")
             return []
     
+    # Columnas de la hoja de validación que usa la verificación
+    COLUMNAS_VERIFICACION = [
+        "Date", "Invoice Numbers", "Número guía", "Fecha del envío", "Fecha_pago", "Observaciones"
+    ]
+
     def leer_segunda_hoja_excel(self, archivo_excel: Path) -> Optional[pd.DataFrame]:
-        """Lee la segunda hoja del Excel (Validación o Validación Nataly)"""
+        """
+        Lee la segunda hoja del Excel (Validación o Validación Nataly).
+        El libro se abre una sola vez y solo se cargan las columnas que usa la verificación.
+        """
         try:
-            # Intentar obtener los nombres de las hojas primero
-            xl = pd.ExcelFile(archivo_excel)
-            hojas = xl.sheet_names
-            
-            # Lista de nombres posibles para la hoja procesada
-            nombres_posibles = ['Validación', 'Validación Nataly']
-            nombre_final = None
-            
-            # Buscar si alguno de los nombres existe en el archivo
-            for nombre in nombres_posibles:
-                if nombre in hojas:
-                    nombre_final = nombre
-                    break
-            
-            if nombre_final:
-                df = pd.read_excel(archivo_excel, sheet_name=nombre_final, engine='openpyxl', dtype=object)
-            elif len(hojas) >= 2:
-                # Si no existe ninguno de los nombres, pero hay al menos 2 hojas, intentar con la segunda hoja por índice
-                self.logger.warning(f"No se encontró ninguna de las hojas {nombres_posibles}. Intentando con la segunda hoja: '{hojas[1]}'")
-                df = pd.read_excel(archivo_excel, sheet_name=1, engine='openpyxl', dtype=object)
-            else:
-                self.logger.error(f"El archivo Excel {archivo_excel.name} solo tiene una hoja: {hojas}. Se requieren al menos 2.")
-                return None
+            # Abrir el libro una vez: la lista de hojas y la lectura usan el mismo manejador
+            with pd.ExcelFile(archivo_excel) as xl:
+                hojas = xl.sheet_names
+                
+                # Lista de nombres posibles para la hoja procesada
+                nombres_posibles = HOJAS_VALIDACION
+                nombre_final = None
+                
+                # Buscar si alguno de los nombres existe en el archivo
+                for nombre in nombres_posibles:
+                    if nombre in hojas:
+                        nombre_final = nombre
+                        break
+
+                def columnas(col) -> bool:
+                    return col in self.COLUMNAS_VERIFICACION
+
+                if nombre_final:
+                    df = xl.parse(sheet_name=nombre_final, dtype=object, usecols=columnas)
+                elif len(hojas) >= 2:
+                    # Si no existe ninguno de los nombres, pero hay al menos 2 hojas, intentar con la segunda hoja por índice
+                    self.logger.warning(f"No se encontró ninguna de las hojas {nombres_posibles}. Intentando con la segunda hoja: '{hojas[1]}'")
+                    df = xl.parse(sheet_name=1, dtype=object, usecols=columnas)
+                else:
+                    self.logger.error(f"El archivo Excel {archivo_excel.name} solo tiene una hoja: {hojas}. Se requieren al menos 2.")
+                    return None
 
             # Guardar el nombre de la hoja leída para usarlo al guardar
             self._ultima_hoja_leida = nombre_final or (hojas[1] if len(hojas) >= 2 else None)
 
-            # CORRECCIÓN DE FECHAS: Asegurar formato dd/mm/aaaa y quitar horas de forma segura
-            columnas_fecha = ["Date", "Fecha del envío", "Fecha_pago"]
-            for col in columnas_fecha:
-                if col in df.columns:
-                    def _formatear_fecha_segura(val):
-                        if pd.isna(val) or str(val).strip() == "":
-                            return ""
-                        try:
-                            # Si ya es un objeto de fecha/tiempo
-                            if isinstance(val, (pd.Timestamp, datetime)):
-                                return val.strftime('%d/%m/%Y')
-                            
-                            # Si es un string, intentar parsear
-                            # Usamos dayfirst=True para el formato dd/mm/yyyy común en sus archivos
-                            dt = pd.to_datetime(val, dayfirst=True, errors='coerce')
-                            if pd.notna(dt):
-                                return dt.strftime('%d/%m/%Y')
-                            
-                            # Si no se pudo parsear, devolver el valor original como string
-                            return str(val).strip()
-                        except:
-                            return str(val).strip()
-
-                    df[col] = df[col].apply(_formatear_fecha_segura)
+            # CORRECCIÓN DE FECHAS (dd/mm/aaaa, sin horas) y tipos compactos para el resto del proceso
+            aplicar_esquema(df)
 
             self.logger.info(f"Se leyeron {len(df)} registros de {archivo_excel.name} (fechas corregidas)")
             return df
@@ -323,13 +389,9 @@ class VerificadorActualizadorSoportes:
     def analizar_observaciones_registro(self, row: pd.Series) -> Dict:
         """Analiza qué documentos faltan según las observaciones"""
         # Limpiar valores para detectar si la fila está realmente vacía
-        def _limpiar(val):
-            v = str(val).strip().lower()
-            return "" if v in ["nan", "none", ""] else str(val).strip()
-
-        observaciones = _limpiar(row.get('Observaciones', ''))
-        invoice = _limpiar(row.get('Invoice Numbers', ''))
-        guia = _limpiar(row.get('Número guía', ''))
+        observaciones = limpiar_nulo(row.get('Observaciones', ''))
+        invoice = limpiar_nulo(row.get('Invoice Numbers', ''))
+        guia = limpiar_nulo(row.get('Número guía', ''))
         
         resultado = {
             'falta_factura': False,
@@ -410,66 +472,82 @@ class VerificadorActualizadorSoportes:
         
         return "Soportes OK"
     
+    # Columnas que el verificador modifica y que se sincronizan con el Excel
+    COLUMNAS_ACTUALIZABLES = ["Observaciones", "Date", "Fecha del envío", "Fecha_pago"]
+
     def actualizar_excel_con_nuevas_observaciones(self, 
                                                   archivo_excel: Path,
                                                   df_actualizado: pd.DataFrame) -> bool:
-        """Guarda el DataFrame actualizado en el Excel"""
+        """
+        Escribe en el Excel solo las celdas que cambiaron (observaciones y fechas corregidas).
+
+        La hoja se lee en modo read_only para comparar cada valor del DataFrame con la celda
+        de su fila (índice + 2, la fila 1 es la cabecera); las diferentes se escriben con
+        paquete_excel.actualizar_celdas, el mismo camino que usa main.py para el maestro.
+        Fórmulas (Diferencia, TOTALES), estilos, anchos y el resto del libro quedan intactos.
+        """
         try:
             from openpyxl import load_workbook
-            from openpyxl.styles import PatternFill, Font, Alignment
-            from openpyxl.utils import get_column_letter
-            
+
             self.logger.info(f"Guardando cambios en {archivo_excel.name}...")
-            
-            # Asegurar que los IDs sean tratados como texto antes de guardar
-            for col in ["Order Id Paypal", "Invoice Numbers", "Número guía"]:
-                if col in df_actualizado.columns:
-                    df_actualizado[col] = df_actualizado[col].astype(str).replace(['nan', 'None', ''], "")
 
             # Usar el nombre de la hoja que se leyó originalmente
             nombre_hoja = getattr(self, '_ultima_hoja_leida', 'Validación')
-            
-            # Guardar con pandas
-            with pd.ExcelWriter(archivo_excel, engine='openpyxl', mode='a', 
-                               if_sheet_exists='replace') as writer:
-                df_actualizado.to_excel(writer, sheet_name=nombre_hoja, index=False)
-            
-            # Aplicar estilos con openpyxl
-            wb = load_workbook(archivo_excel)
-            ws = wb[nombre_hoja]
-            
-            # Estilo cabecera
-            color_fondo = PatternFill(start_color='69E2FF', end_color='69E2FF', fill_type='solid')
-            fuente_cabecera = Font(bold=True)
-            alineacion_centrada = Alignment(horizontal='center', vertical='center')
-            
-            for cell in ws[1]:
-                cell.fill = color_fondo
-                cell.font = fuente_cabecera
-                cell.alignment = alineacion_centrada
-            
-            # Anchos de columna
-            anchos_config = {
-                "Observaciones": 44,
-                "Date": 15,
-                "Fecha del envío": 18,
-                "Invoice Numbers": 18,
-                "Número guía": 20
+
+            # Valores tal como se escriben en Excel (fechas dd/mm/aaaa, categorías como texto)
+            df_excel = preparar_para_excel(df_actualizado)
+
+            # 1. Cabecera y valores actuales (read_only: la hoja de SAP no se carga)
+            wb = load_workbook(archivo_excel, read_only=True)
+            try:
+                ws = wb[nombre_hoja]
+                ws.reset_dimensions()
+                filas = ws.iter_rows(values_only=True)
+                headers = list(next(filas, ()))
+                actuales = list(islice(filas, len(df_excel)))
+            finally:
+                wb.close()
+
+            columnas = {
+                col: headers.index(col)
+                for col in self.COLUMNAS_ACTUALIZABLES
+                if col in headers and col in df_excel.columns
             }
-            
-            headers = [cell.value for cell in ws[1]]
-            for col_idx, col_name in enumerate(headers, 1):
-                if col_name in anchos_config:
-                    letra_col = get_column_letter(col_idx)
-                    ws.column_dimensions[letra_col].width = anchos_config[col_name]
-            
-            wb.save(archivo_excel)
-            self.logger.info("Excel guardado con éxito")
+
+            # 2. Celdas cuyo valor cambió ({fila: {columna: valor}}, base 1)
+            cambios: Dict[int, Dict[int, object]] = {}
+            for col_name, col_idx in columnas.items():
+                for idx, valor in df_excel[col_name].items():
+                    fila = actuales[idx] if idx < len(actuales) else ()
+                    actual = fila[col_idx] if col_idx < len(fila) else None
+                    if isinstance(actual, str) and actual.startswith('='):
+                        continue  # Nunca reemplazar fórmulas
+                    nuevo = self._valor_para_celda(valor)
+                    if nuevo != (None if actual == "" else actual):
+                        cambios.setdefault(idx + 2, {})[col_idx + 1] = nuevo
+
+            if not cambios:
+                self.logger.info("Excel sin cambios, no se reescribe")
+                return True
+
+            # 3. Reescribir solo esas celdas; observaciones y fechas no alimentan fórmulas,
+            #    así que no hace falta forzar el recálculo al abrir
+            escritas = actualizar_celdas(archivo_excel, nombre_hoja, cambios, recalcular=False)
+            self.logger.info(f"Excel guardado con éxito ({sum(escritas.values())} celdas actualizadas)")
             return True
         
         except Exception as e:
             self.logger.error(f"Error guardando Excel: {e}")
             return False
+
+    @staticmethod
+    def _valor_para_celda(valor):
+        """Valor del DataFrame tal como se escribe en una celda: vacíos y nulos como None"""
+        if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+            return None
+        if isinstance(valor, str) and valor == "":
+            return None
+        return valor
     
     def procesar_pago_completo(self, numero_pago: int, base_paypal: Path, progress_callback=None) -> ResultadoVerificacion:
         """
@@ -543,9 +621,6 @@ class VerificadorActualizadorSoportes:
                 detalles=[]
             )
         
-        # Crear copia para actualizar
-        df_actualizado = df.copy()
-        
         # Carpeta soporte
         carpeta_soporte = carpeta_pago / "Soporte"
         carpeta_soporte.mkdir(parents=True, exist_ok=True)
@@ -643,7 +718,7 @@ class VerificadorActualizadorSoportes:
             # Si cambió, actualizar
             cambio = False
             if nueva_observacion != observacion_original:
-                df_actualizado.at[idx, 'Observaciones'] = nueva_observacion
+                asignar_valor(df, idx, 'Observaciones', nueva_observacion)
                 cambio = True
                 observaciones_actualizadas += 1
                 
@@ -679,7 +754,7 @@ class VerificadorActualizadorSoportes:
             progress_callback(0.95, "Guardando Excel...")
 
         # Siempre guardamos el Excel para asegurar que las correcciones de fecha se apliquen
-        exito = self.actualizar_excel_con_nuevas_observaciones(archivo_excel, df_actualizado)
+        exito = self.actualizar_excel_con_nuevas_observaciones(archivo_excel, df)
         if not exito:
             self.logger.error("Error al guardar Excel")
         